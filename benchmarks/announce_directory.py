@@ -0,0 +1,64 @@
+# Fills the announce directory with synthetic announces, and measures
+# loading the first page and scrolling through the following pages of
+# the announce list, unfiltered and with each of the available filters.
+# Hop counts are derived from the destination hash, since no transport
+# instance is running.
+#
+# Usage: python benchmarks/announce_directory.py [announces] [pages]
+
+import os
+import time
+import random
+from common import arg, headless_core, rate, timed
+
+import RNS
+
+announce_count = arg(1, 50000)
+page_count = arg(2, 20)
+words = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliet", "kilo", "lima", "mike", "nörd", "øst", "zürich"]
+
+RNS.Transport.has_path = lambda destination_hash: True
+RNS.Transport.hops_to = lambda destination_hash: destination_hash[0]%8
+
+def ingest(core):
+    random.seed(1)
+    for i in range(announce_count):
+        name = f"{random.choice(words).capitalize()} {random.choice(words)} {i}"
+        dest_type = "lxmf.propagation" if i%10 == 0 else "lxmf.delivery"
+        core.log_announce(os.urandom(16), name.encode("utf-8"), dest_type, stamp_cost=8, link_stats={"rssi": -80, "snr": 5, "q": 90})
+        if i%2000 == 1999: core.flush_announces()
+    core.flush_announces()
+
+def scroll(core, **filters):
+    announces, cursor = core.list_announces_page(**filters)
+    pages = 1
+    while cursor != None and pages < page_count:
+        announces, cursor = core.list_announces_page(cursor=cursor, **filters)
+        pages += 1
+    return pages
+
+with headless_core() as core:
+    _, duration = timed(ingest, core)
+    rate("Announces ingested", announce_count, duration, "announces")
+
+    since = time.time()-1
+    for label, filters in [["All announces", {}],
+                           ["Propagation nodes", {"dest_type": "lxmf.propagation"}],
+                           ["At most 1 hop", {"max_hops": 1}],
+                           ["Received in last second", {"since": since}],
+                           ["Name prefix 'ech'", {"name_prefix": "ech"}],
+                           ["Name prefix 'nö'", {"name_prefix": "nö"}],
+                           ["Name prefix 'golf kil'", {"name_prefix": "golf kil"}]]:
+        _, first = timed(core.list_announces_page, **filters)
+        pages, duration = timed(scroll, core, **filters)
+        print(f"{label:<32} first page {first*1000:8.2f} ms  {pages:>3} pages {duration*1000:8.1f} ms")
+
+    # Paging through the whole directory visits every announce once
+    seen = set(); cursor = None; paged = 0
+    while True:
+        announces, cursor = core.list_announces_page(cursor=cursor, limit=1000)
+        paged += len(announces); seen.update(a["dest"] for a in announces)
+        if cursor == None: break
+    _, duration = timed(core.list_announces)
+    print(f"Full list in {duration*1000:.1f} ms, {paged} announces paged, {len(seen)} distinct")
+    assert paged == len(seen) == announce_count
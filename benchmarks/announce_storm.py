@@ -0,0 +1,80 @@
+# Logs announces from several threads as fast as possible, while another
+# thread saves received messages, and reports the announce ingestion
+# rate and the latency of saving messages, compared to saving messages
+# with no announces arriving. The announce storm is run twice, first
+# with announce flushes held back, which shows the cost of the logging
+# threads alone, and then with announces being written to the database.
+#
+# Usage: python benchmarks/announce_storm.py [announcer threads] [seconds]
+
+import os
+import time
+import random
+import threading
+from common import arg, headless_core, rate, report, timed
+
+import RNS
+import LXMF
+
+announcer_count = arg(1, 4)
+duration = arg(2, 5)
+destination_count = 5000
+message_interval = 0.005
+
+def messages(core, count):
+    own = RNS.Destination(RNS.Identity(), RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
+    core.lxmf_destination.hash = own.hash
+    peers = [RNS.Destination(RNS.Identity(), RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery") for _ in range(20)]
+    pool = []
+    for i in range(count):
+        peer = random.choice(peers)
+        lxm = LXMF.LXMessage(own, peer, f"Message {i}", "", desired_method=LXMF.LXMessage.DIRECT)
+        lxm.pack()
+        pool.append((lxm, peer.hash))
+    return pool
+
+def run(core, pool, announcers, seconds):
+    stop = threading.Event()
+    announced = [0]*announcers
+    latencies = []
+
+    def announcer(index):
+        rng = random.Random(index)
+        destinations = [os.urandom(16) for _ in range(destination_count)]
+        while not stop.is_set():
+            dest = rng.choice(destinations)
+            core.log_announce(dest, f"Peer {dest.hex()[:8]}".encode("utf-8"), "lxmf.delivery", link_stats={"rssi": -90, "snr": 4, "q": 80})
+            announced[index] += 1
+
+    def receiver():
+        while not stop.is_set() and len(pool) > 0:
+            lxm, context_dest = pool.pop()
+            _, latency = timed(core._db_save_lxm, lxm, context_dest)
+            latencies.append(latency)
+            time.sleep(message_interval)
+
+    threads  = [threading.Thread(target=announcer, args=(i,), daemon=True) for i in range(announcers)]
+    threads += [threading.Thread(target=receiver, daemon=True)]
+    for thread in threads: thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads: thread.join()
+    return sum(announced), latencies
+
+with headless_core() as core:
+    pool = messages(core, int(3*duration/message_interval))
+
+    _, latencies = run(core, pool, 0, duration)
+    report("Message saves, no announces", latencies)
+
+    with core.announce_flush_lock:
+        announced, latencies = run(core, pool, announcer_count, duration)
+    report(f"Message saves, {announcer_count} threads, not flushing", latencies)
+    core.flush_announces()
+
+    announced, latencies = run(core, pool, announcer_count, duration)
+    report(f"Message saves, {announcer_count} threads, flushing", latencies)
+    rate("Announces logged", announced, duration, "announces")
+
+    _, flush_duration = timed(core.flush_announces)
+    print(f"Final flush in {flush_duration*1000:.1f} ms, {len(core.list_announces())} announces in directory")
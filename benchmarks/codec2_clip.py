@@ -0,0 +1,75 @@
+# Encodes and decodes a synthetic 5-minute voice clip in every supported
+# Codec2 mode, with the buffer functions and with the streaming encoder
+# reading the clip from a file in odd-sized chunks, and compares them
+# with encoding and decoding by concatenating frames, as was done before.
+# Requires pycodec2.
+#
+# Usage: python benchmarks/codec2_clip.py [clip seconds]
+
+import io
+import math
+import struct
+import numpy as np
+from common import arg, timed
+
+import pycodec2
+from sideband.audioproc import codec2_modes, codec2_encoder, encode_codec2, decode_codec2
+
+clip_seconds = arg(1, 300)
+sample_rate = 8000
+
+def synthetic_clip(seconds):
+    # Voiced segments with a drifting pitch and a few harmonics, with
+    # syllable-rate amplitude modulation and some noise
+    rng = np.random.default_rng(1)
+    t = np.arange(seconds*sample_rate)/sample_rate
+    pitch = 120+30*np.sin(2*np.pi*0.3*t)
+    phase = 2*np.pi*np.cumsum(pitch)/sample_rate
+    voice = sum(np.sin(k*phase)/k for k in range(1, 6))
+    envelope = np.clip(np.sin(2*np.pi*3*t), 0, 1)
+    samples = 6000*voice*envelope+200*rng.standard_normal(len(t))
+    return np.clip(samples, -32768, 32767).astype(np.int16)
+
+def concatenated_encode(samples, rate):
+    c2 = pycodec2.Codec2(rate)
+    spf = c2.samples_per_frame()
+    encoded = b""
+    for i in range(len(samples)//spf):
+        encoded += c2.encode(samples[i*spf:(i+1)*spf])
+    return encoded
+
+def concatenated_decode(encoded, rate):
+    c2 = pycodec2.Codec2(rate)
+    spf = c2.samples_per_frame(); bpf = c2.bytes_per_frame()
+    decoded = b""
+    for i in range(len(encoded)//bpf):
+        decoded += struct.pack(f"{spf}h", *c2.decode(encoded[i*bpf:(i+1)*bpf]))
+    return decoded
+
+def streamed_encode(samples, mode):
+    # Reads the clip as raw PCM in chunks that do not end on a sample
+    # boundary, as they would from a file or socket
+    source = io.BytesIO(samples.tobytes())
+    chunk_size = 4095
+    chunks = iter(lambda: source.read(chunk_size), b"")
+    return b"".join(codec2_encoder(chunks, mode))
+
+clip = synthetic_clip(clip_seconds)
+print(f"Clip of {clip_seconds} s, {len(clip)} samples")
+for mode, rate in codec2_modes.items():
+    c2 = pycodec2.Codec2(rate)
+    whole = len(clip)//c2.samples_per_frame()*c2.samples_per_frame()
+
+    encoded, encode_time = timed(encode_codec2, clip, mode)
+    streamed, stream_time = timed(streamed_encode, clip, mode)
+    decoded, decode_time = timed(decode_codec2, encoded, mode)
+    assert streamed == encoded
+    assert len(decoded) == math.ceil(len(clip)/c2.samples_per_frame())*c2.samples_per_frame()*2
+
+    reference, reference_encode_time = timed(concatenated_encode, clip[:whole], rate)
+    assert reference == encoded[:len(reference)]
+    _, reference_decode_time = timed(concatenated_decode, reference, rate)
+
+    print(f"{rate:>5} bps: {len(encoded):7} bytes  encode {encode_time:6.2f} s, streamed {stream_time:6.2f} s, "
+          f"concatenated {reference_encode_time:6.2f} s  decode {decode_time:6.2f} s, "
+          f"concatenated {reference_decode_time:6.2f} s")
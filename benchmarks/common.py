@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import types
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sbapp_dir = os.path.join(repo_dir, "sbapp")
+for path in [repo_dir, sbapp_dir]:
+    if not path in sys.path:
+        sys.path.insert(0, path)
+
+# Location rendering needs the geoid model from the app assets, which
+# the core points to when it is created, but MQTT and geodesy code is
+# also benchmarked without a core
+os.environ.setdefault("TELEMETER_GEOID_PATH", os.path.join(sbapp_dir, "assets", "geoids"))
+
+import RNS
+
+def arg(index, default):
+    # Returns an integer command line argument, so sizes can be
+    # scaled down for quick runs or up for stress tests
+    try: return int(sys.argv[index])
+    except (IndexError, ValueError): return default
+
+@contextmanager
+def headless_core(quiet=True, **kwargs):
+    # Yields a SidebandCore that has loaded its configuration and
+    # opened its database in a temporary directory, but has not
+    # started Reticulum, LXMF or any of its background jobs. Any
+    # keyword arguments are passed on to SidebandCore.
+    from sideband.core import SidebandCore
+    if quiet:
+        RNS.loglevel = RNS.LOG_WARNING
+
+    core = None
+    config_dir = tempfile.mkdtemp(prefix="sideband_bench_")
+    try:
+        core = SidebandCore(None, config_path=config_dir, load_config_only=True, **kwargs)
+        core.lxmf_destination = types.SimpleNamespace(hash=os.urandom(RNS.Reticulum.TRUNCATED_HASHLENGTH//8))
+        yield core
+    finally:
+        if core != None:
+            core.shutdown_database()
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+def packed_location(latitude, longitude, timestamp, altitude=100.0):
+    # Returns packed telemetry with a location sensor, as it would be
+    # received from a peer and stored in the telemetry table
+    from sideband.sense import Telemeter
+    telemeter = Telemeter()
+    telemeter.sensors["time"].data = {"utc": int(timestamp)}
+    telemeter.synthesize("location")
+    location = telemeter.sensors["location"]
+    location.latitude = latitude; location.longitude = longitude
+    location.altitude = altitude; location.speed = 1.5; location.bearing = 90.0
+    location.accuracy = 5.0; location.set_update_time(timestamp)
+    telemeter.synthesize("battery")
+    battery = telemeter.sensors["battery"]
+    battery.data = {"charge_percent": 50, "charging": False, "temperature": None}
+    return telemeter.packed()
+
+def percentile(samples, p):
+    if len(samples) == 0:
+        return 0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered)-1, int(len(ordered)*p/100))]
+
+def timed(fn, *args, **kwargs):
+    # Returns the result of the call and its duration in seconds
+    st = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter()-st
+
+def report(label, samples, unit="ms"):
+    # Prints a latency summary for a list of durations in seconds
+    scale = 1000 if unit == "ms" else 1000000
+    print(f"{label:<40} n={len(samples):<7} "
+          f"p50={percentile(samples, 50)*scale:9.3f} {unit}  "
+          f"p99={percentile(samples, 99)*scale:9.3f} {unit}  "
+          f"max={max(samples, default=0)*scale:9.3f} {unit}")
+
+def rate(label, count, duration, unit="ops"):
+    print(f"{label:<40} {count/duration if duration > 0 else 0:12.0f} {unit}/s  ({count} in {duration:.3f} s)")
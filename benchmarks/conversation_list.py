@@ -0,0 +1,54 @@
+# Compares building the conversation list from the display-ready
+# entries of list_conversations() with the previous path, which
+# looked up the name, flags and appearance of every row separately.
+#
+# Usage: python benchmarks/conversation_list.py [conversations] [rounds]
+
+import os
+import time
+from common import arg, headless_core, report, timed
+
+conversation_count = arg(1, 1500)
+rounds = arg(2, 10)
+
+def per_row_list(core):
+    # The lookups the conversation list used to make for each row
+    entries = []
+    for conv in core.list_conversations():
+        context_dest = conv["dest"]
+        appearance = core.peer_appearance(context_dest, conv=conv)
+        core.peer_appearance(context_dest, conv=conv)
+        display_name = core.peer_display_name(context_dest)
+        existing_conv = core._db_conversation(context_dest)
+        is_object = core.is_object(context_dest, conv_data=existing_conv)
+        is_trusted = core.is_trusted(context_dest, conv_data=existing_conv)
+        ptt_enabled = core.ptt_enabled(context_dest, conv_data=existing_conv)
+        entries.append((display_name, is_object, is_trusted, ptt_enabled, appearance))
+    return entries
+
+def single_query_list(core):
+    entries = []
+    for conv in core.list_conversations():
+        entries.append((conv["display_name"], conv["is_object"], conv["trust"] == 1, conv["ptt_enabled"], conv["appearance"]))
+    return entries
+
+with headless_core() as core:
+    for i in range(conversation_count):
+        context_dest = os.urandom(16)
+        appearance = ["account", bytes([i%256, 0x40, 0x80]), bytes([0x10, 0x20, i%256])]
+        # Half of the peers have their appearance stored as a temporary
+        # persistent value, and the other half in the conversation itself
+        if i%2 == 0: core._db_update_appearance(context_dest, time.time(), appearance)
+        core._db_create_conversation(context_dest, name=f"Peer {i}", trust=i%3 == 0)
+        if i%2 == 1: core._db_update_appearance(context_dest, time.time(), appearance)
+
+    per_row = []; single = []
+    for _ in range(rounds):
+        expected, duration = timed(per_row_list, core)
+        per_row.append(duration)
+        result, duration = timed(single_query_list, core)
+        single.append(duration)
+
+    report(f"Per-row lookups, {conversation_count} rows", per_row)
+    report(f"Single query, {conversation_count} rows", single)
+    print("Entries match:", sorted(map(str, expected)) == sorted(map(str, result)))
@@ -0,0 +1,64 @@
+# Runs concurrent readers and writers against the database methods of
+# the core. Read latency is measured first with the readers alone, and
+# then while writer threads save telemetry and persistent values, so
+# any blocking of readers by writes shows up in the tail latencies.
+#
+# Usage: python benchmarks/db_contention.py [readers] [writers] [seconds]
+
+import os
+import time
+import random
+import threading
+from common import arg, headless_core, packed_location, report, rate
+
+reader_count = arg(1, 4)
+writer_count = arg(2, 2)
+duration = arg(3, 5)
+source_count = 200
+
+def run(core, readers, writers, seconds):
+    stop = threading.Event()
+    read_samples = [[] for _ in range(readers)]
+    write_counts = [0]*writers
+
+    def reader(samples):
+        calls = [
+            lambda: core.list_conversations(),
+            lambda: core.list_latest_locations(after=time.time()-86400),
+            lambda: core.getpersistent(f"bench.{random.randrange(1000)}"),
+        ]
+        while not stop.is_set():
+            st = time.perf_counter()
+            random.choice(calls)()
+            samples.append(time.perf_counter()-st)
+
+    def writer(index):
+        sources = [os.urandom(16) for _ in range(source_count)]
+        while not stop.is_set():
+            source = random.choice(sources)
+            telemetry = packed_location(random.uniform(-60, 60), random.uniform(-180, 180), time.time()-random.random()*86400)
+            core._db_save_telemetry(source, telemetry, source_dest=source)
+            core.setpersistent(f"bench.{random.randrange(1000)}", time.time())
+            write_counts[index] += 2
+
+    threads  = [threading.Thread(target=reader, args=(read_samples[i],), daemon=True) for i in range(readers)]
+    threads += [threading.Thread(target=writer, args=(i,), daemon=True) for i in range(writers)]
+    for thread in threads: thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads: thread.join()
+
+    return [s for samples in read_samples for s in samples], sum(write_counts)
+
+with headless_core() as core:
+    for i in range(50):
+        core._db_create_conversation(os.urandom(16), name=f"Peer {i}")
+
+    samples, _ = run(core, reader_count, 0, duration)
+    report(f"Reads, {reader_count} readers", samples)
+    rate("Reads", len(samples), duration, "reads")
+
+    samples, writes = run(core, reader_count, writer_count, duration)
+    report(f"Reads, {reader_count} readers, {writer_count} writers", samples)
+    rate("Reads", len(samples), duration, "reads")
+    rate("Writes", writes, duration, "writes")
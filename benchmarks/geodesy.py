@@ -0,0 +1,97 @@
+# Checks the Karney geodesic solver and the scalar ellipsoid distance
+# against reference geodesics on the WGS84 ellipsoid, and the batch
+# geodesy functions against their scalar versions, then times batch and
+# scalar evaluation from one origin to many points. The reference values
+# below were computed with GeographicLib. If the geographiclib package
+# is installed, random pairs are checked against it too.
+#
+# Usage: python benchmarks/geodesy.py [points]
+
+import numpy as np
+from common import arg, timed
+
+from sideband import geo
+
+point_count = arg(1, 10000)
+check_count = 2000
+
+rng = np.random.default_rng(1)
+origin = (47.5, 10.0, 120.0)
+
+def random_points(count):
+    return rng.uniform(-80, 80, count), rng.uniform(-180, 180, count), rng.uniform(0, 3000, count)
+
+def max_difference(batch, scalar):
+    return np.nanmax(np.abs(np.asarray(batch, dtype=float)-np.asarray(scalar, dtype=float)))
+
+def check(label, difference, tolerance):
+    print(f"{label:<48} max difference {difference:.3e}  (tolerance {tolerance:.0e})")
+    assert difference <= tolerance, label
+
+# Latitude and longitude of both points, distance in metres, and the
+# forward azimuths at both points in degrees
+reference = np.array([
+    (51.2308, 4.38703, 47.699437, 9.268651, 528417.6564789154, 136.10409945400056, 139.81689808676458),
+    (0.0, 0.0, 0.0, 0.0002777777777777778, 30.922080775909325, 90.0, 90.0),
+    (-52.832454368952554, -115.72114067532164, 55.61939813104101, -108.23547732176336, 12041832.603440003, 4.46818176198228, 4.780376868680211),
+    (0.0, 0.0, 0.5, 179.5, 19936288.578965314, 25.67187286829188, 154.3270854699416),
+    (0.7, 0.0, 0.0, -180.0, 19926529.42688064, -0.0, -180.0),
+    (0.0, 0.0, 0.0, 179.7, 19995624.889961265, 29.828768395683454, 150.17123160431655),
+    (0.2, 0.0, -0.2, 179.6, 19989165.416035745, 41.53748253874077, 138.46251746125924),
+    (-30.12345, 0.0, 30.12345, 179.99, 20003922.22814904, 178.90231793249245, 1.0976820675075463),
+    (-90.0, 0.0, 90.0, 0.0, 20003931.458625447, 0.0, 0.0),
+    (89.9, 10.0, -89.9, -170.0, 20003931.458625447, -0.0, -180.0),
+    (35.3524, 135.0302, 35.3532, 135.0305, 92.85194331754519, 17.078073270902756, 17.078246853745952),
+    (40.0, -75.0, -33.9, 151.2, 15899753.808677182, -95.31774256453221, -113.17981647560642)])
+
+def azimuth_difference(a, b):
+    return np.nanmax(np.abs((np.asarray(a, dtype=float)-b+180)%360-180))
+
+def check_geodesics(label, lats1, lons1, lats2, lons2, distances, azimuths1, azimuths2):
+    karney, karney_azimuths1, karney_azimuths2 = geo.geodesic_inverse(lats1, lons1, lats2, lons2)
+    check(f"{label}, Karney distance (m)", max_difference(karney, distances), 2e-8)
+    check(f"{label}, Karney azimuths (deg)", max(azimuth_difference(karney_azimuths1, azimuths1), azimuth_difference(karney_azimuths2, azimuths2)), 1e-10)
+    scalar = [geo.ellipsoid_distance((lats1[i], lons1[i]), (lats2[i], lons2[i])) for i in range(len(lats1))]
+    check(f"{label}, scalar distance (m)", max_difference(scalar, distances), 2e-4)
+
+check_geodesics("Reference geodesics", *reference.T)
+
+try:
+    from geographiclib.geodesic import Geodesic
+    lats1, lons1, _ = random_points(check_count)
+    lats2, lons2, _ = random_points(check_count)
+    # Nearly antipodal pairs, which are the hardest to solve, half of
+    # them close to the equator
+    lats1[:check_count//4] = rng.uniform(-1, 1, check_count//4)
+    lats1[check_count//4:check_count//2] = rng.uniform(-60, 60, check_count//4)
+    lats2[:check_count//2] = -lats1[:check_count//2]+rng.uniform(-0.5, 0.5, check_count//2)
+    lons2[:check_count//2] = lons1[:check_count//2]+180-rng.uniform(0, 2, check_count//2)
+    solved = [Geodesic.WGS84.Inverse(*pair) for pair in zip(lats1, lons1, lats2, lons2)]
+    check_geodesics("GeographicLib", lats1, lons1, lats2, lons2, *np.array([(g["s12"], g["azi1"], g["azi2"]) for g in solved]).T)
+except ImportError:
+    print("The geographiclib package is not installed, skipping random geodesics")
+
+lats, lons, alts = random_points(check_count)
+points = list(zip(lats, lons, alts))
+
+check("Euclidian distances", max_difference(geo.euclidian_distances(origin, lats, lons, alts), [geo.euclidian_distance(origin, p) for p in points]), 1e-6)
+check("Spherical distances", max_difference(geo.spherical_distances(origin, lats, lons), [geo.spherical_distance(origin, p) for p in points]), 1e-6)
+azimuths, altitudes = geo.azalts(origin, lats, lons, alts)
+scalar = [geo.azalt(origin, p) for p in points]
+check("Azimuths", max_difference(azimuths, [s[0] for s in scalar]), 1e-6)
+check("Altitude angles", max_difference(altitudes, [s[1] for s in scalar]), 1e-6)
+horizons = geo.shared_radio_horizons(origin, lats, lons, alts)
+scalar = [geo.shared_radio_horizon(origin, p) for p in points]
+for key in ["horizon2", "shared", "within", "geodesic_distance", "antenna_distance"]:
+    check(f"Shared radio horizon, {key}", max_difference(horizons[key], [s[key] for s in scalar]), 1e-3)
+
+lats, lons, alts = random_points(point_count)
+points = list(zip(lats, lons, alts))
+for label, batch, scalar in [
+    ["Orthodromic distance", lambda: geo.orthodromic_distances(origin, lats, lons), lambda: [geo.orthodromic_distance(origin, p) for p in points]],
+    ["Euclidian distance", lambda: geo.euclidian_distances(origin, lats, lons, alts), lambda: [geo.euclidian_distance(origin, p) for p in points]],
+    ["Azimuth and altitude", lambda: geo.azalts(origin, lats, lons, alts), lambda: [geo.azalt(origin, p) for p in points]],
+    ["Shared radio horizon", lambda: geo.shared_radio_horizons(origin, lats, lons, alts), lambda: [geo.shared_radio_horizon(origin, p) for p in points]]]:
+    _, batch_duration = timed(batch)
+    _, scalar_duration = timed(scalar)
+    print(f"{label+f', {point_count} points':<44} batch {batch_duration*1000:8.1f} ms  scalar {scalar_duration*1000:8.1f} ms")
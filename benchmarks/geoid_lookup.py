@@ -0,0 +1,47 @@
+# Compares batch geoid height lookups with scalar lookups, for accuracy
+# and speed. Scalar lookups are timed with the cell cache disabled, as
+# every lookup was computed before, and enabled, for points that are
+# spread out and for points clustered around a few locations. Needs the
+# EGM2008 geoid model from the app assets, or TELEMETER_GEOID_PATH set
+# to a directory containing egm2008-5.pgm.
+#
+# Usage: python benchmarks/geoid_lookup.py [points]
+
+import numpy as np
+from common import arg, timed
+
+from sideband.geo import GeoidHeight
+
+point_count = arg(1, 10000)
+
+rng = np.random.default_rng(1)
+spread = (rng.uniform(-90, 90, point_count), rng.uniform(-180, 180, point_count))
+centres = rng.uniform(-60, 60, (8, 2))
+clustered = tuple(centres[rng.integers(0, 8, point_count), i]+rng.uniform(-0.05, 0.05, point_count) for i in range(2))
+
+geoid = GeoidHeight()
+in_memory = GeoidHeight(in_memory=True)
+cache_size = GeoidHeight.CELL_CACHE_SIZE
+
+def scalar(lats, lons, cubic, size):
+    GeoidHeight.CELL_CACHE_SIZE = size
+    geoid.cells.clear()
+    try: return np.array([geoid.get(lat, lon, cubic=cubic) for lat, lon in zip(lats, lons)])
+    finally: GeoidHeight.CELL_CACHE_SIZE = cache_size
+
+for cubic in [True, False]:
+    mode = "cubic" if cubic else "bilinear"
+    lats, lons = spread
+    difference = np.max(np.abs(geoid.get_many(lats, lons, cubic=cubic)-scalar(lats, lons, cubic, cache_size)))
+    print(f"Batch against scalar, {mode:<9} max difference {difference:.3e} m")
+    assert difference < 1e-6
+
+    for points, label in [(spread, "spread"), (clustered, "clustered")]:
+        lats, lons = points
+        _, uncached = timed(scalar, lats, lons, cubic, 0)
+        _, cached = timed(scalar, lats, lons, cubic, cache_size)
+        _, batch = timed(geoid.get_many, lats, lons, cubic=cubic)
+        _, memory = timed(in_memory.get_many, lats, lons, cubic=cubic)
+        print(f"{mode:<9} {label:<9} {point_count} points: scalar {uncached*1000:7.1f} ms, "
+              f"with cell cache {cached*1000:7.1f} ms, batch {batch*1000:6.1f} ms, "
+              f"batch in memory {memory*1000:6.1f} ms")
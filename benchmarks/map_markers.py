@@ -0,0 +1,70 @@
+# Measures the cost of repositioning map markers when the map is panned
+# or zoomed, for a plain marker layer with one widget per point, and
+# for the clustered marker layer used for telemetry markers. Requires
+# Kivy, but no window is opened.
+#
+# Usage: python benchmarks/map_markers.py [points] [rounds]
+
+import os
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+
+import random
+from common import arg, report, timed
+
+from mapview import MapView, MapMarker
+from mapview.view import MarkerMapLayer
+from mapview.clustered_marker_layer import ClusteredMarkerLayer
+
+point_count = arg(1, 10000)
+rounds = arg(2, 5)
+zoom_levels = [4, 8, 12]
+
+random.seed(1)
+points = [(random.uniform(35, 60), random.uniform(-10, 30)) for _ in range(point_count)]
+
+def view_at(zoom):
+    return MapView(zoom=zoom, lat=47.5, lon=10.0, size=(1080, 1920))
+
+def plain_layer(mapview):
+    layer = MarkerMapLayer()
+    mapview.add_layer(layer, mode="scatter")
+    for lat, lon in points:
+        # Markers are added to the marker list directly, since inserting
+        # every widget in latitude order takes quadratic time
+        marker = MapMarker(lat=lat, lon=lon)
+        marker._layer = layer
+        layer.markers.append(marker)
+    return layer
+
+def clustered_layer(mapview):
+    layer = ClusteredMarkerLayer()
+    mapview.add_layer(layer, mode="scatter")
+    for lat, lon in points:
+        layer.add_marker(lon=lon, lat=lat)
+    return layer
+
+builds = []
+for zoom in zoom_levels:
+    mapview = view_at(zoom)
+    layer = plain_layer(mapview)
+    samples = []
+    for _ in range(rounds):
+        _, duration = timed(layer.reposition)
+        samples.append(duration)
+    report(f"Plain layer, zoom {zoom}, {len(layer.children)} widgets", samples)
+
+    mapview = view_at(zoom)
+    layer = clustered_layer(mapview)
+    layer.cluster, duration = timed(layer.build_cluster)
+    builds.append(duration)
+    if layer._rebuild_event is not None:
+        layer._rebuild_event.cancel()
+        layer._rebuild_event = None
+    samples = []
+    for _ in range(rounds):
+        _, duration = timed(layer.reposition)
+        samples.append(duration)
+    report(f"Clustered layer, zoom {zoom}, {len(layer.children)} widgets", samples)
+
+report(f"Cluster index build, {point_count} points", builds)
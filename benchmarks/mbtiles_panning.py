@@ -0,0 +1,112 @@
+# Pans a viewport back and forth over a generated .mbtiles file, and
+# measures the time taken to load the tiles of each step. Tiles are
+# loaded once by opening a connection and decoding the image for every
+# tile, as the MBTiles source used to, and once through the pooled
+# readers and texture cache of MBTilesMapSource. Requires Kivy and a
+# window for creating textures, which can be an offscreen one:
+#
+#   SDL_VIDEODRIVER=offscreen python benchmarks/mbtiles_panning.py
+#
+# Usage: python benchmarks/mbtiles_panning.py [pan steps]
+
+import os
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+
+import io
+import zlib
+import types
+import struct
+import shutil
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from common import arg, report, timed
+
+# Textures can only be created once a window has set up a GL context
+from kivy.core.window import Window
+from kivy.core.image import Image as CoreImage
+from mapview.mbtsource import MBTilesMapSource
+
+pan_steps = arg(1, 40)
+zoom = 8
+view_columns = 5
+view_rows = 8
+workers = 5
+
+def png_tile(x, y):
+    # A solid 256x256 tile, with a colour unique to its position
+    rgb = bytes([x*7%256, y*11%256, (x+y)*13%256])
+    raw = b"".join(b"\x00"+rgb*256 for _ in range(256))
+    def chunk(kind, data):
+        return struct.pack(">I", len(data))+kind+data+struct.pack(">I", zlib.crc32(kind+data) & 0xffffffff)
+    header = struct.pack(">IIBBBBB", 256, 256, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n"+chunk(b"IHDR", header)+chunk(b"IDAT", zlib.compress(raw))+chunk(b"IEND", b"")
+
+def create_mbtiles(path, columns, rows):
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+    db.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+    db.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+    metadata = {"name": "benchmark", "format": "png", "minzoom": str(zoom), "maxzoom": str(zoom), "bounds": "-180,-85,180,85"}
+    db.executemany("INSERT INTO metadata (name, value) VALUES (?, ?)", metadata.items())
+    db.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", ((zoom, x, y, png_tile(x, y)) for x in range(columns) for y in range(rows)))
+    db.commit()
+    db.close()
+
+def pan_path():
+    # The viewport moves right one column per step, and then back
+    offsets = list(range(pan_steps//2+1))
+    offsets += offsets[-2::-1]
+    return [[(x+ox, y) for x in range(view_columns) for y in range(view_rows)] for ox in offsets]
+
+def load_unpooled(filename, tiles):
+    # Opens a connection and decodes a new texture for every tile
+    textures = []
+    for x, y in tiles:
+        db = sqlite3.connect(filename)
+        row = db.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", (zoom, x, y)).fetchone()
+        textures.append(CoreImage(io.BytesIO(row[0]), ext="png", filename=f"{zoom}.{x}.{y}.png").texture)
+        db.close()
+    return textures
+
+def load_pooled(source, executor, tiles):
+    # Tiles in the texture cache are filled immediately, and the rest are
+    # read and decoded by the workers, with textures created afterwards
+    pending = []
+    for x, y in tiles:
+        tile = types.SimpleNamespace(zoom=zoom, tile_x=x, tile_y=y, state="loading", texture=None)
+        texture = MBTilesMapSource.texture_cache.get(source._texture_key(tile))
+        if texture is not None:
+            tile.texture = texture
+        else:
+            pending.append(executor.submit(source._load_tile, tile))
+    for future in pending:
+        result = future.result()
+        if result is not None:
+            callback, args = result
+            callback(*args)
+
+temp_dir = tempfile.mkdtemp(prefix="sideband_bench_")
+try:
+    filename = os.path.join(temp_dir, "benchmark.mbtiles")
+    create_mbtiles(filename, view_columns+pan_steps//2+1, view_rows)
+    path = pan_path()
+
+    samples = []
+    for tiles in path:
+        _, duration = timed(load_unpooled, filename, tiles)
+        samples.append(duration)
+    report(f"Unpooled, {len(path[0])} tiles per step", samples)
+
+    source = MBTilesMapSource(filename)
+    MBTilesMapSource.texture_cache.clear()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        samples = []
+        for tiles in path:
+            _, duration = timed(load_pooled, source, executor, tiles)
+            samples.append(duration)
+    report(f"Pooled and cached, {len(path[0])} tiles per step", samples)
+
+finally:
+    shutil.rmtree(temp_dir, ignore_errors=True)
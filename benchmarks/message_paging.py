@@ -0,0 +1,56 @@
+# Seeds a database with synthetic messages spread over a number of
+# conversations, and measures the latency of loading the first page
+# of a conversation and of scrolling back through earlier pages.
+#
+# Usage: python benchmarks/message_paging.py [messages] [conversations]
+
+import time
+import random
+from common import arg, headless_core, report, timed, rate
+
+import RNS
+import LXMF
+
+message_count = arg(1, 50000)
+conversation_count = arg(2, 100)
+scroll_pages = 20
+
+def seed(core, count, peers):
+    own = RNS.Destination(RNS.Identity(), RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
+    core.lxmf_destination.hash = own.hash
+    query = "INSERT INTO lxm (lxm_hash, dest, source, title, tx_ts, rx_ts, state, method, t_encrypted, t_encryption, data, extra) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    now = time.time()
+    rows = []
+    for i in range(count):
+        peer = random.choice(peers)
+        if i%2 == 0: source, dest = peer, own
+        else: source, dest = own, peer
+        lxm = LXMF.LXMessage(dest, source, f"Message {i} "+"lorem ipsum "*random.randint(1, 20), "", desired_method=LXMF.LXMessage.DIRECT)
+        lxm.pack()
+        ts = now - (count-i)*30
+        rows.append((lxm.hash, lxm.destination_hash, lxm.source_hash, lxm.title, ts, ts, LXMF.LXMessage.DELIVERED, LXMF.LXMessage.DIRECT, True, "Curve25519", lxm.packed, None))
+        if len(rows) >= 4096:
+            core.db.executemany(query, rows); rows = []
+    core.db.executemany(query, rows)
+    core.db.commit()
+
+with headless_core() as core:
+    peers = [RNS.Destination(RNS.Identity(), RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery") for _ in range(conversation_count)]
+    _, duration = timed(seed, core, message_count, peers)
+    rate("Seeding messages", message_count, duration, "messages")
+
+    query = core._SidebandCore__db_context_messages_query("", core.MESSAGES_PAGE_SIZE)
+    plan = core.db.execute("EXPLAIN QUERY PLAN "+query, {"context_dest": peers[0].hash, "limit_val": core.MESSAGES_PAGE_SIZE}).fetchall()
+    print("Query plan:", "; ".join(str(row[-1]) for row in plan))
+
+    first_pages = []; scroll = []
+    for peer in peers:
+        (messages, cursor), duration = timed(core.list_messages_page, peer.hash)
+        first_pages.append(duration)
+        pages = 0
+        while cursor != None and pages < scroll_pages:
+            (messages, cursor), duration = timed(core.list_messages_page, peer.hash, cursor=cursor)
+            scroll.append(duration); pages += 1
+
+    report("First page", first_pages)
+    report("Scroll page", scroll)
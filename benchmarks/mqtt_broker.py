@@ -0,0 +1,108 @@
+# Sends telemetry from a number of sources through the MQTT publisher
+# to a local broker stand-in, and reports the cost of handing telemetry
+# to the publisher, publish throughput and acknowledgement latency, and
+# how many connections were made to the broker. The stand-in implements
+# just enough of MQTT 3.1.1 for QoS 1 publishing.
+#
+# Usage: python benchmarks/mqtt_broker.py [sources] [rounds]
+
+import time
+import socket
+import struct
+import threading
+from common import arg, packed_location, report, timed
+
+from sideband.mqtt import MQTT
+
+source_count = arg(1, 200)
+rounds = arg(2, 5)
+
+class BrokerStandIn:
+    CONNACK = b"\x20\x02\x00\x00"
+    PINGRESP = b"\xd0\x00"
+
+    def __init__(self):
+        self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(64)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.published = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            connection, _ = self.socket.accept()
+            with self.lock: self.connections += 1
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def read(self, connection, length):
+        data = b""
+        while len(data) < length:
+            chunk = connection.recv(length-len(data))
+            if not chunk: raise EOFError
+            data += chunk
+        return data
+
+    def read_length(self, connection):
+        multiplier = 1; length = 0
+        while True:
+            byte = self.read(connection, 1)[0]
+            length += (byte & 0x7f)*multiplier; multiplier *= 128
+            if not byte & 0x80: return length
+
+    def serve(self, connection):
+        try:
+            while True:
+                header = self.read(connection, 1)[0]
+                length = self.read_length(connection)
+                body = self.read(connection, length) if length > 0 else b""
+                packet_type = header >> 4
+                if packet_type == 1:
+                    connection.sendall(BrokerStandIn.CONNACK)
+                elif packet_type == 3:
+                    topic_length = struct.unpack("!H", body[:2])[0]
+                    if (header >> 1) & 0x03:
+                        packet_id = body[2+topic_length:4+topic_length]
+                        connection.sendall(b"\x40\x02"+packet_id)
+                    with self.lock: self.published += 1
+                elif packet_type == 12:
+                    connection.sendall(BrokerStandIn.PINGRESP)
+                elif packet_type == 14:
+                    break
+        except EOFError:
+            pass
+        connection.close()
+
+broker = BrokerStandIn()
+mqtt = MQTT()
+mqtt.configure("127.0.0.1", broker.port, None, None, False)
+
+sources = [bytes([i%256, i//256])*8 for i in range(source_count)]
+now = time.time()
+telemetry = [[packed_location(50+i*0.01, 10+r*0.001, now+r) for i in range(source_count)] for r in range(rounds)]
+
+handled = []
+started = time.time()
+for r in range(rounds):
+    for source, packed in zip(sources, telemetry[r]):
+        _, duration = timed(mqtt.handle, source, packed)
+        handled.append(duration)
+
+while True:
+    stats = mqtt.get_stats()
+    if stats["queued"] == 0 and stats["inflight"] == 0 and stats["acknowledged"] == stats["published"]: break
+    time.sleep(0.01)
+duration = time.time()-started
+
+report("Handing telemetry to the publisher", handled, unit="us")
+print(f"Telemetry handled: {stats['enqueued']}, coalesced: {stats['coalesced']}, dropped: {stats['dropped']}")
+print(f"Topics published: {stats['published']} in {duration:.3f} s, {stats['published']/duration:.0f} topics/s, {stats['unchanged']} unchanged topics skipped")
+if stats["latency_avg"] != None:
+    print(f"Acknowledgement latency: mean {stats['latency_avg']*1000:.1f} ms, max {stats['latency_max']*1000:.1f} ms")
+else:
+    print("Acknowledgement latency: no publishes were acknowledged")
+print(f"Broker connections: {broker.connections}, publishes received: {broker.published}")
+mqtt.stop()
@@ -0,0 +1,90 @@
+# Replays a recorded telemetry stream through MQTT topic rendering and
+# publishing, and compares the number of topics published and the CPU
+# time used when every topic is rendered and published for each update,
+# with rendering only sensors whose data changed, and with publishing
+# only the topics that changed. The stream is recorded up front from a
+# mix of stationary and moving sources reporting at a fixed interval.
+# Topics are published through the MQTT client without a connection to
+# a server, so the CPU time includes building the publish packets, but
+# not writing them to a socket.
+#
+# Usage: python benchmarks/mqtt_topics.py [sources] [updates per source]
+
+import time
+import random
+from common import arg, packed_location
+
+import RNS
+from sideband.mqtt import MQTT
+from sideband.sense import Telemeter
+
+source_count = arg(1, 50)
+update_count = arg(2, 60)
+interval = 10
+
+def record():
+    random.seed(1)
+    stream = []
+    started = time.time()-update_count*interval
+    positions = [[random.uniform(45, 55), random.uniform(5, 15)] for _ in range(source_count)]
+    for update in range(update_count):
+        for i in range(source_count):
+            # A third of the sources are moving, and the rest stationary
+            if i%3 == 0:
+                positions[i][0] += random.uniform(-0.001, 0.001)
+                positions[i][1] += random.uniform(-0.001, 0.001)
+            source = bytes([i%256, i//256])*8
+            stream.append((source, packed_location(positions[i][0], positions[i][1], started+update*interval)))
+    return stream
+
+def render_uncached(context_dest, telemetry):
+    # Renders every sensor of the telemetry, as the MQTT handler did
+    # before rendered topics were cached per sensor
+    remote_telemeter = Telemeter.from_packed(telemetry)
+    root_path = f"lxmf/telemetry/{RNS.hexrep(context_dest, delimit=False)}"
+    rendered = {}
+    for sensor in remote_telemeter.sensors:
+        topics = remote_telemeter.sensors[sensor].render_mqtt()
+        if topics != None:
+            for topic in topics:
+                rendered[f"{root_path}/{topic}"] = topics[topic]
+    return rendered
+
+def replay_uncached(mqtt, stream):
+    published = 0
+    for source, telemetry in stream:
+        for topic_path, data in render_uncached(source, telemetry).items():
+            mqtt.post_message(topic_path, data, time.time())
+            published += 1
+    return published
+
+def replay_all(mqtt, stream):
+    published = 0
+    for source, telemetry in stream:
+        for topic_path, data in mqtt.render_topics(source, telemetry).items():
+            mqtt.post_message(topic_path, data, time.time())
+            published += 1
+    return published
+
+def replay_changed(mqtt, stream):
+    published = 0
+    for source, telemetry in stream:
+        cached, changed = mqtt.render(source, telemetry)
+        for topic_path, data in changed:
+            mqtt.post_message(topic_path, data, time.time())
+            cached["topics"][topic_path] = data
+        cached["telemetry"] = telemetry
+        published += len(changed)
+    return published
+
+stream = record()
+render_uncached(*stream[0])
+for label, replay in [["All topics, uncached", replay_uncached],
+                      ["All topics", replay_all],
+                      ["Changed topics only", replay_changed]]:
+    mqtt = MQTT()
+    started = time.process_time()
+    published = replay(mqtt, stream)
+    cpu_time = time.process_time()-started
+    print(f"{label:<24} {published:8} topics published  {cpu_time:7.3f} s CPU  ({len(stream)} updates)")
+    mqtt.stop()
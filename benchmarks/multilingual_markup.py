@@ -0,0 +1,59 @@
+# Runs multilingual markup over a corpus of mixed-script messages, and
+# reports the time per message without and with the markup cache, and
+# how the time scales with message length. Requires Kivy.
+#
+# Usage: python benchmarks/multilingual_markup.py [messages]
+
+import os
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+
+import random
+from common import arg, report, timed
+
+from ui.helpers import multilingual_markup
+
+message_count = arg(1, 2000)
+
+words = ["hello", "world", "meeting", "at", "the", "relay", "12:30", "ok!",
+         "שלום", "עולם", "مرحبا", "بالعالم", "привет", "мир", "你好", "世界",
+         "こんにちは", "世界", "안녕하세요", "세계", "สวัสดี", "ชาวโลก", "नमस्ते", "दुनिया",
+         "🌍", "📡", "👍", "🔋", "\U000f0001", "", "☃"]
+
+def message(rng, length):
+    text = []
+    while sum(len(w) for w in text) < length:
+        r = rng.random()
+        if r < 0.05: text.append("[font=nf]"+rng.choice(words)+"[/font]")
+        elif r < 0.08: text.append("[font=term]"+rng.choice(words)+" "+rng.choice(words)+"[/font]")
+        else: text.append(rng.choice(words))
+    return " ".join(text).encode("utf-8")
+
+rng = random.Random(1)
+corpus = [message(rng, rng.choice([20, 80, 300, 1200])) for _ in range(message_count)]
+uncached = multilingual_markup.__wrapped__
+
+samples = []
+for data in corpus:
+    _, duration = timed(uncached, data)
+    samples.append(duration)
+report(f"Uncached, {message_count} messages", samples, unit="us")
+
+# Reopening a conversation renders the same messages again, which are
+# then served from the cache
+conversation = corpus[:256]
+multilingual_markup.cache_clear()
+for data in conversation:
+    multilingual_markup(data)
+samples = []
+for data in conversation:
+    _, duration = timed(multilingual_markup, data)
+    samples.append(duration)
+report(f"Cached, {len(conversation)} messages reopened", samples, unit="us")
+info = multilingual_markup.cache_info()
+print(f"Cache hits {info.hits}, misses {info.misses}, size {info.currsize} of {info.maxsize}")
+
+for length in [1000, 10000, 100000]:
+    data = message(rng, length)
+    _, duration = timed(uncached, data)
+    print(f"Message of {len(data.decode('utf-8')):>6} characters: {duration*1000:8.2f} ms, {duration/len(data.decode('utf-8'))*1e6:.2f} us per character")
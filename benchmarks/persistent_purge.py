@@ -0,0 +1,36 @@
+# Stores a large number of expired temporary peer appearances, and
+# measures purging them, along with the latency of persistent value
+# writes made from another thread while the purge runs.
+#
+# Usage: python benchmarks/persistent_purge.py [expired values]
+
+import time
+import threading
+from common import arg, headless_core, report, timed
+
+expired_count = arg(1, 100000)
+
+with headless_core() as core:
+    for offset in range(0, expired_count, 10000):
+        core.setpersistent_many({f"temp.peer_appearance.{i:032x}": ["account", b"\x00\x00\x00", b"\xff\xff\xff"] for i in range(offset, min(offset+10000, expired_count))}, ttl=-1)
+    core.setpersistent("telemetry.timebase", time.time())
+    print("Before purge:", core.get_persistent_stats())
+
+    stop = threading.Event(); latencies = []
+    def writer():
+        while not stop.is_set():
+            _, duration = timed(core.setpersistent, "telemetry.timebase", time.time())
+            latencies.append(duration)
+            time.sleep(0.001)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    _, duration = timed(core._db_purge_persistent)
+    stop.set(); thread.join()
+
+    print(f"Purged {expired_count} values in {duration*1000:.1f} ms")
+    report("Concurrent writes during purge", latencies)
+    stats = core.get_persistent_stats()
+    print("After purge:", stats)
+    assert stats["last_purged"] == expired_count
+    assert core.getpersistent("telemetry.timebase") != None
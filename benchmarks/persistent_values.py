@@ -0,0 +1,49 @@
+# Measures reading and writing persistent values, one at a time and in
+# bulk, with the in-memory persistent value cache enabled and disabled.
+#
+# Usage: python benchmarks/persistent_values.py [operations] [keys]
+
+import time
+from common import arg, headless_core, rate, timed
+
+operation_count = arg(1, 20000)
+key_count = arg(2, 200)
+
+keys = [f"telemetry.{i:032x}.timebase" for i in range(key_count)]
+missing = [f"temp.peer_appearance.{i:032x}" for i in range(key_count)]
+
+def set_values(core):
+    for i in range(operation_count):
+        core.setpersistent(keys[i%key_count], time.time())
+
+def get_values(core, props):
+    for i in range(operation_count):
+        core.getpersistent(props[i%key_count])
+
+def set_bulk(core):
+    for i in range(operation_count//key_count):
+        core.setpersistent_many({key: i for key in keys})
+
+def get_bulk(core):
+    for i in range(operation_count//key_count):
+        core.getpersistent_many(keys)
+
+with headless_core() as core:
+    for enabled in [False, True]:
+        core.persistent_cache_enabled = enabled
+        core.persistent_cache.clear()
+        label = "cached" if enabled else "uncached"
+
+        _, duration = timed(set_values, core)
+        rate(f"Set, {label}", operation_count, duration, "ops")
+        _, duration = timed(get_values, core, keys)
+        rate(f"Get, {label}", operation_count, duration, "ops")
+        _, duration = timed(get_values, core, missing)
+        rate(f"Get missing, {label}", operation_count, duration, "ops")
+        _, duration = timed(set_bulk, core)
+        rate(f"Bulk set, {label}", operation_count, duration, "values")
+        _, duration = timed(get_bulk, core)
+        rate(f"Bulk get, {label}", operation_count, duration, "values")
+
+        values = core.getpersistent_many(keys+missing[:1])
+        assert all(values[key] == operation_count//key_count-1 for key in keys) and values[missing[0]] == None
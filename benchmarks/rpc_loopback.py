@@ -0,0 +1,64 @@
+# Measures service RPC throughput over a loopback connection, between a
+# service core and a UI client core in the same process, as they are
+# used on Android. Reports sequential and concurrent calls per second,
+# batched state retrieval, and the per-method latency counters.
+#
+# Usage: python benchmarks/rpc_loopback.py [calls] [threads]
+
+import os
+import time
+import threading
+from common import arg, headless_core, rate, timed
+
+import RNS
+
+call_count = arg(1, 5000)
+thread_count = arg(2, 8)
+batch_size = 20
+
+with headless_core(is_service=True) as service, headless_core(is_client=True) as client:
+    # The client only routes state over RPC when running on Android
+    RNS.vendor.platformutils.is_android = lambda: True
+    service.rpc_addr = client.rpc_addr = f"\0sideband/benchmark/{os.getpid()}"
+    client.rpc_key = service.rpc_key
+    service._SidebandCore__init_rpc_handlers()
+    service._SidebandCore__start_rpc_listener()
+
+    props = [f"bench.value.{i}" for i in range(batch_size)]
+    for i, prop in enumerate(props):
+        service.setstate(prop, i)
+    assert client.getstate(props[1]) == 1
+
+    def sequential():
+        for i in range(call_count):
+            client.getstate(props[i%batch_size])
+    _, duration = timed(sequential)
+    rate("Sequential getstate", call_count, duration, "calls")
+
+    def concurrent():
+        def job():
+            for i in range(call_count//thread_count):
+                client.getstate(props[i%batch_size])
+        threads = [threading.Thread(target=job) for _ in range(thread_count)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    _, duration = timed(concurrent)
+    rate(f"Concurrent getstate, {thread_count} threads", call_count//thread_count*thread_count, duration, "calls")
+
+    rounds = max(1, call_count//batch_size)
+    def separate():
+        for _ in range(rounds):
+            for prop in props: client.getstate(prop)
+    def batched():
+        for _ in range(rounds):
+            client.getstate_many(props)
+    _, duration = timed(separate)
+    rate(f"{batch_size} keys with separate calls", rounds, duration, "rounds")
+    _, duration = timed(batched)
+    rate(f"{batch_size} keys with one batch call", rounds, duration, "rounds")
+
+    print("Client round trip latencies:")
+    for method, stats in client.get_rpc_stats()["local"].items():
+        print(f"  {method:<20} calls={stats['calls']:<7} mean={stats['total']/stats['calls']*1000:.3f} ms  max={stats['max']*1000:.3f} ms")
+
+    service.rpc_listener.close()
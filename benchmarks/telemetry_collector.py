@@ -0,0 +1,59 @@
+# Fills the telemetry database with a week of location updates from a
+# number of sources, and measures building collector responses for
+# requests with different timebases, both from the database and from
+# the cached response entries, with and without only the latest entry
+# per source being sent.
+#
+# Usage: python benchmarks/telemetry_collector.py [sources] [days] [update interval]
+
+import os
+import time
+import random
+from common import arg, headless_core, packed_location, timed
+
+import RNS
+
+source_count = arg(1, 500)
+days = arg(2, 7)
+interval = arg(3, 300)
+
+def seed(core, sources):
+    now = int(time.time())
+    pool = [packed_location(random.uniform(-60, 60), random.uniform(-180, 180), now) for _ in range(100)]
+    rows = [(source, ts, pool[ts%len(pool)]) for source in sources for ts in range(now-days*86400, now, interval)]
+    with core.db_lock:
+        db = core._SidebandCore__db_connect()
+        db.executemany("insert into telemetry (dest_context, ts, data) values (?, ?, ?)", rows)
+        db.commit()
+
+    for source in sources[::5]:
+        core.setpersistent(f"temp.peer_appearance.{RNS.hexrep(source, delimit=False)}", [["account", b"\x01\x02\x03", b"\x04\x05\x06"]])
+
+    return len(rows)
+
+with headless_core() as core:
+    sources = [os.urandom(16) for _ in range(source_count)]
+    row_count, duration = timed(seed, core, sources)
+    print(f"Stored {row_count} telemetry entries from {source_count} sources in {duration:.1f} s")
+
+    responses = {}
+    def capture(to_addr, stream, **kwargs):
+        responses[to_addr] = stream
+        return "sent"
+    core.send_latest_telemetry = capture
+
+    now = time.time()
+    for only_latest in [True, False]:
+        core.config["telemetry_requests_only_send_latest"] = only_latest
+        for label, timebase in [["1 week", now-days*86400], ["1 hour", now-3600], ["10 minutes", now-600]]:
+            if not only_latest and timebase < now-3600:
+                # Sending the full history of every source is not a
+                # realistic request, and only measures the database scan
+                continue
+
+            core.telemetry_response_cache.clear()
+            _, cold = timed(core.create_telemetry_collector_response, to_addr=sources[0], timebase=timebase)
+            _, cached = timed(core.create_telemetry_collector_response, to_addr=sources[1], timebase=timebase+7)
+            assert len(responses[sources[0]]) > 0
+            mode = "latest only" if only_latest else "all entries"
+            print(f"Timebase {label:<12} {mode:<12} {len(responses[sources[0]]):>7} entries  cold {cold*1000:8.1f} ms  cached {cached*1000:7.2f} ms")
@@ -0,0 +1,44 @@
+# Decodes a set of stored telemetry blobs through the different
+# decoding paths of the Telemeter: a full decode of all sensors, a
+# lazy decode reading only the location, and the peek functions.
+#
+# Usage: python benchmarks/telemetry_decode.py [blobs]
+
+import time
+import random
+from common import arg, packed_location, rate, timed
+
+from sideband.sense import Telemeter
+
+blob_count = arg(1, 100000)
+
+def blobs(count):
+    # Packs a pool of distinct telemetry and repeats it, since packing
+    # is much slower than the decoding being measured
+    now = time.time()
+    pool = [packed_location(random.uniform(-60, 60), random.uniform(-180, 180), now-i*60) for i in range(min(count, 5000))]
+    return [pool[i%len(pool)] for i in range(count)]
+
+def decode_all(stored):
+    for packed in stored:
+        Telemeter.from_packed(packed).read_all()
+
+def decode_location(stored):
+    for packed in stored:
+        Telemeter.from_packed(packed).read("location")
+
+def peek_location(stored):
+    for packed in stored:
+        Telemeter.peek_location(packed)
+
+def peek_time(stored):
+    for packed in stored:
+        Telemeter.peek_time(packed)
+
+stored = blobs(blob_count)
+for label, fn in [["Full decode, all sensors", decode_all],
+                  ["Lazy decode, location only", decode_location],
+                  ["Peek location", peek_location],
+                  ["Peek time", peek_time]]:
+    _, duration = timed(fn, stored)
+    rate(label, blob_count, duration, "blobs")
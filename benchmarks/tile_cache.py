@@ -0,0 +1,110 @@
+# Exercises the online map tile cache against a local stand-in tile
+# server. Tiles are fetched through the Downloader into a cache with a
+# small byte budget, read back, and prefetched for a bounding box, and
+# the number of requests reaching the server is checked at each step.
+# Requires Kivy and requests, but no window is opened.
+#
+# Usage: python benchmarks/tile_cache.py [tiles] [budget in KB]
+
+import os
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from common import arg, rate, report, timed
+
+from mapview.source import MapSource
+from mapview.downloader import Downloader
+from mapview.tilecache import TileCache
+
+tile_count = arg(1, 1000)
+budget = arg(2, 1024)*1024
+tile_bytes = 4096
+
+class TileServer(BaseHTTPRequestHandler):
+    requests = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with TileServer.lock:
+            TileServer.requests += 1
+        # Tile content is not decoded here, so any payload will do
+        data = self.path.encode("utf-8").ljust(tile_bytes, b"\x00")
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def served():
+    with TileServer.lock:
+        return TileServer.requests
+
+cache_dir = tempfile.mkdtemp(prefix="sideband_bench_")
+server = ThreadingHTTPServer(("127.0.0.1", 0), TileServer)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+try:
+    # Tile files from earlier versions are removed when the cache is
+    # created, while any other files in the directory are kept
+    open(os.path.join(cache_dir, "osm_12_2100_1400.png"), "wb").close()
+    open(os.path.join(cache_dir, "notes.txt"), "wb").close()
+
+    TileCache.configure(cache_dir, budget)
+    downloader = Downloader(cache_dir=cache_dir)
+    cache = downloader.cache
+    assert not os.path.exists(os.path.join(cache_dir, "osm_12_2100_1400.png"))
+    assert os.path.exists(os.path.join(cache_dir, "notes.txt"))
+
+    source = MapSource(url=f"http://127.0.0.1:{server.server_address[1]}/{{z}}/{{x}}/{{y}}.png", cache_key="bench", subdomains=[""])
+    tiles = [(12, 2048+i%64, 1024+i//64) for i in range(tile_count)]
+
+    def fetch_all():
+        for zoom, tile_x, tile_y in tiles:
+            downloader._fetch_tile(source, zoom, tile_x, tile_y)
+
+    _, duration = timed(fetch_all)
+    rate("Fetched from stand-in server", tile_count, duration, "tiles")
+    assert served() == tile_count
+    assert cache.size() <= budget, cache.size()
+
+    # Only the most recently fetched tiles fit within the budget
+    hits = [cache.get(source.cache_key, *tile) is not None for tile in tiles]
+    print(f"Cached after fetching: {sum(hits)} of {tile_count} tiles, {cache.size()//1024} KB of {budget//1024} KB")
+    assert hits[-1] and not hits[0]
+
+    samples = []
+    for zoom, tile_x, tile_y in tiles[-sum(hits):]:
+        _, duration = timed(cache.get, source.cache_key, zoom, tile_x, tile_y)
+        samples.append(duration)
+    report("Cache hit", samples)
+    _, duration = timed(cache.size)
+    print(f"Cache size reported in {duration*1000:.3f} ms")
+
+    # A prefetch only requests tiles that are not cached yet, so
+    # repeating it does not reach the server again
+    cache.set_max_bytes(64*1024*1024)
+    bbox = (60.0, 10.0, 60.5, 11.0)
+    before = served()
+    count = downloader.prefetch(source, bbox, 8, 12)
+    downloader.prefetch_executor.submit(lambda: None).result()
+    print(f"Prefetched {served()-before} of {count} tiles in range")
+    assert served()-before == count
+    before = served()
+    downloader.prefetch(source, bbox, 8, 12)
+    downloader.prefetch_executor.submit(lambda: None).result()
+    assert served() == before
+
+    # Lowering the budget evicts tiles right away
+    cache.set_max_bytes(budget//2)
+    assert cache.size() <= budget//2
+    print("All checks passed")
+
+finally:
+    server.shutdown()
+    shutil.rmtree(cache_dir, ignore_errors=True)
@@ -24,6 +24,7 @@ import os
 import re
 import pathlib
 import base64
+import heapq
 import threading
 import RNS.vendor.umsgpack as msgpack
 
@@ -310,7 +311,7 @@ if args.daemon:
     ScreenManager = DaemonElement; FadeTransition = DaemonElement; NoTransition = DaemonElement; OneLineIconListItem = DaemonElement;
     StringProperty = DaemonElement; BaseButton = DaemonElement; MDIconButton = DaemonElement; MDFileManager = DaemonElement;
     toast = DaemonElement; dp = DaemonElement; sp = DaemonElement; MDRectangleFlatButton = DaemonElement; MDDialog = DaemonElement;
-    colors = DaemonElement; Telemeter = DaemonElement; CustomMapMarker = DaemonElement; MBTilesMapSource = DaemonElement;
+    colors = DaemonElement; Telemeter = DaemonElement; CustomMapMarker = DaemonElement; ClusteredMarkerLayer = DaemonElement; MBTilesMapSource = DaemonElement; Downloader = DaemonElement;
     MapSource = DaemonElement; webbrowser = DaemonElement; Conversations = DaemonElement; MsgSync = DaemonElement; IconLeftWidget = DaemonElement;
     NewConv = DaemonElement; Telemetry = DaemonElement; ObjectDetails = DaemonElement; Announces = DaemonElement;
     Messages = DaemonElement; ts_format = DaemonElement; messages_screen_kv = DaemonElement; plyer = DaemonElement; multilingual_markup = DaemonElement;
@@ -427,7 +428,9 @@ else:
     from kivymd.color_definitions import colors
     from sideband.sense import Telemeter
     from mapview import CustomMapMarker
+    from mapview.clustered_marker_layer import ClusteredMarkerLayer
     from mapview.mbtsource import MBTilesMapSource
+    from mapview.downloader import Downloader
     from mapview.source import MapSource
     from kivy.utils import escape_markup
     import webbrowser
@@ -518,6 +521,19 @@ class SidebandApp(MDApp):
 
     SERVICE_TIMEOUT = 30
 
+    # State flags read on every jobs tick. On Android, the UI subscribes
+    # to changes of these, so the service pushes new values as they are
+    # set, and the jobs tick runs as soon as one of them is raised.
+    JOBS_STATE_KEYS = [
+        "app.flags.unread_conversations", "app.flags.lxmf_sync_dialog_open",
+        "app.flags.new_announces", "app.flags.last_telemetry", "app.flags.new_conversations",
+        "app.flags.new_ticket", "wants.viewupdate.conversations", "lxm_uri_ingest.result",
+        "hardware_operation.error",
+    ]
+
+    MAP_PREFETCH_LEVELS = 4
+    MAP_PREFETCH_MAX_TILES = 5000
+
     EINK_BG_STR = "1,0,0,1"
     EINK_BG_ARR = [1,0,0,1]
 
@@ -556,6 +572,7 @@ class SidebandApp(MDApp):
         self.messages_view = None
         self.map = None
         self.map_layer = None
+        self.map_marker_layer = None
         self.map_screen = None
         self.telemetry_screen = None
         self.connectivity_screen = None
@@ -600,6 +617,11 @@ class SidebandApp(MDApp):
         self.connectivity_updater = None
         self.last_map_update = 0
         self.last_telemetry_received = 0
+        self.map_location_cursor = None
+        self.map_trusted_only = None
+        self.map_marker_times = {}
+        self.map_eviction_queue = []
+        self.map_eviction_event = None
         self.repository_url = None
         self.rnode_flasher_url = None
 
@@ -707,7 +729,7 @@ class SidebandApp(MDApp):
             RNS.log("Waiting for service restart...", RNS.LOG_DEBUG)
             restart_timeout = time.time() + 45
             while not self.sideband.service_rpc_request({"getstate": "service.heartbeat"}):
-                self.sideband.rpc_connection = None
+                self.sideband.reset_rpc_connection()
                 time.sleep(1)
                 if time.time() > restart_timeout:
                     service_restarting = False
@@ -791,6 +813,13 @@ class SidebandApp(MDApp):
         self.final_load_completed = True
         self.keyboard_enabled = True
 
+        if RNS.vendor.platformutils.is_android():
+            jobs_trigger = Clock.create_trigger(self.jobs)
+            def state_changed(prop, value):
+                if value: jobs_trigger()
+
+            self.sideband.subscribe_state(SidebandApp.JOBS_STATE_KEYS, state_changed)
+
         def check_errors(dt):
             if self.sideband.getpersistent("startup.errors.rnode") != None:
                 if self.hw_error_dialog == None or (self.hw_error_dialog != None and not self.hw_error_dialog.is_open):
@@ -1482,6 +1511,9 @@ class SidebandApp(MDApp):
 
     def jobs(self, delta_time):
         if self.final_load_completed:
+            if RNS.vendor.platformutils.is_android():
+                self.sideband.getstate_many(SidebandApp.JOBS_STATE_KEYS)
+
             if RNS.vendor.platformutils.is_android() and not self.sideband.service_available():
                 if time.time() - self.service_last_available > SidebandApp.SERVICE_TIMEOUT:
                     if self.app_state == SidebandApp.ACTIVE:
@@ -1983,14 +2015,19 @@ class SidebandApp(MDApp):
 
         return converted
 
+    def markup_render_settings(self):
+        # Font sizes used when processing BBCode markup. These are
+        # part of the key for cached message renders.
+        return int(sp(14)), int(sp(20)), int(sp(18)), int(sp(16))
+
     def process_bb_markup(self, text):
         st = time.time()
-        ms = int(sp(14))
-        h1s = int(sp(20))
-        h2s = int(sp(18))
-        h3s = int(sp(16))
+        settings = self.markup_render_settings()
+        ms, h1s, h2s, h3s = settings
         
-        if not hasattr(self, "pres"):
+        # The size patterns are compiled from the same values that key
+        # cached message renders, and are rebuilt if those change
+        if getattr(self, "pres_settings", None) != settings:
             self.presz = re.compile(r"\[(?:size=\d*?)\]", re.IGNORECASE | re.MULTILINE )
             self.pres = []
             res = [ [r"\[(?:code|icode).*?\]", f"[font=mono][size={ms}]"],
@@ -2011,6 +2048,7 @@ class SidebandApp(MDApp):
 
             for r in res:
                 self.pres.append([re.compile(r[0], re.IGNORECASE | re.MULTILINE ), r[1]])
+            self.pres_settings = settings
 
 
         size_matches = self.presz.findall(text)
@@ -2434,17 +2472,12 @@ class SidebandApp(MDApp):
                     return
 
                 if audio_field[0] == LXMF.AM_OPUS_OGG:
-                    temp_path = os.path.join(self.sideband.rec_cache, "msg.ogg")
-                    with open(temp_path, "wb") as af: af.write(self.last_msg_audio)
+                    temp_path = self.sideband.audio_playback_path(audio_field)
 
                 elif audio_field[0] >= LXMF.AM_CODEC2_700C and audio_field[0] <= LXMF.AM_CODEC2_3200:
-                    temp_path = os.path.join(self.sideband.rec_cache, "msg.ogg")
-                    from sideband.audioproc import samples_to_ogg, decode_codec2, detect_codec2
-                    
-                    target_rate = 48000
+                    from sideband.audioproc import detect_codec2
                     if detect_codec2():
-                        if samples_to_ogg(decode_codec2(audio_field[1], audio_field[0]), temp_path, input_rate=8000, output_rate=target_rate): RNS.log("Wrote OGG file to: "+temp_path, RNS.LOG_DEBUG)
-                        else: RNS.log("OGG write failed", RNS.LOG_DEBUG)
+                        temp_path = self.sideband.audio_playback_path(audio_field)
                     else:
                         self.last_msg_audio = None
                         self.display_codec2_error()
@@ -2452,6 +2485,10 @@ class SidebandApp(MDApp):
                 
                 else: raise NotImplementedError(audio_field[0])
 
+                if temp_path == None:
+                    self.last_msg_audio = None
+                    return
+
                 if self.msg_sound == None:
                     self.msg_sound = FilePlayer()
 
@@ -4425,9 +4462,6 @@ class SidebandApp(MDApp):
         if not self.announces_view:
             self.announces_view = Announces(self)
             self.sideband.setstate("app.flags.new_announces", True)
-            for child in self.announces_view.ids.announces_scrollview.children: self.announces_view.ids.announces_scrollview.remove_widget(child)
-            self.announces_view.ids.announces_scrollview.effect_cls = ScrollEffect
-            self.announces_view.ids.announces_scrollview.add_widget(self.announces_view.get_widget())
             self.announces_view.update()
 
     def announces_action(self, sender=None, direction="left"):
@@ -5170,9 +5204,12 @@ class SidebandApp(MDApp):
             self.root.ids.screen_manager.add_widget(self.map_screen)
 
             from mapview import MapView
+            self.sideband.map_tile_cache()
             mapview = MapView(map_source=msource, zoom=mzoom, lat=mlat, lon=mlon)
             mapview.snap_to_zoom = False
             mapview.double_tap_zoom = True
+            self.map_marker_layer = ClusteredMarkerLayer(cluster_max_zoom=max(0, min(16, msource.max_zoom-1)))
+            mapview.add_layer(self.map_marker_layer)
             self.map = mapview
             self.map_screen.ids.map_layout.map = mapview
             self.map_screen.ids.map_layout.add_widget(self.map_screen.ids.map_layout.map)
@@ -5193,7 +5230,7 @@ class SidebandApp(MDApp):
             self.map_markers = {}
 
         def am_job(dt):
-            self.map_update_markers()
+            self.map_update_markers(full=True)
         Clock.schedule_once(am_job, 0.15)
 
         if no_transition:
@@ -5265,6 +5302,37 @@ class SidebandApp(MDApp):
 
         Clock.schedule_once(update_cache_size, 0.35)
 
+    def map_prefetch_action(self, sender=None):
+        # Downloads the currently visible map area for the next few
+        # zoom levels into the tile cache, for use while offline
+        def notify(text):
+            if RNS.vendor.platformutils.is_android():
+                toast(text)
+            else:
+                ok_button = MDRectangleFlatButton(text="OK",font_size=dp(18))
+                dialog = MDDialog(title="Map Download", text=text, buttons=[ ok_button ])
+                ok_button.bind(on_release=dialog.dismiss)
+                dialog.open()
+
+        if self.map == None or isinstance(self.map.map_source, MBTilesMapSource):
+            notify("Open the map with an online map source, and move it to the area you want to download")
+            return
+
+        source = self.map.map_source
+        bbox = self.map.get_bbox()
+        downloader = Downloader.instance(cache_dir=self.map_cache)
+        min_zoom = int(self.map.zoom); max_zoom = min(source.max_zoom, min_zoom+SidebandApp.MAP_PREFETCH_LEVELS)
+        while max_zoom > min_zoom and len(downloader.tiles_in_bbox(source, bbox, min_zoom, max_zoom)) > SidebandApp.MAP_PREFETCH_MAX_TILES:
+            max_zoom -= 1
+
+        def done(fetched, failed):
+            notify(f"Downloaded {fetched} map tiles for offline use"+(f", {failed} failed" if failed else ""))
+            if self.map_settings_screen != None and self.root.ids.screen_manager.current == "map_settings_screen":
+                self.map_settings_action()
+
+        count = downloader.prefetch(source, bbox, min_zoom, max_zoom, callback=done)
+        notify(f"Downloading up to {count} map tiles for zoom levels {min_zoom} to {max_zoom} in the background")
+
     def map_clear_cache(self, sender=None):
         yes_button = MDRectangleFlatButton(text="Yes",font_size=dp(18), theme_text_color="Custom", line_color=self.color_reject, text_color=self.color_reject)
         no_button = MDRectangleFlatButton(text="No",font_size=dp(18))
@@ -5464,10 +5532,20 @@ class SidebandApp(MDApp):
             RNS.log("Could not create map marker for "+RNS.prettyhexrep(source)+": "+str(e), RNS.LOG_ERROR)
             return None
 
-    def map_update_markers(self, sender=None):
+    def map_update_markers(self, sender=None, full=False):
+        # Applies location changes since the last update as per-source
+        # marker deltas. A full update re-lists all sources, and is only
+        # performed when the map is opened, when telemetry has been
+        # removed from the database, or when conversation trust has
+        # changed, so markers of sources that are no longer trusted
+        # are removed. Changing the trusted-only setting also results in
+        # a full update.
         RNS.log("Updating map markers", RNS.LOG_DEBUG)
+        trusted_only = self.sideband.config["telemetry_display_trusted_only"]
+        if full or trusted_only != self.map_trusted_only: self.map_location_cursor = None
+        self.map_trusted_only = trusted_only
         earliest = time.time() - self.sideband.config["map_history_limit"]
-        telemetry_entries = self.sideband.list_telemetry(after=earliest)
+        self.map_location_cursor, telemetry_entries, complete = self.sideband.list_location_changes(self.map_location_cursor, after=earliest)
         own_address = self.sideband.lxmf_destination.hash
         changes = False
 
@@ -5480,19 +5558,15 @@ class SidebandApp(MDApp):
             self.sideband.config["telemetry_bg"]
         ]
 
-        skip_entries = []
-        if self.sideband.config["telemetry_display_trusted_only"]:
-            for telemetry_source in telemetry_entries:
+        if trusted_only:
+            for telemetry_source in list(telemetry_entries.keys()):
                 try:
                     if not self.sideband.is_trusted(telemetry_source):
-                        skip_entries.append(telemetry_source)
+                        telemetry_entries.pop(telemetry_source)
+                        if telemetry_source in self.map_markers:
+                            changes = self.map_remove_marker(telemetry_source) or changes
                 except:
                     pass
-        for skip_entry in skip_entries:
-            try:
-                telemetry_entries.pop(skip_entry)
-            except:
-                pass
 
         try:
             if own_telemetry != None and "location" in own_telemetry and own_telemetry["location"] != None and own_telemetry["location"]["latitude"] != None and own_telemetry["location"]["longitude"] != None:
@@ -5502,7 +5576,7 @@ class SidebandApp(MDApp):
                     marker = self.map_create_marker(own_address, own_telemetry, own_appearance)
                     if marker != None:
                         self.map_markers[own_address] = marker
-                        self.map_screen.ids.map_layout.map.add_marker(marker)
+                        self.map_add_marker(marker)
                         changes = True
 
                 else:
@@ -5510,8 +5584,7 @@ class SidebandApp(MDApp):
                     o = own_telemetry["location"]
                     if o["last_update"] > marker.location_time or (hasattr(self, "own_appearance_changed") and self.own_appearance_changed):
                         marker.location_time = o["last_update"]
-                        marker.lat = o["latitude"]
-                        marker.lon = o["longitude"]
+                        self.map_move_marker(marker, o["latitude"], o["longitude"])
                         marker.icon.icon = own_appearance[0]
                         marker.icon.icon_color = own_appearance[1]
                         marker.icon.md_bg_color = own_appearance[2]
@@ -5520,79 +5593,115 @@ class SidebandApp(MDApp):
 
             stale_markers = []
             for marker in self.map_markers:
-                if not marker in telemetry_entries:
-                    if marker == own_address:
-                        if not retain_own:
-                            stale_markers.append(marker)
-                    else:
+                if marker == own_address:
+                    if not retain_own:
                         stale_markers.append(marker)
+                elif complete and not marker in telemetry_entries:
+                    stale_markers.append(marker)
 
             for marker in stale_markers:
-                RNS.log("Removing stale marker: "+str(marker), RNS.LOG_DEBUG)
-                try:
-                    to_remove = self.map_markers[marker]
-                    self.map_screen.ids.map_layout.map.remove_marker(to_remove)
-                    self.map_markers.pop(marker)
-                    changes = True
-                except Exception as e:
-                    RNS.log("Error while removing map marker: "+str(e), RNS.LOG_ERROR)
+                changes = self.map_remove_marker(marker) or changes
         
         except Exception as e:
             RNS.log("Error while updating own map marker: "+str(e), RNS.LOG_ERROR)
 
         for telemetry_source in telemetry_entries:
-            try:
-                skip = False
-                if telemetry_source == own_address:
-                    skip = True
-                elif telemetry_source in self.map_markers:
-                    marker = self.map_markers[telemetry_source]
-                    newest_timestamp = telemetry_entries[telemetry_source][0][0]
-                    if newest_timestamp <= marker.location_time:
-                        skip = True
-
-                latest_viewable = None
-                if not skip:
-                    for telemetry_entry in sorted(telemetry_entries[telemetry_source], key=lambda t: t[0], reverse=True):
-                        telemetry_timestamp = telemetry_entry[0]
-                        telemetry_data = telemetry_entry[1]
-                        t = Telemeter.from_packed(telemetry_data)
-                        if t != None:
-                            telemetry = t.read_all()
-                            if "location" in telemetry and telemetry["location"] != None and telemetry["location"]["latitude"] != None and telemetry["location"]["longitude"] != None:
-                                latest_viewable = telemetry
-                                break
-                            elif "connection_map" in telemetry:
-                                # TODO: Telemetry entries with connection map sensor types are skipped for now,
-                                # until a proper rendering mechanism is implemented
-                                break
-
-                    if latest_viewable != None:
-                        l = latest_viewable["location"]
-                        if not telemetry_source in self.map_markers:
-                            marker = self.map_create_marker(telemetry_source, latest_viewable, self.sideband.peer_appearance(telemetry_source))
-                            if marker != None:
-                                self.map_markers[telemetry_source] = marker
-                                self.map_screen.ids.map_layout.map.add_marker(marker)
-                                changes = True
-                        else:
-                            marker = self.map_markers[telemetry_source]
-                            marker.location_time = latest_viewable["time"]["utc"]
-                            marker.lat = l["latitude"]
-                            marker.lon = l["longitude"]
-                            appearance = self.sideband.peer_appearance(telemetry_source)
-                            marker.icon.icon = appearance[0]
-                            marker.icon.icon_color = appearance[1]
-                            marker.icon.md_bg_color = appearance[2]
-                            changes = True
-
-            except Exception as e:
-                RNS.log("Error while updating map entry for "+RNS.prettyhexrep(telemetry_source)+": "+str(e), RNS.LOG_ERROR)
+            if telemetry_source != own_address:
+                changes = self.map_update_marker(telemetry_source, telemetry_entries[telemetry_source]) or changes
 
+        self.map_schedule_eviction()
         self.last_map_update = time.time()
         if changes:
             self.map.trigger_update(True)
 
+    def map_update_marker(self, telemetry_source, telemetry_entry):
+        # Adds or moves the marker for a single source, and returns
+        # whether the map changed
+        try:
+            telemetry_timestamp, telemetry_data, location = telemetry_entry
+            if telemetry_source in self.map_markers:
+                marker = self.map_markers[telemetry_source]
+                if telemetry_timestamp <= marker.location_time:
+                    return False
+
+            location = Telemeter.peek_location(telemetry_data) or location
+            if not "last_update" in location: location["last_update"] = telemetry_timestamp
+            latest_viewable = {"time": {"utc": telemetry_timestamp}, "location": location}
+
+            if not telemetry_source in self.map_markers:
+                marker = self.map_create_marker(telemetry_source, latest_viewable, self.sideband.peer_appearance(telemetry_source))
+                if marker == None:
+                    return False
+
+                self.map_markers[telemetry_source] = marker
+                self.map_add_marker(marker)
+
+            else:
+                marker = self.map_markers[telemetry_source]
+                marker.location_time = telemetry_timestamp
+                self.map_move_marker(marker, location["latitude"], location["longitude"])
+                appearance = self.sideband.peer_appearance(telemetry_source)
+                marker.icon.icon = appearance[0]
+                marker.icon.icon_color = appearance[1]
+                marker.icon.md_bg_color = appearance[2]
+
+            self.map_marker_times[telemetry_source] = telemetry_timestamp
+            heapq.heappush(self.map_eviction_queue, (telemetry_timestamp, telemetry_source))
+            return True
+
+        except Exception as e:
+            RNS.log("Error while updating map entry for "+RNS.prettyhexrep(telemetry_source)+": "+str(e), RNS.LOG_ERROR)
+            return False
+
+    def map_add_marker(self, marker):
+        marker.cluster_marker = self.map_marker_layer.add_marker(marker.lon, marker.lat, widget=marker)
+
+    def map_move_marker(self, marker, lat, lon):
+        marker.lat = lat; marker.lon = lon
+        self.map_marker_layer.move_marker(marker.cluster_marker, lon, lat)
+
+    def map_remove_marker(self, source):
+        RNS.log("Removing stale marker: "+RNS.prettyhexrep(source), RNS.LOG_DEBUG)
+        self.map_marker_times.pop(source, None)
+        try:
+            to_remove = self.map_markers.pop(source)
+            self.map_marker_layer.remove_marker(to_remove.cluster_marker)
+            return True
+        except Exception as e:
+            RNS.log("Error while removing map marker: "+str(e), RNS.LOG_ERROR)
+            return False
+
+    def map_schedule_eviction(self):
+        # Schedules removal of the marker whose location will be the
+        # first to fall outside the map history window. Queue entries
+        # for markers that have since moved are discarded when popped.
+        if self.map_eviction_event != None:
+            self.map_eviction_event.cancel()
+            self.map_eviction_event = None
+
+        while len(self.map_eviction_queue) > 0:
+            timestamp, source = self.map_eviction_queue[0]
+            if self.map_marker_times.get(source) == timestamp:
+                break
+            heapq.heappop(self.map_eviction_queue)
+
+        if len(self.map_eviction_queue) > 0:
+            expiry = self.map_eviction_queue[0][0] + self.sideband.config["map_history_limit"]
+            self.map_eviction_event = Clock.schedule_once(self.map_evict_markers, max(0, expiry-time.time())+0.1)
+
+    def map_evict_markers(self, dt=None):
+        self.map_eviction_event = None
+        earliest = time.time() - self.sideband.config["map_history_limit"]
+        changes = False
+        while len(self.map_eviction_queue) > 0 and self.map_eviction_queue[0][0] <= earliest:
+            timestamp, source = heapq.heappop(self.map_eviction_queue)
+            if self.map_marker_times.get(source) == timestamp and source in self.map_markers:
+                changes = self.map_remove_marker(source) or changes
+
+        self.map_schedule_eviction()
+        if changes:
+            self.map.trigger_update(True)
+
     ### Guide screen
     ######################################
     def close_guide_action(self, sender=None):
@@ -6,7 +6,10 @@ Layer that support point clustering
 
 from math import atan, exp, floor, log, pi, sin, sqrt
 from os.path import dirname, join
+from threading import Thread
+from time import time
 
+from kivy.clock import Clock
 from kivy.lang import Builder
 from kivy.metrics import dp
 from kivy.properties import (
@@ -241,6 +244,7 @@ class Cluster:
         self.props = props
         self.parent_id = None
         self.widget = None
+        self.removed = False
 
         # preprocess lon/lat
         self.lon = xLng(x)
@@ -248,25 +252,39 @@ class Cluster:
 
 
 class Marker:
-    def __init__(self, lon, lat, cls=MapMarker, options=None):
-        self.lon = lon
-        self.lat = lat
+    def __init__(self, lon, lat, cls=MapMarker, options=None, widget=None):
         self.cls = cls
         self.options = options
-
-        # preprocess x/y from lon/lat
-        self.x = lngX(lon)
-        self.y = latY(lat)
+        self.move(lon, lat)
 
         # cluster information
         self.id = None
         self.zoom = float("inf")
         self.parent_id = None
-        self.widget = None
+        self.widget = widget
+        self.removed = False
+        self.origin = None
+
+    def snapshot(self):
+        """Returns a copy of the marker that can be loaded into a cluster
+        index, while the original remains free to change.
+        """
+        point = Marker.__new__(Marker)
+        point.__dict__.update(self.__dict__)
+        point.origin = self
+        return point
+
+    def move(self, lon, lat):
+        self.lon = lon
+        self.lat = lat
+
+        # preprocess x/y from lon/lat
+        self.x = lngX(lon)
+        self.y = latY(lat)
 
     def __repr__(self):
-        return "<Marker lon={} lat={} source={}>".format(
-            self.lon, self.lat, self.source
+        return "<Marker lon={} lat={} widget={}>".format(
+            self.lon, self.lat, self.widget
         )
 
 
@@ -283,33 +301,28 @@ class SuperCluster:
 
     def load(self, points):
         """Load an array of markers.
-        Once loaded, the index is immutable.
+        Once loaded, the index is immutable. Markers can be loaded
+        again into a new index, after they have been changed.
         """
-        from time import time
-
         self.trees = {}
         self.points = points
 
         for index, point in enumerate(points):
             point.id = index
+            point.zoom = float("inf")
+            point.parent_id = None
 
         clusters = points
         for z in range(self.max_zoom, self.min_zoom - 1, -1):
-            start = time()
-            print("build tree", z)
             self.trees[z + 1] = KDBush(clusters, self.node_size)
-            print("kdbush", (time() - start) * 1000)
-            start = time()
             clusters = self._cluster(clusters, z)
-            print(len(clusters))
-            print("clustering", (time() - start) * 1000)
         self.trees[self.min_zoom] = KDBush(clusters, self.node_size)
 
     def get_clusters(self, bbox, zoom):
         """For the given bbox [westLng, southLat, eastLng, northLat], and
         integer zoom, returns an array of clusters and markers
         """
-        tree = self.trees[self._limit_zoom(zoom)]
+        tree = self.trees[self._limit_zoom(int(zoom))]
         ids = tree.range(lngX(bbox[0]), latY(bbox[3]), lngX(bbox[2]), latY(bbox[1]))
         clusters = []
         for i in range(len(ids)):
@@ -388,53 +401,127 @@ class ClusterMapMarker(MapMarker):
 
 
 class ClusteredMarkerLayer(MapLayer):
+    """Layer that aggregates markers into clusters depending on the zoom
+    level. Only clusters and markers inside the current viewport are
+    materialized as widgets. The cluster index is rebuilt when markers
+    are added, moved or removed, at most once per rebuild interval.
+    """
+
     cluster_cls = ObjectProperty(ClusterMapMarker)
     cluster_min_zoom = NumericProperty(0)
     cluster_max_zoom = NumericProperty(16)
     cluster_radius = NumericProperty("40dp")
     cluster_extent = NumericProperty(512)
     cluster_node_size = NumericProperty(64)
+    cluster_rebuild_interval = NumericProperty(2.0)
 
     def __init__(self, **kwargs):
         self.cluster = None
         self.cluster_markers = []
+        self.last_build = 0
+        self._rebuild_event = None
+        self._building = False
+        self._dirty = False
         super().__init__(**kwargs)
 
-    def add_marker(self, lon, lat, cls=MapMarker, options=None):
+    def add_marker(self, lon, lat, cls=MapMarker, options=None, widget=None):
+        """Add a marker to the layer. If widget is specified, it will be
+        used to display the marker, instead of creating a widget from
+        cls and options.
+        """
         if options is None:
             options = {}
-        marker = Marker(lon, lat, cls, options)
+        marker = Marker(lon, lat, cls, options, widget)
         self.cluster_markers.append(marker)
+        self.invalidate()
         return marker
 
+    def move_marker(self, marker, lon, lat):
+        marker.move(lon, lat)
+        self.invalidate()
+
     def remove_marker(self, marker):
+        marker.removed = True
         self.cluster_markers.remove(marker)
+        if marker.widget is not None and marker.widget.parent is self:
+            self.remove_widget(marker.widget)
+        self.invalidate()
+
+    def invalidate(self):
+        """Schedule a rebuild of the cluster index. Removed markers are
+        hidden immediately, while added and moved markers are clustered
+        at the next rebuild.
+        """
+        self._dirty = True
+        if self._rebuild_event is None and not self._building:
+            delay = max(0, self.last_build + self.cluster_rebuild_interval - time())
+            self._rebuild_event = Clock.schedule_once(self._rebuild, delay)
+
+    def _rebuild(self, dt):
+        # The index is built from a snapshot of the markers in a
+        # separate thread, since building it for many thousands of
+        # markers takes far longer than a frame.
+        self._rebuild_event = None
+        self._dirty = False
+        self._building = True
+        points = [marker.snapshot() for marker in self.cluster_markers]
+
+        def job():
+            cluster = self.build_cluster(points)
+            Clock.schedule_once(lambda dt: self._install(cluster), 0)
+        Thread(target=job, daemon=True).start()
+
+    def _install(self, cluster):
+        self._building = False
+        self.last_build = time()
+        self.cluster = cluster
+        if self.parent is not None:
+            self.reposition()
+        if self._dirty:
+            self.invalidate()
 
     def reposition(self):
         if self.cluster is None:
-            self.build_cluster()
-        margin = dp(48)
+            self.invalidate()
+            return
         mapview = self.parent
+        if mapview is None:
+            return
+        margin = dp(48)
         set_marker_position = self.set_marker_position
         bbox = mapview.get_bbox(margin)
         bbox = (bbox[1], bbox[0], bbox[3], bbox[2])
-        self.clear_widgets()
+        visible = {}
         for point in self.cluster.get_clusters(bbox, mapview.zoom):
+            if isinstance(point, Marker) and point.origin is not None:
+                point = point.origin
+            if point.removed:
+                continue
             widget = point.widget
             if widget is None:
                 widget = self.create_widget_for(point)
             set_marker_position(mapview, widget)
-            self.add_widget(widget)
-
-    def build_cluster(self):
-        self.cluster = SuperCluster(
+            visible[id(widget)] = widget
+
+        for widget in self.children[:]:
+            if not id(widget) in visible:
+                self.remove_widget(widget)
+        for widget in visible.values():
+            if widget.parent is None:
+                self.add_widget(widget)
+
+    def build_cluster(self, points=None):
+        if points is None:
+            points = [marker.snapshot() for marker in self.cluster_markers]
+        cluster = SuperCluster(
             min_zoom=self.cluster_min_zoom,
             max_zoom=self.cluster_max_zoom,
             radius=self.cluster_radius,
             extent=self.cluster_extent,
             node_size=self.cluster_node_size,
         )
-        self.cluster.load(self.cluster_markers)
+        cluster.load(points)
+        return cluster
 
     def create_widget_for(self, point):
         if isinstance(point, Marker):
@@ -447,3 +534,15 @@ class ClusteredMarkerLayer(MapLayer):
         x, y = mapview.get_window_xy_from(marker.lat, marker.lon, mapview.zoom)
         marker.x = int(x - marker.width * marker.anchor_x)
         marker.y = int(y - marker.height * marker.anchor_y)
+        if marker.children and not isinstance(marker, ClusterMapMarker):
+            for c in marker.children:
+                c.x = marker.x
+                c.y = marker.y+dp(16)
+
+    def unload(self):
+        if self._rebuild_event is not None:
+            self._rebuild_event.cancel()
+            self._rebuild_event = None
+        self.clear_widgets()
+        del self.cluster_markers[:]
+        self.cluster = None
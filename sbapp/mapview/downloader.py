@@ -2,9 +2,11 @@
 
 __all__ = ["Downloader"]
 
+import io
 import logging
 import traceback
 from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from math import floor
 from os import environ, makedirs
 from os.path import exists, join
 from random import choice
@@ -12,9 +14,11 @@ from time import time
 
 import requests
 from kivy.clock import Clock
+from kivy.core.image import Image as CoreImage
 from kivy.logger import LOG_LEVELS, Logger
 
 from mapview.constants import CACHE_DIR
+from mapview.tilecache import TileCache
 
 import logging
 # if "MAPVIEW_DEBUG_DOWNLOADER" in environ:
@@ -49,11 +53,13 @@ class Downloader:
         self.is_paused = False
         self.cap_time = cap_time
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=1)
         self._futures = []
         Clock.schedule_interval(self._check_executor, 1 / 60.0)
         if not exists(self.cache_dir):
             RNS.log("Creating cache dir "+str(self.cache_dir), RNS.LOG_WARNING)
             makedirs(self.cache_dir)
+        self.cache = TileCache.instance(self.cache_dir)
 
         logging.getLogger("urllib3").setLevel(logging.WARNING)
         logging.getLogger("urllib3.response").setLevel(logging.WARNING)
@@ -106,35 +112,90 @@ class Downloader:
             i -= 1
         return "".join(quad_key)
 
-    def _load_tile(self, tile):
-        if tile.state == "done":
-            return
-        cache_fn = tile.cache_fn
-        if exists(cache_fn):
-            # Logger.debug("Downloader: use cache {}".format(cache_fn))
-            return tile.set_source, (cache_fn,)
-        tile_y = tile.map_source.get_row_count(tile.zoom) - tile.tile_y - 1
-
-        if tile.map_source.quad_key:
-            uri = tile.map_source.url.format(
-                q=self.__to_quad(tile.tile_x,tile_y,tile.zoom), s=choice(tile.map_source.subdomains)
+    def _tile_uri(self, map_source, zoom, tile_x, tile_y):
+        tile_y = map_source.get_row_count(zoom) - tile_y - 1
+        if map_source.quad_key:
+            return map_source.url.format(
+                q=self.__to_quad(tile_x,tile_y,zoom), s=choice(map_source.subdomains)
             )
         else:
-            uri = tile.map_source.url.format(
-                z=tile.zoom, x=tile.tile_x, y=tile_y, s=choice(tile.map_source.subdomains)
+            return map_source.url.format(
+                z=zoom, x=tile_x, y=tile_y, s=choice(map_source.subdomains)
             )
 
+    def _fetch_tile(self, map_source, zoom, tile_x, tile_y):
+        uri = self._tile_uri(map_source, zoom, tile_x, tile_y)
         # Logger.debug("Downloader: download(tile) {}".format(uri))
         response = requests.get(uri, headers={'User-agent': USER_AGENT}, timeout=5)
-        try:
-            response.raise_for_status()
-            data = response.content
-            with open(cache_fn, "wb") as fd:
-                fd.write(data)
-            # Logger.debug("Downloaded {} bytes: {}".format(len(data), uri))
-            return tile.set_source, (cache_fn,)
-        except Exception as e:
-            print("Downloader error: {!r}".format(e))
+        response.raise_for_status()
+        data = response.content
+        self.cache.put(map_source.cache_key, zoom, tile_x, tile_y, data)
+        # Logger.debug("Downloaded {} bytes: {}".format(len(data), uri))
+        return data
+
+    def _load_tile(self, tile):
+        if tile.state == "done":
+            return
+        map_source = tile.map_source
+        data = self.cache.get(map_source.cache_key, tile.zoom, tile.tile_x, tile.tile_y)
+        if data is None:
+            try:
+                data = self._fetch_tile(map_source, tile.zoom, tile.tile_x, tile.tile_y)
+            except Exception as e:
+                print("Downloader error: {!r}".format(e))
+                return
+
+        im = CoreImage(
+            io.BytesIO(data),
+            ext=map_source.image_ext,
+            filename="{}.{}.{}.{}".format(tile.zoom, tile.tile_x, tile.tile_y, map_source.image_ext),
+        )
+        return self._load_tile_done, (tile, im,)
+
+    def _load_tile_done(self, tile, im):
+        tile.texture = im.texture
+        tile.state = "need-animation"
+
+    def prefetch(self, map_source, bbox, min_zoom, max_zoom, callback=None):
+        """Download all tiles within the bbox (lat1, lon1, lat2, lon2) for
+        the given zoom range into the cache, so they are available
+        offline. Tiles are fetched one at a time in the background, and
+        tiles already in the cache are skipped. If a callback is given,
+        it is called on the main thread with the number of fetched and
+        failed tiles when done. Returns the number of tiles in range.
+        """
+        tiles = self.tiles_in_bbox(map_source, bbox, min_zoom, max_zoom)
+        def job():
+            fetched = failed = 0
+            for zoom, tile_x, tile_y in tiles:
+                if self.cache.contains(map_source.cache_key, zoom, tile_x, tile_y):
+                    continue
+                try:
+                    self._fetch_tile(map_source, zoom, tile_x, tile_y)
+                    fetched += 1
+                except Exception as e:
+                    RNS.log("Could not prefetch map tile: "+str(e), RNS.LOG_DEBUG)
+                    failed += 1
+            RNS.log("Prefetched "+str(fetched)+" of "+str(len(tiles))+" map tiles, "+str(failed)+" failed", RNS.LOG_DEBUG)
+            if callback:
+                Clock.schedule_once(lambda dt: callback(fetched, failed), 0)
+        self.prefetch_executor.submit(job)
+        return len(tiles)
+
+    def tiles_in_bbox(self, map_source, bbox, min_zoom, max_zoom):
+        lat1, lon1, lat2, lon2 = bbox
+        tiles = []
+        for zoom in range(int(min_zoom), int(max_zoom) + 1):
+            size = float(map_source.dp_tile_size)
+            rows = map_source.get_row_count(zoom)
+            x1 = int(floor(map_source.get_x(zoom, min(lon1, lon2)) / size))
+            x2 = int(floor(map_source.get_x(zoom, max(lon1, lon2)) / size))
+            y1 = int(floor(map_source.get_y(zoom, min(lat1, lat2)) / size))
+            y2 = int(floor(map_source.get_y(zoom, max(lat1, lat2)) / size))
+            for tile_x in range(max(0, x1), min(rows - 1, x2) + 1):
+                for tile_y in range(max(0, y1), min(rows - 1, y2) + 1):
+                    tiles.append((zoom, tile_x, tile_y))
+        return tiles
 
     def _check_executor(self, dt):
         start = time()
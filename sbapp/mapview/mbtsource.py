@@ -13,6 +13,7 @@ __all__ = ["MBTilesMapSource"]
 import io
 import sqlite3
 import threading
+from collections import OrderedDict
 
 from kivy.core.image import Image as CoreImage
 from kivy.core.image import ImageLoader
@@ -21,7 +22,51 @@ from mapview.downloader import Downloader
 from mapview.source import MapSource
 
 
+class TextureCache:
+    """Bounded LRU of decoded tile textures, evicting the least recently
+    used textures once their combined size exceeds the byte budget. Only
+    accessed from the main thread, where textures are created.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        texture = self.entries.get(key)
+        if texture is not None:
+            self.entries.move_to_end(key)
+        return texture
+
+    def put(self, key, texture):
+        if key in self.entries:
+            self.size -= self._texture_size(self.entries.pop(key))
+        self.entries[key] = texture
+        self.size += self._texture_size(texture)
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= self._texture_size(evicted)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    @staticmethod
+    def _texture_size(texture):
+        return texture.width * texture.height * 4
+
+
 class MBTilesMapSource(MapSource):
+    # Decoded textures are shared between all sources, and keyed by
+    # filename, so they survive the source being recreated
+    TEXTURE_CACHE_SIZE = 32*1024*1024
+    texture_cache = TextureCache(TEXTURE_CACHE_SIZE)
+
+    # Connections cannot be shared across threads, so each downloader
+    # worker keeps its own connection to every MBTiles file it reads
+    _readers = threading.local()
+
     def __init__(self, filename, **kwargs):
         super().__init__(**kwargs)
         self.filename = filename
@@ -55,16 +100,28 @@ class MBTilesMapSource(MapSource):
     def fill_tile(self, tile):
         if tile.state == "done":
             return
+        texture = MBTilesMapSource.texture_cache.get(self._texture_key(tile))
+        if texture is not None:
+            tile.texture = texture
+            tile.state = "need-animation"
+            return
         Downloader.instance(self.cache_dir).submit(self._load_tile, tile)
 
-    def _load_tile(self, tile):
-        # global db context cannot be shared across threads.
-        ctx = threading.local()
-        if not hasattr(ctx, "db"):
-            ctx.db = sqlite3.connect(self.filename)
+    def _texture_key(self, tile):
+        return (self.filename, tile.zoom, tile.tile_x, tile.tile_y)
+
+    def _reader(self):
+        readers = getattr(MBTilesMapSource._readers, "connections", None)
+        if readers is None:
+            readers = MBTilesMapSource._readers.connections = {}
+        db = readers.get(self.filename)
+        if db is None:
+            db = readers[self.filename] = sqlite3.connect(self.filename)
+        return db
 
+    def _load_tile(self, tile):
         # get the right tile
-        c = ctx.db.cursor()
+        c = self._reader().cursor()
         c.execute(
             (
                 "SELECT tile_data FROM tiles WHERE "
@@ -99,6 +156,7 @@ class MBTilesMapSource(MapSource):
     def _load_tile_done(self, tile, im):
         tile.texture = im.texture
         tile.state = "need-animation"
+        MBTilesMapSource.texture_cache.put(self._texture_key(tile), im.texture)
 
     def get_x(self, zoom, lon):
         if self.is_xy:
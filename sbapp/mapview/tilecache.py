@@ -0,0 +1,181 @@
+# coding=utf-8
+"""
+Tile cache
+==========
+
+Single-file SQLite store for downloaded map tiles. Tiles are evicted in
+least recently used order once the cache exceeds its byte budget, and
+the total size is maintained by triggers, so it can be read in constant
+time.
+"""
+
+__all__ = ["TileCache"]
+
+import re
+import sqlite3
+import threading
+from os import makedirs, scandir, unlink
+from os.path import exists, join
+from time import time
+
+import RNS
+
+
+class TileCache:
+    FILENAME = "tiles.db"
+    DEFAULT_MAX_BYTES = 256*1024*1024
+
+    # Access times are only rewritten when they are older than this,
+    # to avoid a write for every tile that is displayed
+    TOUCH_INTERVAL = 60
+
+    # When evicting, the cache is trimmed to this fraction of the budget
+    EVICT_TARGET = 0.9
+
+    # Earlier versions stored each tile as a separate file, named from
+    # the cache format of the map source
+    LEGACY_TILE_FILE = re.compile(r"^.+_\d+_\d+_\d+\.(png|jpg|jpeg)$")
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+    _limits = {}
+
+    @staticmethod
+    def instance(cache_dir):
+        with TileCache._instances_lock:
+            if not cache_dir in TileCache._instances:
+                TileCache._instances[cache_dir] = TileCache(cache_dir, TileCache._limits.get(cache_dir))
+            return TileCache._instances[cache_dir]
+
+    @staticmethod
+    def configure(cache_dir, max_bytes):
+        """Sets the byte budget for the cache in a directory. This can be
+        called before the cache is opened, and applies to whichever
+        component opens it first.
+        """
+        with TileCache._instances_lock:
+            TileCache._limits[cache_dir] = max_bytes
+            cache = TileCache._instances.get(cache_dir)
+        if cache is not None:
+            cache.set_max_bytes(max_bytes)
+
+    def __init__(self, cache_dir, max_bytes=None):
+        if not exists(cache_dir):
+            makedirs(cache_dir)
+        self.path = join(cache_dir, TileCache.FILENAME)
+        self.max_bytes = max_bytes or TileCache.DEFAULT_MAX_BYTES
+        if not exists(self.path):
+            TileCache.remove_legacy_tiles(cache_dir)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=15)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS tiles (
+                id INTEGER PRIMARY KEY, cache_key TEXT, zoom INTEGER,
+                tile_x INTEGER, tile_y INTEGER, data BLOB, size INTEGER, accessed REAL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_tiles_position ON tiles(cache_key, zoom, tile_x, tile_y);
+            CREATE INDEX IF NOT EXISTS idx_tiles_accessed ON tiles(accessed);
+
+            CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value INTEGER);
+            INSERT OR IGNORE INTO info (key, value) VALUES ('size', 0);
+
+            CREATE TRIGGER IF NOT EXISTS tiles_size_insert AFTER INSERT ON tiles BEGIN
+                UPDATE info SET value = value + new.size WHERE key = 'size';
+            END;
+            CREATE TRIGGER IF NOT EXISTS tiles_size_delete AFTER DELETE ON tiles BEGIN
+                UPDATE info SET value = value - old.size WHERE key = 'size';
+            END;
+            CREATE TRIGGER IF NOT EXISTS tiles_size_update AFTER UPDATE OF size ON tiles BEGIN
+                UPDATE info SET value = value - old.size + new.size WHERE key = 'size';
+            END;
+        """)
+        self.db.commit()
+
+    def get(self, cache_key, zoom, tile_x, tile_y):
+        """Returns the cached tile data, or None if the tile is not cached.
+        """
+        now = time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, data, accessed FROM tiles WHERE cache_key=? AND zoom=? AND tile_x=? AND tile_y=?",
+                (cache_key, zoom, tile_x, tile_y),
+            ).fetchone()
+            if row is None:
+                return None
+            if row[2] < now - TileCache.TOUCH_INTERVAL:
+                self.db.execute("UPDATE tiles SET accessed=? WHERE id=?", (now, row[0]))
+                self.db.commit()
+            return row[1]
+
+    def contains(self, cache_key, zoom, tile_x, tile_y):
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM tiles WHERE cache_key=? AND zoom=? AND tile_x=? AND tile_y=?",
+                (cache_key, zoom, tile_x, tile_y),
+            ).fetchone() is not None
+
+    def put(self, cache_key, zoom, tile_x, tile_y, data):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO tiles (cache_key, zoom, tile_x, tile_y, data, size, accessed) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(cache_key, zoom, tile_x, tile_y) DO UPDATE SET data=excluded.data, size=excluded.size, accessed=excluded.accessed",
+                (cache_key, zoom, tile_x, tile_y, data, len(data), time()),
+            )
+            if self._size() > self.max_bytes:
+                self._evict()
+            self.db.commit()
+
+    def set_max_bytes(self, max_bytes):
+        """Changes the byte budget, evicting tiles right away if the
+        cache is now over it.
+        """
+        with self.lock:
+            self.max_bytes = max_bytes or TileCache.DEFAULT_MAX_BYTES
+            if self._size() > self.max_bytes:
+                self._evict()
+                self.db.commit()
+
+    @staticmethod
+    def remove_legacy_tiles(cache_dir):
+        """Removes tile files left by earlier versions from the cache
+        directory. Only files named like legacy tiles are removed.
+        """
+        removed = 0
+        for entry in scandir(cache_dir):
+            if entry.is_file(follow_symlinks=False) and TileCache.LEGACY_TILE_FILE.match(entry.name):
+                try:
+                    unlink(entry.path)
+                    removed += 1
+                except Exception as e:
+                    RNS.log(f"Could not remove legacy map tile file {entry.path}: {e}", RNS.LOG_WARNING)
+
+        if removed > 0:
+            RNS.log(f"Removed {removed} map tile files from earlier versions in {cache_dir}, since tiles are now stored in {TileCache.FILENAME}", RNS.LOG_NOTICE)
+
+    def size(self):
+        """Returns the total size of all cached tiles in bytes.
+        """
+        with self.lock:
+            return self._size()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM tiles")
+            self.db.commit()
+            self.db.execute("VACUUM")
+
+    def _size(self):
+        return self.db.execute("SELECT value FROM info WHERE key = 'size'").fetchone()[0]
+
+    def _evict(self):
+        # Deletes least recently used tiles in batches, until the cache
+        # is below the eviction target
+        target = self.max_bytes * TileCache.EVICT_TARGET
+        while self._size() > target:
+            deleted = self.db.execute(
+                "DELETE FROM tiles WHERE id IN (SELECT id FROM tiles ORDER BY accessed LIMIT 16)"
+            ).rowcount
+            if deleted == 0:
+                break
@@ -2,6 +2,7 @@ __debug_build__ = False
 
 import sys
 import time
+import threading
 import RNS
 from os import environ
 
@@ -53,6 +54,10 @@ else:
     from sbapp.sideband.core import SidebandCore
 
 class SidebandService():
+    # Heartbeats must be written well within the stale time checked
+    # by the UI in SidebandCore.service_available
+    HEARTBEAT_INTERVAL = 2.5
+
     usb_device_filter = {
         0x0403: [0x6001, 0x6010, 0x6011, 0x6014, 0x6015], # FTDI
         0x10C4: [0xea60, 0xea70, 0xea71], # SiLabs
@@ -487,8 +492,16 @@ class SidebandService():
             return stat
 
     def run(self):
+        # The loop wakes up when one of the wanted actions is signalled,
+        # and otherwise only to update the heartbeat
+        wants_event = threading.Event()
+        def wants_changed(prop, value):
+            if value: wants_event.set()
+        self.sideband.subscribe_state(["wants.service_stop", "wants.clear_notifications", "wants.settings_reload", "wants.rnode_ble_reset"], wants_changed)
+
         while self.should_run:
-            sleep_time = 1
+            sleep_time = SidebandService.HEARTBEAT_INTERVAL
+            wants_event.clear()
             self.sideband.setstate("service.heartbeat", time.time())
             self.sideband.setstate("service.connectivity_status", self.get_connectivity_status())
 
@@ -515,7 +528,7 @@ class SidebandService():
                 else:
                     RNS.log("No RNode interface active, could not execute BLE hardware reset", RNS.LOG_ERROR)
 
-            time.sleep(sleep_time)
+            wants_event.wait(sleep_time)
 
         self.sideband.cleanup()
         self.release_locks()
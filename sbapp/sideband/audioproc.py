@@ -113,6 +113,88 @@ def detect_codec2():
 
     return False
 
+def _chunks(source, chunk_size):
+    # Yields chunks from a file-like object, or passes through the
+    # chunks of any other iterable
+    if hasattr(source, "read"):
+        return iter(lambda: source.read(chunk_size), b"")
+    else:
+        return iter(source)
+
+# Samples must be 8KHz, 16-bit, 1 channel. The source can be a file-like
+# object with raw PCM data, or an iterable of sample chunks of any size,
+# given as bytes-like objects or int16 arrays. One encoded packet is
+# yielded per frame, and a trailing partial frame is padded with silence.
+def codec2_encoder(source, mode):
+    import pycodec2
+    if not mode in codec2_modes:
+        return
+
+    c2 = pycodec2.Codec2(codec2_modes[mode])
+    SPF = c2.samples_per_frame()
+    frame = np.zeros(SPF, dtype=np.int16)
+    filled = 0
+    carry = b""
+
+    for chunk in _chunks(source, SPF*2*64):
+        if isinstance(chunk, np.ndarray):
+            chunk = chunk.astype(np.int16, copy=False)
+        else:
+            # Byte chunks need not end on a sample boundary, so an odd
+            # trailing byte is carried over into the next chunk
+            chunk = memoryview(chunk).cast("B")
+            if len(carry) > 0:
+                chunk = memoryview(carry + bytes(chunk))
+            whole = len(chunk) - len(chunk) % 2
+            carry = bytes(chunk[whole:])
+            chunk = np.frombuffer(chunk[:whole], dtype=np.int16)
+
+        offset = 0
+        while offset < len(chunk):
+            if filled == 0 and len(chunk)-offset >= SPF:
+                # Whole frames are encoded directly from the chunk
+                yield c2.encode(chunk[offset:offset+SPF])
+                offset += SPF
+            else:
+                taken = min(SPF-filled, len(chunk)-offset)
+                frame[filled:filled+taken] = chunk[offset:offset+taken]
+                filled += taken; offset += taken
+                if filled == SPF:
+                    yield c2.encode(frame)
+                    filled = 0
+
+    if filled > 0:
+        frame[filled:] = 0
+        yield c2.encode(frame)
+
+# The source can be a file-like object or an iterable of bytes-like
+# chunks of encoded data. Decoded frames are yielded as int16 arrays.
+def codec2_decoder(source, mode):
+    import pycodec2
+    if not mode in codec2_modes:
+        return
+
+    c2 = pycodec2.Codec2(codec2_modes[mode])
+    BPF = c2.bytes_per_frame()
+    pending = bytearray()
+
+    for chunk in _chunks(source, BPF*64):
+        chunk = memoryview(chunk).cast("B")
+        offset = 0
+        if len(pending) > 0:
+            taken = min(BPF-len(pending), len(chunk))
+            pending += chunk[:taken]
+            offset = taken
+            if len(pending) == BPF:
+                yield c2.decode(bytes(pending))
+                pending.clear()
+
+        while len(chunk)-offset >= BPF:
+            yield c2.decode(bytes(chunk[offset:offset+BPF]))
+            offset += BPF
+
+        pending += chunk[offset:]
+
 # Samples must be 8KHz, 16-bit, 1 channel
 def encode_codec2(samples, mode):
     ap_start = time.time()
@@ -122,25 +204,21 @@ def encode_codec2(samples, mode):
 
     c2 = pycodec2.Codec2(codec2_modes[mode])
     SPF = c2.samples_per_frame()
-    PACKET_SIZE = SPF * 2 # 16-bit samples
-    STRUCT_FORMAT = '{}h'.format(SPF)
-    F_FRAMES = len(samples)/SPF
-    N_FRAMES = math.floor(len(samples)/SPF)
-    # TODO: Add padding to align to whole frames
-    frames = np.array(samples[0:N_FRAMES*SPF], dtype=np.int16)
-    
-    encoded = b""
-    for pi in range(0, N_FRAMES):
-        pstart = pi*SPF
-        pend = (pi+1)*SPF
-        frame = frames[pstart:pend]
-        encoded_packet = c2.encode(frame)
-        encoded += encoded_packet
+    BPF = c2.bytes_per_frame()
+    if not isinstance(samples, np.ndarray):
+        samples = np.frombuffer(samples, dtype=np.int16)
+    N_FRAMES = math.ceil(len(samples)/SPF)
+
+    # Encoded frames are written into a preallocated buffer, and the
+    # encoder reads whole frames directly from the sample buffer
+    encoded = bytearray(N_FRAMES*BPF)
+    for pi, encoded_packet in enumerate(codec2_encoder((samples,), mode)):
+        encoded[pi*BPF:(pi+1)*BPF] = encoded_packet
 
     ap_duration = time.time() - ap_start
     RNS.log("Codec2 encoding complete in "+RNS.prettytime(ap_duration)+", bytes out: "+str(len(encoded)), RNS.LOG_DEBUG)
 
-    return encoded
+    return bytes(encoded)
 
 def decode_codec2(encoded_bytes, mode):
     ap_start = time.time()
@@ -151,18 +229,13 @@ def decode_codec2(encoded_bytes, mode):
     c2 = pycodec2.Codec2(codec2_modes[mode])
     SPF = c2.samples_per_frame()
     BPF = c2.bytes_per_frame()
-    STRUCT_FORMAT = '{}h'.format(SPF)
     N_FRAMES = math.floor(len(encoded_bytes)/BPF)
 
-    decoded = b""
-    for pi in range(0, N_FRAMES):
-        pstart = pi*BPF
-        pend = (pi+1)*BPF
-        encoded_packet = encoded_bytes[pstart:pend]
-        decoded_frame = c2.decode(encoded_packet)
-        decoded += struct.pack(STRUCT_FORMAT, *decoded_frame)
+    decoded = np.empty(N_FRAMES*SPF, dtype=np.int16)
+    for pi, decoded_frame in enumerate(codec2_decoder((encoded_bytes,), mode)):
+        decoded[pi*SPF:(pi+1)*SPF] = decoded_frame
 
     ap_duration = time.time() - ap_start
     RNS.log("Codec2 decoding complete in "+RNS.prettytime(ap_duration)+", samples out: "+str(len(decoded)), RNS.LOG_DEBUG)
 
-    return decoded
\ No newline at end of file
+    return decoded.tobytes()
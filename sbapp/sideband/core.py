@@ -18,7 +18,8 @@ import multiprocessing.connection
 
 from copy import deepcopy
 from threading import Lock
-from collections import deque
+from contextlib import contextmanager
+from collections import deque, OrderedDict
 from .res import sideband_fb_data
 from .sense import Telemeter, Commands
 from .plugins import SidebandCommandPlugin, SidebandServicePlugin, SidebandTelemetryPlugin
@@ -102,13 +103,70 @@ class PropagationNodeDetector():
         self.owner = owner
         self.owner_app = owner.owner_app
 
+class BusyRetryCursor(sqlite3.Cursor):
+    # Cursor for the database writer connection. Statements that fail
+    # because the database is busy are retried, since a statement that
+    # fails with SQLITE_BUSY has no effect, and can be run again within
+    # the same transaction.
+    def execute(self, *args):
+        return db_busy_retry(lambda: sqlite3.Cursor.execute(self, *args), "statement")
+
+    def executemany(self, *args):
+        return db_busy_retry(lambda: sqlite3.Cursor.executemany(self, *args), "statement")
+
+class BusyRetryConnection(sqlite3.Connection):
+    def cursor(self, factory=BusyRetryCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+def db_busy_retry(operation, description):
+    # Retries a database operation when the database is busy, which can
+    # happen when the service and UI processes write at the same time
+    retries = 0
+    while True:
+        try:
+            return operation()
+        except sqlite3.OperationalError as e:
+            busy = "locked" in str(e) or "busy" in str(e)
+            if not busy or retries >= SidebandCore.DB_BUSY_RETRIES:
+                raise e
+
+            retries += 1
+            RNS.log(f"Database busy on {description}, retrying ({retries}/{SidebandCore.DB_BUSY_RETRIES})", RNS.LOG_DEBUG)
+            time.sleep(SidebandCore.DB_BUSY_BACKOFF*retries)
+
 class SidebandCore():
     CONV_P2P                        = 0x01
     CONV_GROUP                      = 0x02
     CONV_BROADCAST                  = 0x03
     CONV_VOICE                      = 0x04
 
-    MAX_ANNOUNCES                   = 24
+    MAX_ANNOUNCES                   = 50000
+    ANNOUNCE_FLUSH_INTERVAL         = 2.5
+    ANNOUNCE_WRITE_BATCH            = 64
+    ANNOUNCES_PAGE_SIZE             = 64
+    ANNOUNCE_COLUMNS                = "source, received, data, dest_type, extra, name, stamp_cost, hops, rowid"
+    MESSAGES_PAGE_SIZE              = 32
+    DB_SCHEMA_VERSION               = 6
+    DB_BUSY_TIMEOUT                 = 15.0
+    DB_BUSY_RETRIES                 = 5
+    DB_BUSY_BACKOFF                 = 0.1
+    DB_SYNCHRONOUS                  = "NORMAL"
+    DB_CACHE_SIZE                   = -4096       # In KiB when negative
+    DB_MMAP_SIZE                    = 32*1024*1024
+    DB_READER_POOL_SIZE             = 4
+
+    RPC_TIMEOUT                     = 30
+    RPC_STATE_CACHE_TTL             = 1.0
+    STATE_PUSH_TTL                  = 60
+    STATE_PUSH_QUEUE_MAX            = 256
+    STATE_PUSH_EXCLUDED             = ["service.heartbeat"]
+    RPC_INLINE_METHODS              = ["getstate", "getstate_batch", "setstate", "subscribe_state", "latest_telemetry", "get_rpc_stats", "invalidate_persistent"]
 
     SERVICE_JOB_INTERVAL            = 1
     PERIODIC_JOBS_INTERVAL          = 60
@@ -117,6 +175,14 @@ class SidebandCore():
     TELEMETRY_INTERVAL              = 60
     SERVICE_TELEMETRY_INTERVAL      = 300
     TELEMETRY_CLEAN_INTERVAL        = 3600
+    TELEMETRY_RESPONSE_BUCKET       = 300
+    TELEMETRY_RESPONSE_CACHE_TTL    = 30
+    TELEMETRY_RESPONSE_CACHE_SIZE   = 16
+    AUDIO_CACHE_SIZE                = 64*1024*1024
+    PERSISTENT_CACHE_SIZE           = 4096
+    PERSISTENT_TEMP_TTL             = 60*60*24*14
+    PERSISTENT_PURGE_INTERVAL       = 3600
+    PERSISTENT_PURGE_BATCH          = 1024
 
     IF_CHANGE_ANNOUNCE_MIN_INTERVAL = 3.5  # In seconds
     AUTO_ANNOUNCE_RANDOM_MIN        = 90   # In minutes
@@ -154,11 +220,42 @@ class SidebandCore():
         self.is_daemon = is_daemon
         self.ptt_player = None
         self.ptt_player_lock = threading.Lock()
+        self.audio_transcode_lock = threading.Lock()
+        self.audio_transcode_locks = {}
+        self.audio_pretranscode_queue = deque()
+        self.audio_pretranscode_condition = threading.Condition()
+        self.audio_pretranscode_worker = None
         self.last_msg_audio = None
         self.ui_recording = False
         self.db = None
         self.db_lock = threading.Lock()
 
+        # Received announces are collected here, keyed by destination,
+        # and written to the database in batches
+        self.pending_announces = OrderedDict()
+        self.announce_lock = threading.Lock()
+        self.announce_flush_scheduled = False
+        self.announce_flush_lock = threading.Lock()
+        self.announce_flush_stop = threading.Event()
+        self.announce_flush_thread = None
+        self.announce_search_available = None
+
+        # Unpacked persistent values are cached in memory, and writes
+        # go through the cache. When running as a client to the service,
+        # both processes write persistent values, so the client does not
+        # cache, and instead notifies the service of its own writes.
+        self.persistent_cache = OrderedDict()
+        self.persistent_cache_lock = threading.Lock()
+        self.persistent_cache_generation = 0
+        self.persistent_cache_enabled = not self.is_client
+        self.last_persistent_purge = 0
+        self.persistent_purge_stats = {"purges": 0, "purged": 0, "last_purged": 0, "last_duration": None}
+        self.db_readers = deque()
+        self.db_readers_lock = threading.Lock()
+        self.db_synchronous = SidebandCore.DB_SYNCHRONOUS
+        self.db_cache_size = SidebandCore.DB_CACHE_SIZE
+        self.db_mmap_size = SidebandCore.DB_MMAP_SIZE
+
         if not self.is_service and not self.is_client:
             self.is_standalone = True
         else:
@@ -178,6 +275,8 @@ class SidebandCore():
         self.latest_packed_telemetry = None
         self.telemetry_changes = 0
         self.telemetry_response_excluded = []
+        self.telemetry_response_cache = OrderedDict()
+        self.telemetry_response_lock = threading.Lock()
         self.pending_telemetry_send = False
         self.pending_telemetry_send_try = 0
         self.pending_telemetry_send_maxtries = 2
@@ -193,6 +292,17 @@ class SidebandCore():
         self.message_router = None
         self.rpc_connection = None
         self.rpc_lock = Lock()
+        self.rpc_request_id = 0
+        self.rpc_pending = {}
+        self.rpc_handlers = {}
+        self.rpc_stats = {}
+        self.rpc_stats_lock = Lock()
+        self.state_cache = {}
+        self.state_pushed = {}
+        self.state_seq = 0
+        self.state_subscribers = {}
+        self.state_subscriptions = set()
+        self.rpc_subscribers = {}
         self.service_stopped = False
         self.service_context = service_context
         self.owner_service = owner_service
@@ -568,18 +678,20 @@ class SidebandCore():
 
         self.__save_config(no_thread=True)
 
+    def map_tile_cache(self):
+        # Map tiles are stored in a single SQLite file in the map cache
+        # directory. The configured size limit is registered before the
+        # cache is opened, so it also applies when the map downloader
+        # opens the cache first.
+        from mapview.tilecache import TileCache
+        TileCache.configure(self.map_cache, self.config["map_cache_size"])
+        return TileCache.instance(self.map_cache)
+
     def clear_map_cache(self):
-        for entry in os.scandir(self.map_cache):
-            os.unlink(entry.path)
+        self.map_tile_cache().clear()
             
     def get_map_cache_size(self):
-        total = 0
-        for entry in os.scandir(self.map_cache):
-            if entry.is_dir(follow_symlinks=False):
-                pass
-            else:
-                total += entry.stat(follow_symlinks=False).st_size
-        return total
+        return self.map_tile_cache().size()
 
     def should_persist_data(self, background=False):
         if self.reticulum != None: self.reticulum._should_persist_data(background=background)
@@ -721,6 +833,7 @@ class SidebandCore():
         if not "telemetry_mqtt_user" in self.config:                   self.config["telemetry_mqtt_user"] = None
         if not "telemetry_mqtt_pass" in self.config:                   self.config["telemetry_mqtt_pass"] = None
         if not "telemetry_mqtt_validate_ssl" in self.config:           self.config["telemetry_mqtt_validate_ssl"] = False
+        if not "telemetry_mqtt_retain" in self.config:                 self.config["telemetry_mqtt_retain"] = False
 
         if not "telemetry_icon" in self.config:                        self.config["telemetry_icon"] = SidebandCore.DEFAULT_APPEARANCE[0]
         if not "telemetry_fg" in self.config:                          self.config["telemetry_fg"] = SidebandCore.DEFAULT_APPEARANCE[1]
@@ -770,6 +883,7 @@ class SidebandCore():
         
         if not "map_storage_path" in self.config:                      self.config["map_storage_path"] = None
         if not "map_storage_file" in self.config:                      self.config["map_storage_file"] = None
+        if not "map_cache_size" in self.config:                        self.config["map_cache_size"] = 256*1024*1024
 
         if not "voice_enabled" in self.config:                         self.config["voice_enabled"] = False
         if not "voice_output" in self.config:                          self.config["voice_output"] = None
@@ -787,6 +901,7 @@ class SidebandCore():
             self._db_upgradetables()
             self.__db_indices()
 
+        self._db_migrate()
         self.__load_telemetry_collector_excluded()
 
     def __reload_config(self):
@@ -907,6 +1022,10 @@ class SidebandCore():
 
     def reload_configuration(self):
         self.__reload_config()
+        if self.mqtt != None and not self.config["telemetry_to_mqtt"]:
+            with self.mqtt_handle_lock:
+                self.mqtt.stop()
+                self.mqtt = None
 
     def save_configuration(self):
         self.__save_config()
@@ -960,12 +1079,70 @@ class SidebandCore():
             if app_data == None: app_data = b""
             if type(app_data) != bytes: app_data = msgpack.packb([app_data, stamp_cost])
             RNS.log("Received "+str(dest_type)+" announce for "+RNS.prettyhexrep(dest), RNS.LOG_DEBUG)
-            self._db_save_announce(dest, app_data, dest_type, link_stats)
-            self.setstate("app.flags.new_announces", True)
+
+            hops = None
+            try:
+                if RNS.Transport.has_path(dest): hops = RNS.Transport.hops_to(dest)
+            except Exception as e:
+                RNS.log(f"Could not get hop count for announce from {RNS.prettyhexrep(dest)}: {e}", RNS.LOG_DEBUG)
+
+            with self.announce_lock:
+                # Only the latest announce per destination is kept, and
+                # since the directory is capped at MAX_ANNOUNCES entries,
+                # anything beyond that would be trimmed on flush anyway
+                self.pending_announces.pop(dest, None)
+                self.pending_announces[dest] = (time.time(), app_data, dest_type, stamp_cost, hops, link_stats)
+                while len(self.pending_announces) > self.MAX_ANNOUNCES:
+                    self.pending_announces.popitem(last=False)
+
+                if not self.announce_flush_scheduled and not self.announce_flush_stop.is_set():
+                    self.announce_flush_scheduled = True
+                    self.announce_flush_thread = threading.Thread(target=self.__announce_flush_job, daemon=True)
+                    self.announce_flush_thread.start()
 
         except Exception as e:
             RNS.log("Exception while decoding LXMF destination announce data:"+str(e))
 
+    def __announce_flush_job(self):
+        self.announce_flush_stop.wait(SidebandCore.ANNOUNCE_FLUSH_INTERVAL)
+        self.flush_announces()
+
+    def flush_announces(self):
+        # Writes any pending announces, and waits for a flush already
+        # in progress on another thread, so all announces logged before
+        # the call are in the database when it returns
+        try:
+            if self._db_save_announces() > 0:
+                self.setstate("app.flags.new_announces", True)
+
+        except Exception as e:
+            RNS.log(f"An error occurred while saving received announces: {e}", RNS.LOG_ERROR)
+            RNS.trace_exception(e)
+
+    def shutdown_database(self):
+        # Stops the announce flush job, writes any pending announces,
+        # and closes the pooled readers and the writer connection. The
+        # writer is closed while holding db_lock, so no write is in
+        # progress when it is closed
+        self.announce_flush_stop.set()
+        flush_thread = self.announce_flush_thread
+        if flush_thread != None and flush_thread != threading.current_thread():
+            flush_thread.join()
+
+        self.flush_announces()
+        with self.db_readers_lock:
+            while len(self.db_readers) > 0:
+                self.db_readers.pop().close()
+
+        with self.db_lock:
+            if self.db != None:
+                try:
+                    self.db.close()
+                except Exception as e:
+                    RNS.log(f"Error while closing database: {e}", RNS.LOG_ERROR)
+                    RNS.trace_exception(e)
+                self.db = None
+
     def list_conversations(self, conversations=True, objects=False):
         result = self._db_conversations(conversations, objects)
         if result != None:
@@ -974,12 +1151,25 @@ class SidebandCore():
             return []
 
     def list_announces(self):
+        self.flush_announces()
         result = self._db_announces()
         if result != None:
             return result
         else:
             return []
 
+    def list_announces_page(self, dest_type=None, max_hops=None, since=None, name_prefix=None, cursor=None, limit=None):
+        # Returns a page of announces following the cursor, ordered from
+        # newest to oldest, along with the cursor for the next page. The
+        # next cursor is None when there are no more matching announces.
+        self.flush_announces()
+        if limit == None: limit = SidebandCore.ANNOUNCES_PAGE_SIZE
+        announces = self._db_announces_page(dest_type=dest_type, max_hops=max_hops, since=since, name_prefix=name_prefix, cursor=cursor, limit=limit)
+        if len(announces) < limit: next_cursor = None
+        else: next_cursor = announces[-1]["cursor"]
+
+        return announces, next_cursor
+
     def has_conversation(self, context_dest):
         existing_conv = self._db_conversation(context_dest)
         if existing_conv != None:
@@ -1144,27 +1334,30 @@ class SidebandCore():
                 return SidebandCore.DEFAULT_APPEARANCE
         return appearance
 
+    def __conversation_display_name(self, context_dest, name, trust):
+        if name != None and name != "":
+            if trust == 1:
+                return name
+            else:
+                return name+" "+RNS.prettyhexrep(context_dest)
+
+        else:
+            app_data = RNS.Identity.recall_app_data(context_dest)
+            if app_data != None:
+                if trust == 1:
+                    return LXMF.display_name_from_app_data(app_data)
+                else:
+                    return LXMF.display_name_from_app_data(app_data)+" "+RNS.prettyhexrep(context_dest)
+            else:
+                return RNS.prettyhexrep(context_dest)
+
     def peer_display_name(self, context_dest):
         if context_dest == self.lxmf_destination.hash:
             return self.config["display_name"]
         try:
             existing_conv = self._db_conversation(context_dest)
             if existing_conv != None:
-                if existing_conv["name"] != None and existing_conv["name"] != "":
-                    if existing_conv["trust"] == 1:
-                        return existing_conv["name"]
-                    else:
-                        return existing_conv["name"]+" "+RNS.prettyhexrep(context_dest)
-
-                else:
-                    app_data = RNS.Identity.recall_app_data(context_dest)
-                    if app_data != None:
-                        if existing_conv["trust"] == 1:
-                            return LXMF.display_name_from_app_data(app_data)
-                        else:
-                            return LXMF.display_name_from_app_data(app_data)+" "+RNS.prettyhexrep(context_dest)
-                    else:
-                        return RNS.prettyhexrep(context_dest)
+                return self.__conversation_display_name(context_dest, existing_conv["name"], existing_conv["trust"])
             else:
                 app_data = RNS.Identity.recall_app_data(context_dest)
                 if app_data != None:
@@ -1212,6 +1405,13 @@ class SidebandCore():
     def delete_message(self, message_hash):
         self._db_delete_message(message_hash)
 
+    def save_message_renders(self, renders):
+        try:
+            self._db_save_message_renders(renders)
+        except Exception as e:
+            RNS.log(f"Could not save rendered message markup: {e}", RNS.LOG_ERROR)
+            RNS.trace_exception(e)
+
     def read_conversation(self, context_dest):
         self._db_conversation_set_unread(context_dest, False)
 
@@ -1542,6 +1742,40 @@ class SidebandCore():
     def list_telemetry(self, context_dest = None, after = None, before = None, limit = None):
         return self._db_telemetry(context_dest = context_dest, after = after, before = before, limit = limit) or []
 
+    def list_latest_locations(self, after = None):
+        try:
+            return self._db_latest_locations(after = after)
+        except Exception as e:
+            RNS.log("An error occurred while retrieving locations from the database: "+str(e), RNS.LOG_ERROR)
+            return {}
+
+    def list_location_changes(self, cursor = None, after = None):
+        # Returns the latest located fix for each source that has
+        # received telemetry since the cursor was obtained, along with
+        # the next cursor, and whether the result is complete. When no
+        # cursor is given, or telemetry has been removed or the trust of
+        # a conversation has changed since, the result contains all
+        # sources, and is flagged as complete.
+        try:
+            flags = self.getstate_many(["app.flags.telemetry_cleared", "app.flags.trust_changed"]) or {}
+            cleared = flags.get("app.flags.telemetry_cleared") or 0
+            trust_changed = flags.get("app.flags.trust_changed") or 0
+            with self.__db_read() as db:
+                dbc = db.cursor()
+                dbc.execute("select max(id) from telemetry")
+                last_id = dbc.fetchone()[0] or 0
+
+            if cursor == None or last_id < cursor[0] or cleared != cursor[1] or trust_changed != cursor[2]:
+                return (last_id, cleared, trust_changed), self._db_latest_locations(after=after), True
+            elif last_id == cursor[0]:
+                return cursor, {}, False
+            else:
+                return (last_id, cleared, trust_changed), self._db_latest_locations(after=after, after_id=cursor[0]), False
+
+        except Exception as e:
+            RNS.log("An error occurred while retrieving location changes from the database: "+str(e), RNS.LOG_ERROR)
+            return cursor, {}, False
+
     def peer_telemetry(self, context_dest, after = None, before = None, limit = None):
         if context_dest == self.lxmf_destination.hash and limit == 1:
             try:
@@ -1585,18 +1819,13 @@ class SidebandCore():
             except Exception as e:
                 RNS.log("Error while getting own location: "+str(e), RNS.LOG_ERROR)
 
-        after_time = time.time()-3*30*24*60*60
-        pts = self.peer_telemetry(context_dest, after=after_time)
-        for pt in pts:
-            try:
-                t = Telemeter.from_packed(pt[1]).read_all()
-                if "location" in t and t["location"] != None:
-                    l = t["location"]
-                    if "latitude" in l and "longitude" in l:
-                        if l["latitude"] != None and l["longitude"] != None:
-                            return l
-            except:
-                pass
+        try:
+            after_time = time.time()-3*30*24*60*60
+            latest = self._db_latest_locations(context_dest, after=after_time)
+            if context_dest in latest:
+                return Telemeter.peek_location(latest[context_dest][1]) or latest[context_dest][2]
+        except Exception as e:
+            RNS.log(f"Error while getting location for {RNS.prettyhexrep(context_dest)}: {e}", RNS.LOG_ERROR)
 
         return None
 
@@ -1607,10 +1836,20 @@ class SidebandCore():
         else:
             return []
 
+    def list_messages_page(self, context_dest, cursor = None, limit = None):
+        # Returns a page of messages preceding the cursor, ordered from
+        # oldest to newest, along with the cursor for the next page. The
+        # next cursor is None when there are no earlier messages.
+        messages = self._db_messages_page(context_dest, cursor=cursor, limit=limit)
+        if limit == None: limit = SidebandCore.MESSAGES_PAGE_SIZE
+        if len(messages) < limit: next_cursor = None
+        else: next_cursor = (messages[0]["received"], messages[0]["hash"])
+        return messages, next_cursor
+
     def service_available(self):
         heartbeat_stale_time = 7.5
         now = time.time()
-        service_heartbeat = self.getstate("service.heartbeat")
+        service_heartbeat = self.getstate("service.heartbeat", allow_cache=True)
         if not service_heartbeat:
             RNS.log("No service heartbeat available at "+str(now), RNS.LOG_DEBUG)
             return False
@@ -1646,28 +1885,144 @@ class SidebandCore():
         return self.getstate("voice.running")
 
     def setstate(self, prop, val):
+        if not RNS.vendor.platformutils.is_android() or self.is_service:
+            with self.state_lock:
+                if self.service_stopped:
+                    return None
+                changed = not prop in self.state_db or self.state_db[prop] != val
+                self.state_db[prop] = val
+
+                # Changes are queued for RPC subscribers while holding
+                # state_lock, so they are pushed in the order they were
+                # made, and tagged with a sequence number
+                if changed:
+                    self.state_seq += 1
+                    self.__state_enqueue(prop, val, self.state_seq)
+
+            if changed:
+                self.__state_changed(prop, val)
+            return True
+
+        if not self.service_stopped:
+            with self.state_lock:
+                self.state_cache.pop(prop, None)
+                self.state_pushed.pop(prop, None)
+
+            def set():
+                return self.service_rpc_request({"setstate": (prop, val)})
+
+            try:
+                set()
+            except Exception as e:
+                RNS.log("Error while setting state over RPC: "+str(e)+". Retrying once.", RNS.LOG_DEBUG)
+                try:
+                    set()
+                except Exception as e:
+                    RNS.log("Error on retry as well: "+str(e)+". Giving up.", RNS.LOG_DEBUG)
+                    return False
+
+    def subscribe_state(self, props, callback = None):
+        # Registers a callback that is called with the property and its
+        # new value whenever one of the properties changes. On the UI
+        # client, the service pushes changes over the RPC connection,
+        # and pushed values are used to answer getstate calls with
+        # allow_cache set, without a round trip, for up to
+        # STATE_PUSH_TTL seconds. Properties in STATE_PUSH_EXCLUDED are
+        # never pushed, and are always retrieved over RPC.
         with self.state_lock:
-            if not self.service_stopped:
-                if not RNS.vendor.platformutils.is_android():
-                    self.state_db[prop] = val
-                    return True
+            for prop in props:
+                if callback != None:
+                    if not prop in self.state_subscribers: self.state_subscribers[prop] = []
+                    self.state_subscribers[prop].append(callback)
+
+        if RNS.vendor.platformutils.is_android() and not self.is_service:
+            new_props = [prop for prop in props if not prop in self.state_subscriptions]
+            self.state_subscriptions.update(new_props)
+            if len(new_props) > 0:
+                update = self.service_rpc_request({"subscribe_state": new_props})
+                if update != None: self.__state_pushed(update)
+
+    def __state_changed(self, prop, val):
+        with self.state_lock:
+            callbacks = list(self.state_subscribers.get(prop, []))
+        for callback in callbacks:
+            try: callback(prop, val)
+            except Exception as e:
+                RNS.log(f"Error in state change callback for {prop}: {e}", RNS.LOG_ERROR)
+                RNS.trace_exception(e)
+
+    def __state_enqueue(self, prop, val, seq):
+        # Must be called while holding state_lock. Queued changes are
+        # coalesced per property, so a subscriber that falls behind only
+        # receives the latest value of each. If a queue still grows past
+        # STATE_PUSH_QUEUE_MAX, the oldest changes are dropped, and the
+        # client falls back to RPC once its pushed values expire.
+        for subscriber in self.rpc_subscribers.values():
+            if prop in subscriber["props"]:
+                with subscriber["condition"]:
+                    queue = subscriber["queue"]
+                    queue.pop(prop, None)
+                    queue[prop] = (val, seq)
+                    while len(queue) > SidebandCore.STATE_PUSH_QUEUE_MAX:
+                        queue.popitem(last=False)
+                        subscriber["dropped"] += 1
+                    subscriber["condition"].notify()
+
+    def __state_sender(self, connection, subscriber):
+        # Sends queued state changes to a single RPC subscriber. Sending
+        # happens only on this thread, so a client that stops reading
+        # holds up its own updates, and nothing else.
+        try:
+            while True:
+                with subscriber["condition"]:
+                    while subscriber["active"] and len(subscriber["queue"]) == 0:
+                        subscriber["condition"].wait()
+                    if not subscriber["active"]:
+                        break
+                    queued = subscriber["queue"]
+                    subscriber["queue"] = OrderedDict()
+
+                values = {prop: val for prop, (val, seq) in queued.items()}
+                seq = max(seq for val, seq in queued.values())
+                with subscriber["send_lock"]:
+                    connection.send({"event": "state", "values": values, "seq": seq})
+
+        except Exception as e:
+            RNS.log(f"Could not push state changes to RPC client, removing subscription: {e}", RNS.LOG_DEBUG)
+            self.__rpc_unsubscribe(connection)
+
+    def __state_pushed(self, update):
+        # Handles state values pushed by the service, and notifies local
+        # subscribers of values that changed. Values older than the ones
+        # already received are ignored.
+        changed = []
+        now = time.time()
+        seq = update["seq"]
+        values = update["values"]
+        with self.state_lock:
+            for prop in values:
+                if prop in self.state_pushed:
+                    pushed_val, pushed_seq, received = self.state_pushed[prop]
+                    if pushed_seq > seq:
+                        continue
+                    if pushed_val != values[prop]:
+                        changed.append(prop)
                 else:
-                    if self.is_service:
-                        self.state_db[prop] = val
-                        return True
-                    else:
-                        def set():
-                            return self.service_rpc_request({"setstate": (prop, val)})
+                    changed.append(prop)
+                self.state_pushed[prop] = (values[prop], seq, now)
 
-                        try:
-                            set()
-                        except Exception as e:
-                            RNS.log("Error while setting state over RPC: "+str(e)+". Retrying once.", RNS.LOG_DEBUG)
-                            try:
-                                set()
-                            except Exception as e:
-                                RNS.log("Error on retry as well: "+str(e)+". Giving up.", RNS.LOG_DEBUG)
-                                return False
+        for prop in changed:
+            self.__state_changed(prop, values[prop])
+
+    def __state_pushed_value(self, prop):
+        # Must be called while holding state_lock. Returns the pushed
+        # entry for a property, if it is recent enough to be used.
+        if prop in self.state_pushed:
+            entry = self.state_pushed[prop]
+            if time.time() - entry[2] < SidebandCore.STATE_PUSH_TTL:
+                return entry
+
+        return None
 
     def service_set_latest_telemetry(self, latest_telemetry, latest_packed_telemetry):
         if not RNS.vendor.platformutils.is_android():
@@ -1716,44 +2071,196 @@ class SidebandCore():
                     return False
 
     def service_rpc_request(self, request):
+        # Requests are tagged with an ID and sent over a shared
+        # connection, so several requests can be in flight at once.
+        # Responses are matched to requests by the connection reader.
         # RNS.log("Running service RPC call: "+str(request), RNS.LOG_DEBUG)
+        started = time.time()
+        connection = None
         try:
-            with self.rpc_lock:
-                if self.rpc_connection == None:
-                    self.rpc_connection = multiprocessing.connection.Client(self.rpc_addr, family="AF_UNIX", authkey=self.rpc_key)
-                self.rpc_connection.send(request)
-                response = self.rpc_connection.recv()
-                return response
+            pending = self.__rpc_submit(request)
+            connection = pending["connection"]
+            if not pending["event"].wait(SidebandCore.RPC_TIMEOUT):
+                with self.rpc_lock: self.rpc_pending.pop(pending["id"], None)
+                raise TimeoutError("No response from service within "+RNS.prettytime(SidebandCore.RPC_TIMEOUT))
+            if "error" in pending:
+                raise pending["error"]
+
+            self.__rpc_record(self.__rpc_method(request), time.time()-started)
+            return pending["result"]
 
         except Exception as e:
             if not type(e) == ConnectionRefusedError:
-                self.rpc_connection = None
+                self.reset_rpc_connection(connection)
                 RNS.log(f"An error occurred while executing the service RPC request: {request}", RNS.LOG_ERROR)
                 RNS.log(f"The contained exception was: {e}", RNS.LOG_ERROR)
 
-    def getstate(self, prop, allow_cache=False):
-        with self.state_lock:
-            if not self.service_stopped:
+    def reset_rpc_connection(self, connection = None):
+        # Closes the client RPC connection, so the next request opens a
+        # new one. If a connection is specified, it is only reset if it
+        # is still the current one, so a connection that another thread
+        # has just opened is left alone.
+        with self.rpc_lock:
+            if self.rpc_connection != None and (connection == None or self.rpc_connection == connection):
+                try: self.rpc_connection.close()
+                except: pass
+                self.rpc_connection = None
+
+    def __rpc_submit(self, request):
+        with self.rpc_lock:
+            if self.rpc_connection == None:
+                self.rpc_connection = multiprocessing.connection.Client(self.rpc_addr, family="AF_UNIX", authkey=self.rpc_key)
+                threading.Thread(target=self.__rpc_client_reader, args=(self.rpc_connection,), daemon=True).start()
+
+                # State subscriptions belong to a connection, so they
+                # are renewed whenever a new connection is established
+                if len(self.state_subscriptions) > 0 and not "subscribe_state" in request:
+                    renewal = self.__rpc_send({"subscribe_state": list(self.state_subscriptions)})
+                    renewal["on_result"] = self.__state_pushed
+
+            return self.__rpc_send(request)
+
+    def __rpc_send(self, request):
+        # Must be called while holding rpc_lock
+        self.rpc_request_id += 1
+        pending = {"id": self.rpc_request_id, "event": threading.Event(), "connection": self.rpc_connection}
+        self.rpc_pending[pending["id"]] = pending
+        try:
+            self.rpc_connection.send({"id": pending["id"], "call": request})
+        except Exception as e:
+            self.rpc_pending.pop(pending["id"], None)
+            raise e
 
-                if not RNS.vendor.platformutils.is_android():
+        return pending
+
+    def __rpc_client_reader(self, connection):
+        try:
+            while True:
+                response = connection.recv()
+                if "event" in response:
+                    if response["event"] == "state": self.__state_pushed(response)
+                    continue
+
+                with self.rpc_lock:
+                    pending = self.rpc_pending.pop(response["id"], None)
+                if pending != None:
+                    pending["result"] = response["result"]
+                    if "on_result" in pending and pending["result"] != None:
+                        pending["on_result"](pending["result"])
+                    pending["event"].set()
+
+        except Exception as e:
+            # Pushed values can no longer be relied on, so state is
+            # retrieved over RPC again until subscriptions are renewed
+            with self.state_lock:
+                self.state_pushed.clear()
+            with self.rpc_lock:
+                if self.rpc_connection == connection:
+                    self.rpc_connection = None
+                failed = [p for p in self.rpc_pending.values() if p["connection"] == connection]
+                for pending in failed:
+                    self.rpc_pending.pop(pending["id"], None)
+                    pending["error"] = ConnectionError(f"RPC connection lost: {e}")
+                    pending["event"].set()
+
+    def __rpc_method(self, call):
+        for key in call:
+            if key in self.rpc_handlers:
+                return key
+        return next(iter(call), None)
+
+    def __rpc_record(self, method, duration):
+        # Per-method call counts and latencies. On the UI client, these
+        # measure complete round trips, and on the service, the time
+        # spent in handlers.
+        with self.rpc_stats_lock:
+            if not method in self.rpc_stats:
+                self.rpc_stats[method] = {"calls": 0, "total": 0.0, "max": 0.0}
+            stats = self.rpc_stats[method]
+            stats["calls"] += 1
+            stats["total"] += duration
+            if duration > stats["max"]: stats["max"] = duration
+
+    def _get_rpc_stats(self):
+        with self.rpc_stats_lock:
+            return {method: dict(stats) for method, stats in self.rpc_stats.items()}
+
+    def get_rpc_stats(self):
+        stats = {"local": self._get_rpc_stats(), "service": None}
+        if RNS.vendor.platformutils.is_android() and not self.is_service:
+            stats["service"] = self.service_rpc_request({"get_rpc_stats": True})
+        return stats
+
+    def getstate(self, prop, allow_cache=False):
+        if not RNS.vendor.platformutils.is_android() or self.is_service:
+            with self.state_lock:
+                if not self.service_stopped:
                     if prop in self.state_db:
                         return self.state_db[prop]
                     else:
                         return None
-                else:
-                    if self.is_service:
-                        if prop in self.state_db:
-                            return self.state_db[prop]
-                        else:
-                            return None
-                    else:
-                        try:
-                            return self.service_rpc_request({"getstate": prop})
 
-                        except Exception as e:
-                            RNS.log("Error while retrieving state "+str(prop)+" over RPC: "+str(e), RNS.LOG_DEBUG)
-                            self.rpc_connection = None
-                            return None
+        elif not self.service_stopped:
+            pushed = None
+            if allow_cache:
+                with self.state_lock:
+                    pushed = self.state_pushed.get(prop)
+                    if self.__state_pushed_value(prop) != None:
+                        return pushed[0]
+                    if prop in self.state_cache:
+                        value, fetched = self.state_cache[prop]
+                        if time.time() - fetched < SidebandCore.RPC_STATE_CACHE_TTL:
+                            return value
+
+            try:
+                value = self.service_rpc_request({"getstate": prop})
+
+                # An expired pushed value is renewed with the retrieved
+                # one, unless a newer value was pushed in the meantime
+                if pushed != None:
+                    with self.state_lock:
+                        if self.state_pushed.get(prop) is pushed:
+                            self.state_pushed[prop] = (value, pushed[1], time.time())
+
+                return value
+
+            except Exception as e:
+                RNS.log("Error while retrieving state "+str(prop)+" over RPC: "+str(e), RNS.LOG_DEBUG)
+                self.reset_rpc_connection()
+                return None
+
+    def _getstate_many(self, props):
+        with self.state_lock:
+            return {prop: self.state_db[prop] if prop in self.state_db else None for prop in props}
+
+    def getstate_many(self, props):
+        # Retrieves several state values in a single RPC round trip. On
+        # the UI client, the values are also cached, so that subsequent
+        # getstate calls with allow_cache set can be served locally.
+        if not RNS.vendor.platformutils.is_android() or self.is_service:
+            return self._getstate_many(props)
+
+        elif not self.service_stopped:
+            with self.state_lock:
+                pushed = {}
+                for prop in props:
+                    entry = self.__state_pushed_value(prop)
+                    if entry != None: pushed[prop] = entry[0]
+            remaining = [prop for prop in props if not prop in pushed]
+            if len(remaining) == 0:
+                return pushed
+
+            values = self.service_rpc_request({"getstate_batch": remaining})
+            if values == None:
+                values = {prop: None for prop in remaining}
+            else:
+                now = time.time()
+                with self.state_lock:
+                    for prop in values:
+                        self.state_cache[prop] = (values[prop], now)
+
+            values.update(pushed)
+            return values
 
     def _get_plugins_info(self):
         np = 0
@@ -1939,134 +2446,274 @@ class SidebandCore():
                 RNS.log("Ready for next RPC client", RNS.LOG_DEBUG)
                 rpc_connection = self.rpc_listener.accept()
                 RNS.log("Accepted RPC client", RNS.LOG_DEBUG)
-                
-                def job_factory(connection):
-                    def rpc_client_job():
-                        try:
-                            while connection:
-                                call = connection.recv()
-                                if "getstate" in call:
-                                    prop = call["getstate"]
-                                    connection.send(self.getstate(prop))
-                                elif "setstate" in call:
-                                    prop, val = call["setstate"]
-                                    connection.send(self.setstate(prop, val))
-                                elif "latest_telemetry" in call:
-                                    t,p = call["latest_telemetry"]
-                                    self.latest_telemetry = t
-                                    self.latest_packed_telemetry = p
-                                    connection.send(True)
-                                elif "set_debug" in call:
-                                    self.service_rpc_set_debug(call["set_debug"])
-                                    connection.send(True)
-                                elif "set_ui_recording" in call:
-                                    self.service_rpc_set_ui_recording(call["set_ui_recording"])
-                                    connection.send(True)
-                                elif "send_message" in call:
-                                    args = call["send_message"]
-                                    send_result = self.send_message(
-                                        args["content"],
-                                        args["destination_hash"],
-                                        args["propagation"],
-                                        skip_fields=args["skip_fields"],
-                                        no_display=args["no_display"],
-                                        attachment=args["attachment"],
-                                        image=args["image"],
-                                        audio=args["audio"])
-                                    connection.send(send_result)
-                                elif "cancel_message" in call:
-                                    args = call["cancel_message"]
-                                    cancel_result = self.cancel_message(args["message_id"])
-                                    connection.send(cancel_result)
-                                elif "send_command" in call:
-                                    args = call["send_command"]
-                                    send_result = self.send_command(
-                                        args["content"],
-                                        args["destination_hash"],
-                                        args["propagation"])
-                                    connection.send(send_result)
-                                elif "request_latest_telemetry" in call:
-                                    args = call["request_latest_telemetry"]
-                                    send_result = self.request_latest_telemetry(args["from_addr"], is_collector_request=args["is_collector_request"])
-                                    connection.send(send_result)
-                                elif "send_latest_telemetry" in call:
-                                    args = call["send_latest_telemetry"]
-                                    send_result = self.send_latest_telemetry(
-                                        to_addr=args["to_addr"],
-                                        stream=args["stream"],
-                                        is_authorized_telemetry_request=args["is_authorized_telemetry_request"]
-                                    )
-                                    connection.send(send_result)
-                                elif "get_plugins_info" in call: connection.send(self._get_plugins_info())
-                                elif "get_destination_establishment_rate" in call: connection.send(self._get_destination_establishment_rate(call["get_destination_establishment_rate"]))
-                                elif "get_destination_mtu" in call:                connection.send(self._get_destination_mtu(call["get_destination_mtu"]))
-                                elif "get_destination_edr" in call:                connection.send(self._get_destination_edr(call["get_destination_edr"]))
-                                elif "get_destination_lmd" in call:                connection.send(self._get_destination_lmd(call["get_destination_lmd"]))
-                                elif "get_lxm_progress" in call:                   connection.send(self.get_lxm_progress(call["get_lxm_progress"]["lxm_hash"]))
-                                elif "get_lxm_stamp_cost" in call:                 connection.send(self.get_lxm_stamp_cost(call["get_lxm_stamp_cost"]["lxm_hash"]))
-                                elif "get_lxm_propagation_cost" in call:           connection.send(self.get_lxm_propagation_cost(call["get_lxm_propagation_cost"]["lxm_hash"]))
-                                elif "is_tracking" in call:                        connection.send(self.is_tracking(call["is_tracking"]))
-                                elif "start_tracking" in call:                     connection.send(self.start_tracking(object_addr=call["start_tracking"]["object_addr"], interval=call["start_tracking"]["interval"], duration=call["start_tracking"]["duration"]))
-                                elif "stop_tracking" in call:                      connection.send(self.stop_tracking(object_addr=call["stop_tracking"]["object_addr"]))
-                                elif "get_service_log" in call:                    connection.send(self.get_service_log())
-                                elif "start_voice" in call:                        connection.send(self.start_voice())
-                                elif "stop_voice" in call:                         connection.send(self.stop_voice())
-                                elif "telephone_is_available" in call:             connection.send(self.telephone.is_available if self.telephone else False)
-                                elif "telephone_is_in_call" in call:               connection.send(self.telephone.is_in_call if self.telephone else False)
-                                elif "telephone_call_is_connecting" in call:       connection.send(self.telephone.call_is_connecting if self.telephone else False)
-                                elif "telephone_is_ringing" in call:               connection.send(self.telephone.is_ringing if self.telephone else False)
-                                elif "telephone_caller_info" in call:              connection.send(self.telephone.caller.hash if self.telephone and self.telephone.caller else None)
-                                elif "telephone_active_profile" in call:           connection.send(self.telephone.active_profile if self.telephone else None)
-                                elif "telephone_set_busy" in call:                 connection.send(self.telephone.set_busy(call["telephone_set_busy"]) if self.telephone else False)
-                                elif "telephone_dial" in call:                     connection.send(self.telephone.dial(call["telephone_dial"], profile=call["profile"]) if self.telephone else False)
-                                elif "telephone_hangup" in call:                   connection.send(self.telephone.hangup() if self.telephone else False)
-                                elif "telephone_answer" in call:                   connection.send(self.telephone.answer() if self.telephone else False)
-                                elif "telephone_set_speaker" in call:              connection.send(self.telephone.set_speaker(call["telephone_set_speaker"]) if self.telephone else False)
-                                elif "telephone_set_microphone" in call:           connection.send(self.telephone.set_microphone(call["telephone_set_microphone"]) if self.telephone else False)
-                                elif "telephone_set_ringer" in call:               connection.send(self.telephone.set_ringer(call["telephone_set_ringer"]) if self.telephone else False)
-                                elif "telephone_set_low_latency_output" in call:   connection.send(self.telephone.set_low_latency_output(call["telephone_set_low_latency_output"]) if self.telephone else False)
-                                elif "telephone_announce" in call:                 connection.send(self.telephone.announce() if self.telephone else False)
-                                elif "telephone_get_call_log" in call:             connection.send(self.telephone.get_call_log() if self.telephone else [])
-                                elif "telephone_clear_call_log" in call:           connection.send(self.telephone.clear_call_log() if self.telephone else False)
-                                elif "telephone_switch_profile" in call:           connection.send(self.telephone.switch_profile(call["telephone_switch_profile"]) if self.telephone else False)
-                                else:
-                                    connection.send(None)
+                threading.Thread(target=self.__rpc_serve, args=(rpc_connection,), daemon=True).start()
 
-                        except Exception as e:
-                            RNS.log("Error on client RPC connection: "+str(e), RNS.LOG_ERROR)
-                            RNS.trace_exception(e)
-                            try: connection.close()
-                            except: pass
+            except Exception as e:
+                RNS.log("An error ocurred while handling RPC call from local client: "+str(e), RNS.LOG_ERROR)
 
-                    return rpc_client_job
+    def __rpc_serve(self, connection):
+        # Requests tagged with an ID are answered with that ID. Calls
+        # that only touch in-memory state are handled in order on this
+        # thread, while everything else runs on its own thread, so a
+        # slow call does not hold up other requests on the connection.
+        # Untagged requests are answered in order, as before.
+        send_lock = threading.Lock()
+        def respond(request_id, call):
+            if "subscribe_state" in call:
+                result = self.__rpc_subscribe(connection, send_lock, call["subscribe_state"])
+            else:
+                result = self.__rpc_dispatch(call)
+            with send_lock:
+                connection.send({"id": request_id, "result": result})
 
-                threading.Thread(target=job_factory(rpc_connection), daemon=True).start()
+        try:
+            while connection:
+                request = connection.recv()
+                if "id" in request and "call" in request:
+                    if self.__rpc_method(request["call"]) in SidebandCore.RPC_INLINE_METHODS:
+                        respond(request["id"], request["call"])
+                    else:
+                        threading.Thread(target=respond, args=(request["id"], request["call"]), daemon=True).start()
+                else:
+                    result = self.__rpc_dispatch(request)
+                    with send_lock:
+                        connection.send(result)
 
-            except Exception as e:
-                RNS.log("An error ocurred while handling RPC call from local client: "+str(e), RNS.LOG_ERROR)
+        except Exception as e:
+            if not isinstance(e, EOFError):
+                RNS.log("Error on client RPC connection: "+str(e), RNS.LOG_ERROR)
+                RNS.trace_exception(e)
+            self.__rpc_unsubscribe(connection)
+            try: connection.close()
+            except: pass
+
+    def __rpc_subscribe(self, connection, send_lock, props):
+        # Registers the connection for pushed state changes, and returns
+        # the current values of the subscribed properties, along with
+        # the sequence number they correspond to
+        props = [prop for prop in props if not prop in SidebandCore.STATE_PUSH_EXCLUDED]
+        with self.state_lock:
+            if not connection in self.rpc_subscribers:
+                subscriber = {"props": set(), "send_lock": send_lock, "queue": OrderedDict(),
+                              "condition": threading.Condition(), "active": True, "dropped": 0}
+                self.rpc_subscribers[connection] = subscriber
+                threading.Thread(target=self.__state_sender, args=(connection, subscriber), daemon=True).start()
+
+            self.rpc_subscribers[connection]["props"].update(props)
+            values = {prop: self.state_db[prop] if prop in self.state_db else None for prop in props}
+            return {"values": values, "seq": self.state_seq}
+
+    def __rpc_unsubscribe(self, connection):
+        with self.state_lock:
+            subscriber = self.rpc_subscribers.pop(connection, None)
+        if subscriber != None:
+            with subscriber["condition"]:
+                subscriber["active"] = False
+                subscriber["condition"].notify()
+
+    def __rpc_dispatch(self, call):
+        method = self.__rpc_method(call)
+        if not method in self.rpc_handlers:
+            return None
+
+        started = time.time()
+        try:
+            return self.rpc_handlers[method](call)
+        except Exception as e:
+            RNS.log(f"Error while handling RPC call {method}: {e}", RNS.LOG_ERROR)
+            RNS.trace_exception(e)
+            return None
+        finally:
+            self.__rpc_record(method, time.time()-started)
+
+    def register_rpc_handler(self, method, handler):
+        # Handlers receive the complete call dict, and their return
+        # value is sent back to the client
+        self.rpc_handlers[method] = handler
 
+    def __init_rpc_handlers(self):
+        def set_latest_telemetry(call):
+            self.latest_telemetry, self.latest_packed_telemetry = call["latest_telemetry"]
+            return True
+
+        def set_debug(call):
+            self.service_rpc_set_debug(call["set_debug"])
+            return True
 
-    def setpersistent(self, prop, val):
-        self._db_setpersistent(prop, val)
-        # def cb():
-        #     self._db_setpersistent(prop, val)
-        # threading.Thread(target=cb, daemon=True).start()
+        def set_ui_recording(call):
+            self.service_rpc_set_ui_recording(call["set_ui_recording"])
+            return True
+
+        def send_message(call):
+            args = call["send_message"]
+            return self.send_message(
+                args["content"],
+                args["destination_hash"],
+                args["propagation"],
+                skip_fields=args["skip_fields"],
+                no_display=args["no_display"],
+                attachment=args["attachment"],
+                image=args["image"],
+                audio=args["audio"])
+
+        def send_latest_telemetry(call):
+            args = call["send_latest_telemetry"]
+            return self.send_latest_telemetry(
+                to_addr=args["to_addr"],
+                stream=args["stream"],
+                is_authorized_telemetry_request=args["is_authorized_telemetry_request"])
+
+        def telephone(action, default=False):
+            def handler(call):
+                if self.telephone: return action(call)
+                else: return default
+            return handler
+
+        r = self.register_rpc_handler
+        r("getstate",                           lambda c: self.getstate(c["getstate"]))
+        r("getstate_batch",                     lambda c: self._getstate_many(c["getstate_batch"]))
+        r("setstate",                           lambda c: self.setstate(*c["setstate"]))
+        r("latest_telemetry",                   set_latest_telemetry)
+        r("set_debug",                          set_debug)
+        r("set_ui_recording",                   set_ui_recording)
+        r("send_message",                       send_message)
+        r("cancel_message",                     lambda c: self.cancel_message(c["cancel_message"]["message_id"]))
+        r("send_command",                       lambda c: self.send_command(c["send_command"]["content"], c["send_command"]["destination_hash"], c["send_command"]["propagation"]))
+        r("request_latest_telemetry",           lambda c: self.request_latest_telemetry(c["request_latest_telemetry"]["from_addr"], is_collector_request=c["request_latest_telemetry"]["is_collector_request"]))
+        r("send_latest_telemetry",              send_latest_telemetry)
+        r("get_plugins_info",                   lambda c: self._get_plugins_info())
+        r("get_rpc_stats",                      lambda c: self._get_rpc_stats())
+        r("invalidate_persistent",              lambda c: self.__persistent_invalidate(c["invalidate_persistent"]))
+        r("get_persistent_stats",               lambda c: self._get_persistent_stats())
+        r("get_destination_establishment_rate", lambda c: self._get_destination_establishment_rate(c["get_destination_establishment_rate"]))
+        r("get_destination_mtu",                lambda c: self._get_destination_mtu(c["get_destination_mtu"]))
+        r("get_destination_edr",                lambda c: self._get_destination_edr(c["get_destination_edr"]))
+        r("get_destination_lmd",                lambda c: self._get_destination_lmd(c["get_destination_lmd"]))
+        r("get_lxm_progress",                   lambda c: self.get_lxm_progress(c["get_lxm_progress"]["lxm_hash"]))
+        r("get_lxm_stamp_cost",                 lambda c: self.get_lxm_stamp_cost(c["get_lxm_stamp_cost"]["lxm_hash"]))
+        r("get_lxm_propagation_cost",           lambda c: self.get_lxm_propagation_cost(c["get_lxm_propagation_cost"]["lxm_hash"]))
+        r("is_tracking",                        lambda c: self.is_tracking(c["is_tracking"]))
+        r("start_tracking",                     lambda c: self.start_tracking(object_addr=c["start_tracking"]["object_addr"], interval=c["start_tracking"]["interval"], duration=c["start_tracking"]["duration"]))
+        r("stop_tracking",                      lambda c: self.stop_tracking(object_addr=c["stop_tracking"]["object_addr"]))
+        r("get_service_log",                    lambda c: self.get_service_log())
+        r("start_voice",                        lambda c: self.start_voice())
+        r("stop_voice",                         lambda c: self.stop_voice())
+        r("telephone_is_available",             telephone(lambda c: self.telephone.is_available))
+        r("telephone_is_in_call",               telephone(lambda c: self.telephone.is_in_call))
+        r("telephone_call_is_connecting",       telephone(lambda c: self.telephone.call_is_connecting))
+        r("telephone_is_ringing",               telephone(lambda c: self.telephone.is_ringing))
+        r("telephone_caller_info",              telephone(lambda c: self.telephone.caller.hash if self.telephone.caller else None, default=None))
+        r("telephone_active_profile",           telephone(lambda c: self.telephone.active_profile, default=None))
+        r("telephone_set_busy",                 telephone(lambda c: self.telephone.set_busy(c["telephone_set_busy"])))
+        r("telephone_dial",                     telephone(lambda c: self.telephone.dial(c["telephone_dial"], profile=c["profile"])))
+        r("telephone_hangup",                   telephone(lambda c: self.telephone.hangup()))
+        r("telephone_answer",                   telephone(lambda c: self.telephone.answer()))
+        r("telephone_set_speaker",              telephone(lambda c: self.telephone.set_speaker(c["telephone_set_speaker"])))
+        r("telephone_set_microphone",           telephone(lambda c: self.telephone.set_microphone(c["telephone_set_microphone"])))
+        r("telephone_set_ringer",               telephone(lambda c: self.telephone.set_ringer(c["telephone_set_ringer"])))
+        r("telephone_set_low_latency_output",   telephone(lambda c: self.telephone.set_low_latency_output(c["telephone_set_low_latency_output"])))
+        r("telephone_announce",                 telephone(lambda c: self.telephone.announce()))
+        r("telephone_get_call_log",             telephone(lambda c: self.telephone.get_call_log(), default=[]))
+        r("telephone_clear_call_log",           telephone(lambda c: self.telephone.clear_call_log()))
+        r("telephone_switch_profile",           telephone(lambda c: self.telephone.switch_profile(c["telephone_switch_profile"])))
+
+    def setpersistent(self, prop, val, ttl=None):
+        # Values set with a TTL expire after that many seconds. Values
+        # under the "temp." prefix expire after PERSISTENT_TEMP_TTL,
+        # unless another TTL is specified.
+        self._db_setpersistent(prop, val, ttl=ttl)
 
     def getpersistent(self, prop):
         return self._db_getpersistent(prop)
 
+    def setpersistent_many(self, values, ttl=None):
+        self._db_setpersistent_many(values, ttl=ttl)
+
+    def getpersistent_many(self, props):
+        return self._db_getpersistent_many(props)
+
+    def __persistent_invalidate(self, props):
+        with self.persistent_cache_lock:
+            self.persistent_cache_generation += 1
+            for prop in props:
+                self.persistent_cache.pop(prop, None)
+
+    def __persistent_notify(self, props):
+        # Lets the service drop persistent values written by this
+        # client from its cache
+        try:
+            self.service_rpc_request({"invalidate_persistent": props})
+        except Exception as e:
+            RNS.log(f"Could not notify service of persistent value changes: {e}", RNS.LOG_DEBUG)
+
     def __event_conversations_changed(self):
         pass
 
     def __event_conversation_changed(self, context_dest):
         pass
 
+    def __db_open(self, writer=False):
+        # The writer connection retries statements on busy errors, just
+        # like commits, while reader connections are not affected by
+        # other writers in WAL mode
+        factory = BusyRetryConnection if writer else sqlite3.Connection
+        db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=SidebandCore.DB_BUSY_TIMEOUT, factory=factory)
+        dbc = db.cursor()
+        dbc.execute(f"PRAGMA synchronous = {self.db_synchronous}")
+        dbc.execute(f"PRAGMA cache_size = {int(self.db_cache_size)}")
+        dbc.execute(f"PRAGMA mmap_size = {int(self.db_mmap_size)}")
+        return db
+
     def __db_connect(self):
+        # Returns the writer connection. All writes go through this
+        # connection, and must be performed while holding db_lock.
         if self.db == None:
-            self.db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=15.0)
+            self.db = self.__db_open(writer=True)
+            try:
+                dbc = self.db.cursor()
+                dbc.execute("PRAGMA journal_mode = WAL")
+                journal_mode = dbc.fetchone()[0]
+                if journal_mode.lower() != "wal":
+                    RNS.log(f"Could not enable WAL journal mode for database, using {journal_mode}", RNS.LOG_WARNING)
+            except Exception as e:
+                RNS.log(f"Error while setting database journal mode: {e}", RNS.LOG_ERROR)
 
         return self.db
 
+    def __db_reader(self):
+        # Readers take a connection from a small pool, so reads can run
+        # concurrently with each other, and with the writer, without
+        # opening a new connection for every thread. Connections beyond
+        # DB_READER_POOL_SIZE are closed when they are released.
+        with self.db_readers_lock:
+            if len(self.db_readers) > 0:
+                return self.db_readers.pop()
+
+        return self.__db_open()
+
+    def __db_release_reader(self, db):
+        with self.db_readers_lock:
+            if len(self.db_readers) < SidebandCore.DB_READER_POOL_SIZE:
+                self.db_readers.append(db)
+                return
+
+        db.close()
+
+    @contextmanager
+    def __db_read(self):
+        db = self.__db_reader()
+        try:
+            yield db
+        except Exception as e:
+            try: db.close()
+            except: pass
+            raise e
+
+        self.__db_release_reader(db)
+
+    def __db_commit(self, db):
+        return db_busy_retry(db.commit, "commit")
+
     def __db_reconnect(self):
         if self.db != None:
             try:
@@ -2099,7 +2746,7 @@ class SidebandCore():
         dbc.execute("DROP TABLE IF EXISTS persistent")
         dbc.execute("CREATE TABLE persistent (property BLOB PRIMARY KEY, value BLOB)")
 
-        db.commit()
+        self.__db_commit(db)
 
     def __db_indices(self):
         db = self.__db_connect()
@@ -2107,7 +2754,7 @@ class SidebandCore():
         dbc.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_persistent_property ON persistent(property)")
         dbc.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_state_property ON state(property)")
         dbc.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_conv_dest_context ON conv(dest_context)")
-        db.commit()
+        self.__db_commit(db)
 
     def _db_inittelemetry(self):
         db = self.__db_connect()
@@ -2115,7 +2762,7 @@ class SidebandCore():
 
         dbc.execute("CREATE TABLE IF NOT EXISTS telemetry (id INTEGER PRIMARY KEY, dest_context BLOB, ts INTEGER, data BLOB)")
         dbc.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_ts ON telemetry(ts)")
-        db.commit()
+        self.__db_commit(db)
 
     def _db_upgradetables(self):
         # TODO: Remove this again at some point in the future
@@ -2125,7 +2772,196 @@ class SidebandCore():
         result = dbc.fetchall()
         if len(result) == 0:
             dbc.execute("ALTER TABLE announce ADD COLUMN extra BLOB")
-        db.commit()
+        self.__db_commit(db)
+
+    def _db_migrate(self):
+        # Schema migrations are tracked in the SQLite user_version
+        # pragma, and applied in order. Each step must be idempotent,
+        # since both the service and the UI process may run this on
+        # startup. The schema version is committed after every step,
+        # so an interrupted migration resumes where it left off.
+        with self.db_lock:
+            try:
+                db = self.__db_connect()
+                dbc = db.cursor()
+                dbc.execute("PRAGMA user_version")
+                schema_version = dbc.fetchone()[0]
+                if schema_version >= SidebandCore.DB_SCHEMA_VERSION:
+                    return
+
+                RNS.log(f"Migrating database from schema version {schema_version} to {SidebandCore.DB_SCHEMA_VERSION}", RNS.LOG_DEBUG)
+
+                if schema_version < 1:
+                    # Indices for conversation message lookups, allowing both sides
+                    # of the dest/source condition to be walked in rx_ts order
+                    dbc.execute("CREATE INDEX IF NOT EXISTS idx_lxm_dest_rx_ts ON lxm(dest, rx_ts, lxm_hash)")
+                    dbc.execute("CREATE INDEX IF NOT EXISTS idx_lxm_source_rx_ts ON lxm(source, rx_ts, lxm_hash)")
+                    self.__db_set_schema_version(db, 1)
+
+                if schema_version < 2:
+                    # Telemetry entries are unique per source and timestamp, which
+                    # allows stream ingestion to skip duplicates on insert
+                    dbc.execute("DELETE FROM telemetry WHERE id NOT IN (SELECT min(id) FROM telemetry GROUP BY dest_context, ts)")
+                    dbc.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_telemetry_dest_context_ts ON telemetry(dest_context, ts)")
+                    self.__db_set_schema_version(db, 2)
+
+                if schema_version < 3:
+                    # Decoded location columns for telemetry, so that location
+                    # lookups can be answered from an index instead of unpacking
+                    # every stored telemetry blob
+                    self.__db_add_column(dbc, "telemetry", "latitude", "REAL")
+                    self.__db_add_column(dbc, "telemetry", "longitude", "REAL")
+                    self.__db_add_column(dbc, "telemetry", "altitude", "REAL")
+                    self.__db_add_column(dbc, "telemetry", "accuracy", "REAL")
+                    self.__db_add_column(dbc, "telemetry", "has_location", "INTEGER NOT NULL DEFAULT 0")
+                    self.__db_backfill_locations(db)
+                    dbc.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_location ON telemetry(has_location, dest_context, ts)")
+                    self.__db_set_schema_version(db, 3)
+
+                if schema_version < 4:
+                    # Cached display markup for message bodies, along with
+                    # the key of the render settings it was produced with
+                    self.__db_add_column(dbc, "lxm", "render_key", "BLOB")
+                    self.__db_add_column(dbc, "lxm", "render", "BLOB")
+                    self.__db_set_schema_version(db, 4)
+
+                if schema_version < 5:
+                    # Announce directory columns. Each destination has a single
+                    # entry, and the name, stamp cost and hop count are decoded
+                    # when received, so the directory can be filtered and paged
+                    # without unpacking announce data.
+                    self.__db_add_column(dbc, "announce", "extra", "BLOB")
+                    self.__db_add_column(dbc, "announce", "name", "TEXT")
+                    self.__db_add_column(dbc, "announce", "name_key", "TEXT")
+                    self.__db_add_column(dbc, "announce", "stamp_cost", "INTEGER")
+                    self.__db_add_column(dbc, "announce", "hops", "INTEGER")
+                    dbc.execute("DELETE FROM announce WHERE rowid NOT IN (SELECT rowid FROM (SELECT rowid, max(received) FROM announce GROUP BY source))")
+                    dbc.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_announce_source ON announce(source)")
+                    dbc.execute("CREATE INDEX IF NOT EXISTS idx_announce_received ON announce(received)")
+                    dbc.execute("CREATE INDEX IF NOT EXISTS idx_announce_type_received ON announce(dest_type, received)")
+                    dbc.execute("CREATE INDEX IF NOT EXISTS idx_announce_name_key ON announce(name_key)")
+                    self.__db_backfill_announce_names(db)
+                    self.__db_init_announce_search(dbc)
+                    self.__db_set_schema_version(db, 5)
+
+                if schema_version < 6:
+                    # Expiry times for temporary persistent values. Values
+                    # without an expiry are kept indefinitely. Existing
+                    # temporary values get a full TTL from now.
+                    self.__db_add_column(dbc, "persistent", "expires", "REAL")
+                    dbc.execute("CREATE INDEX IF NOT EXISTS idx_persistent_expires ON persistent(expires) WHERE expires IS NOT NULL")
+                    dbc.execute("UPDATE persistent set expires=:expires where expires is NULL and CAST(property AS TEXT) like 'temp.%'", {"expires": time.time()+SidebandCore.PERSISTENT_TEMP_TTL})
+                    self.__db_set_schema_version(db, 6)
+
+            except Exception as e:
+                RNS.log(f"An error occurred while migrating the database schema: {e}", RNS.LOG_ERROR)
+                RNS.trace_exception(e)
+                try: db.rollback()
+                except: pass
+
+                # The rest of Sideband relies on the migrated schema, so
+                # continuing with a partially migrated database would
+                # only fail later, in less obvious ways
+                RNS.log(f"Could not migrate the database at {self.db_path} to schema version {SidebandCore.DB_SCHEMA_VERSION}. Terminating now.", RNS.LOG_ERROR)
+                RNS.panic()
+
+    def __db_set_schema_version(self, db, version):
+        db.execute(f"PRAGMA user_version = {int(version)}")
+        self.__db_commit(db)
+        RNS.log(f"Database schema is now at version {version}", RNS.LOG_DEBUG)
+
+    def __db_add_column(self, dbc, table, column, definition):
+        dbc.execute(f"PRAGMA table_info({table})")
+        if not column in [c[1] for c in dbc.fetchall()]:
+            dbc.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def __db_backfill_locations(self, db, batch_size = 1024):
+        # Populates the location columns for existing telemetry entries,
+        # walking the table in id order in fixed size batches
+        dbc = db.cursor()
+        last_id = -1; filled = 0
+        while True:
+            dbc.execute("select id, data from telemetry where id>:last_id order by id limit :batch_size", {"last_id": last_id, "batch_size": batch_size})
+            result = dbc.fetchall()
+            if len(result) < 1:
+                break
+
+            updates = []
+            for entry in result:
+                last_id = entry[0]
+                try: location = Telemeter.peek_location(entry[1])
+                except: location = None
+                if location != None:
+                    updates.append(self.__db_location_columns(location)+(entry[0],))
+
+            if len(updates) > 0:
+                dbc.executemany("UPDATE telemetry set latitude=?, longitude=?, altitude=?, accuracy=?, has_location=? where id=?", updates)
+                filled += len(updates)
+
+        self.__db_commit(db)
+        RNS.log(f"Backfilled location columns for {filled} telemetry entries", RNS.LOG_DEBUG)
+
+    def __db_backfill_announce_names(self, db, batch_size = 1024):
+        # Populates the name and stamp cost columns for existing announces
+        dbc = db.cursor()
+        last_rowid = -1
+        while True:
+            dbc.execute("select rowid, data, dest_type from announce where rowid>:last_rowid order by rowid limit :batch_size", {"last_rowid": last_rowid, "batch_size": batch_size})
+            result = dbc.fetchall()
+            if len(result) < 1:
+                break
+
+            updates = []
+            for entry in result:
+                last_rowid = entry[0]
+                updates.append(self.__db_announce_columns(entry[1], entry[2])+(entry[0],))
+
+            dbc.executemany("UPDATE announce set name=?, name_key=?, stamp_cost=? where rowid=?", updates)
+
+        self.__db_commit(db)
+
+    def __db_init_announce_search(self, dbc):
+        # Full-text index over announced names. The index uses the
+        # announce table as external content, and is kept up to date by
+        # triggers. Not all SQLite builds include FTS5, and in that case
+        # name searches fall back to prefix matching on name_key.
+        try:
+            dbc.execute("CREATE VIRTUAL TABLE IF NOT EXISTS announce_fts USING fts5(name, content='announce', content_rowid='rowid')")
+            dbc.execute("""CREATE TRIGGER IF NOT EXISTS announce_fts_insert AFTER INSERT ON announce BEGIN
+                             INSERT INTO announce_fts (rowid, name) VALUES (new.rowid, new.name); END""")
+            dbc.execute("""CREATE TRIGGER IF NOT EXISTS announce_fts_delete AFTER DELETE ON announce BEGIN
+                             INSERT INTO announce_fts (announce_fts, rowid, name) VALUES ('delete', old.rowid, old.name); END""")
+            dbc.execute("""CREATE TRIGGER IF NOT EXISTS announce_fts_update AFTER UPDATE OF name ON announce BEGIN
+                             INSERT INTO announce_fts (announce_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+                             INSERT INTO announce_fts (rowid, name) VALUES (new.rowid, new.name); END""")
+            dbc.execute("INSERT INTO announce_fts (announce_fts) VALUES ('rebuild')")
+
+        except Exception as e:
+            RNS.log(f"Full-text search is not available for announces, the contained exception was: {e}", RNS.LOG_WARNING)
+
+    def __db_announce_columns(self, app_data, dest_type, stamp_cost=None):
+        # Returns the values for the name, name_key and stamp_cost
+        # announce columns
+        name = None
+        try:
+            if dest_type == "lxmf.delivery":
+                name = LXMF.display_name_from_app_data(app_data)
+            else:
+                name = LXMF.pn_name_from_app_data(app_data)
+                stamp_cost = LXMF.pn_stamp_cost_from_app_data(app_data)
+        except Exception as e:
+            RNS.log(f"Could not decode announce data: {e}", RNS.LOG_DEBUG)
+
+        name_key = name.casefold() if name != None else None
+        return (name, name_key, stamp_cost)
+
+    def __db_location_columns(self, location):
+        # Returns the values for the latitude, longitude, altitude,
+        # accuracy and has_location telemetry columns
+        if location == None or location.get("latitude") == None or location.get("longitude") == None:
+            return (None, None, None, None, 0)
+        else:
+            return (location["latitude"], location["longitude"], location.get("altitude"), location.get("accuracy"), 1)
 
     def _db_initstate(self):
         # db = self.__db_connect()
@@ -2133,7 +2969,6 @@ class SidebandCore():
 
         # dbc.execute("DROP TABLE IF EXISTS state")
         # dbc.execute("CREATE TABLE state (property BLOB PRIMARY KEY, value BLOB)")
-        # db.commit()
         self.setstate("database_ready", True)
 
     def _db_initpersistent(self):
@@ -2141,71 +2976,175 @@ class SidebandCore():
         dbc = db.cursor()
 
         dbc.execute("CREATE TABLE IF NOT EXISTS persistent (property BLOB PRIMARY KEY, value BLOB)")
-        db.commit()
+        self.__db_commit(db)
 
     def _db_getpersistent(self, prop):
-        with self.db_lock:
-            try:
-                db = self.__db_connect()
-                dbc = db.cursor()
-                
-                query = "select * from persistent where property=:uprop"
-                dbc.execute(query, {"uprop": prop.encode("utf-8")})
-                result = dbc.fetchall()
+        return self._db_getpersistent_many([prop])[prop]
 
-                if len(result) < 1:
-                    return None
+    def _db_getpersistent_many(self, props):
+        values = {}
+        missing = []
+        now = time.time()
+        with self.persistent_cache_lock:
+            generation = self.persistent_cache_generation
+            for prop in props:
+                if self.persistent_cache_enabled and prop in self.persistent_cache:
+                    self.persistent_cache.move_to_end(prop)
+                    value, expires = self.persistent_cache[prop]
+                    values[prop] = value if expires == None or expires > now else None
                 else:
-                    try:
-                        entry = result[0]
-                        val = msgpack.unpackb(entry[1])
-                        if val == None:
-                            query = "delete from persistent where (property=:uprop);"
-                            dbc.execute(query, {"uprop": prop.encode("utf-8")})
-                            db.commit()
-
-                        return val
-                    except Exception as e:
-                        RNS.log("Could not unpack persistent value from database for property \""+str(prop)+"\". The contained exception was: "+str(e), RNS.LOG_ERROR)
-                        return None
-            
+                    missing.append(prop)
+
+        if len(missing) > 0:
+            loaded = {}
+            try:
+                with self.__db_read() as db:
+                    dbc = db.cursor()
+                    for i in range(0, len(missing), 256):
+                        chunk = missing[i:i+256]
+                        query = "select property, value, expires from persistent where property in ("+", ".join("?"*len(chunk))+")"
+                        dbc.execute(query, [prop.encode("utf-8") for prop in chunk])
+                        for uprop, bval, expires in dbc.fetchall():
+                            prop = uprop.decode("utf-8")
+                            try:
+                                loaded[prop] = (msgpack.unpackb(bval), expires)
+                            except Exception as e:
+                                RNS.log("Could not unpack persistent value from database for property \""+str(prop)+"\". The contained exception was: "+str(e), RNS.LOG_ERROR)
+                                loaded[prop] = (None, None)
+
+                # Values are only added to the cache if no writes happened
+                # while they were being read from the database
+                with self.persistent_cache_lock:
+                    for prop in missing:
+                        value, expires = loaded.get(prop, (None, None))
+                        values[prop] = value if expires == None or expires > now else None
+                        if self.persistent_cache_enabled and generation == self.persistent_cache_generation:
+                            self.persistent_cache[prop] = (value, expires)
+                    self.__persistent_cache_trim()
+
             except Exception as e:
                 RNS.log("An error occurred during persistent getstate database operation: "+str(e), RNS.LOG_ERROR)
-                self.db = None
+                for prop in missing: values[prop] = None
 
-    def _db_setpersistent(self, prop, val):
-        existing_prop = self._db_getpersistent(prop)
+        # Cached values are shared, so mutable values are copied
+        # before being handed out
+        return {prop: deepcopy(values[prop]) if type(values[prop]) in (list, dict) else values[prop] for prop in props}
 
+    def _db_setpersistent(self, prop, val, ttl=None):
+        self._db_setpersistent_many({prop: val}, ttl=ttl)
+
+    def _db_setpersistent_many(self, values, ttl=None):
+        # Writes a set of persistent values in a single transaction.
+        # Setting a property to None removes it.
         with self.db_lock:
             try:
                 db = self.__db_connect()
                 dbc = db.cursor()
-                uprop = prop.encode("utf-8")
-                bval = msgpack.packb(val)
-
-                if existing_prop == None:
-                    try:
-                        query = "INSERT INTO persistent (property, value) values (?, ?)"
-                        data = (uprop, bval)
-                        dbc.execute(query, data)
-                        db.commit()
-            
-                    except Exception as e:
-                        RNS.log("Error while setting persistent state property "+str(prop)+" in DB: "+str(e), RNS.LOG_ERROR)
-                        RNS.log("Retrying as update query...")
-                        query = "UPDATE state set value=:bval where property=:uprop;"
-                        dbc.execute(query, {"bval": bval, "uprop": uprop})
-                        db.commit()
+                now = time.time()
+                expiries = {prop: self.__persistent_expiry(prop, ttl, now) for prop in values}
+                updates = [(prop.encode("utf-8"), msgpack.packb(val), expiries[prop]) for prop, val in values.items() if val != None]
+                removals = [(prop.encode("utf-8"),) for prop, val in values.items() if val == None]
+                if len(updates) > 0:
+                    query = "INSERT INTO persistent (property, value, expires) values (?, ?, ?) ON CONFLICT(property) DO UPDATE SET value=excluded.value, expires=excluded.expires"
+                    dbc.executemany(query, updates)
+                if len(removals) > 0:
+                    query = "delete from persistent where property=?"
+                    dbc.executemany(query, removals)
+                self.__db_commit(db)
+                self.__persistent_cache_put(values, expiries)
 
-                else:
-                    query = "UPDATE persistent set value=:bval where property=:uprop;"
-                    dbc.execute(query, {"bval": bval, "uprop": uprop})
-                    db.commit()
-            
             except Exception as e:
                 RNS.log("An error occurred during persistent setstate database operation: "+str(e), RNS.LOG_ERROR)
+                self.__persistent_invalidate(list(values))
                 self.db = None
 
+        if self.is_client:
+            self.__persistent_notify(list(values))
+
+    def __persistent_expiry(self, prop, ttl, now):
+        if ttl == None and prop.startswith("temp."): ttl = SidebandCore.PERSISTENT_TEMP_TTL
+        return now+ttl if ttl != None else None
+
+    def __persistent_cache_put(self, values, expiries):
+        with self.persistent_cache_lock:
+            self.persistent_cache_generation += 1
+            if self.persistent_cache_enabled:
+                for prop, val in values.items():
+                    self.persistent_cache.pop(prop, None)
+                    self.persistent_cache[prop] = (deepcopy(val) if type(val) in (list, dict) else val, expiries[prop])
+                self.__persistent_cache_trim()
+
+    def __persistent_cache_trim(self):
+        # Must be called while holding persistent_cache_lock
+        while len(self.persistent_cache) > SidebandCore.PERSISTENT_CACHE_SIZE:
+            self.persistent_cache.popitem(last=False)
+
+    def _db_purge_persistent(self):
+        # Deletes expired persistent values in batches, releasing the
+        # database lock between batches, so other writers are not held
+        # up by a large purge
+        started = time.time(); purged = 0
+        try:
+            while True:
+                with self.db_lock:
+                    db = self.__db_connect()
+                    dbc = db.cursor()
+                    query = "delete from persistent where rowid in (select rowid from persistent where expires<=:now limit :batch_size)"
+                    dbc.execute(query, {"now": started, "batch_size": SidebandCore.PERSISTENT_PURGE_BATCH})
+                    deleted = dbc.rowcount
+                    self.__db_commit(db)
+
+                purged += deleted
+                if deleted < SidebandCore.PERSISTENT_PURGE_BATCH:
+                    break
+
+        except Exception as e:
+            RNS.log(f"An error occurred while purging expired persistent values: {e}", RNS.LOG_ERROR)
+            RNS.trace_exception(e)
+
+        with self.persistent_cache_lock:
+            for prop in [prop for prop, (value, expires) in self.persistent_cache.items() if expires != None and expires <= started]:
+                self.persistent_cache.pop(prop)
+
+        self.last_persistent_purge = time.time()
+        duration = self.last_persistent_purge-started
+        self.persistent_purge_stats["purges"] += 1
+        self.persistent_purge_stats["purged"] += purged
+        self.persistent_purge_stats["last_purged"] = purged
+        self.persistent_purge_stats["last_duration"] = duration
+
+        stats = self._get_persistent_stats()
+        RNS.log(f"Purged {purged} expired persistent values in {round(duration*1000, 1)} ms, {stats.get('keys')} values stored, {stats.get('expiring')} with expiry, {stats['cached']} cached", RNS.LOG_DEBUG)
+
+    def get_persistent_stats(self):
+        # Expiry and purge statistics are kept by the process that runs
+        # the periodic jobs, so clients request them from the service
+        if self.is_client:
+            try:
+                return self.service_rpc_request({"get_persistent_stats": True})
+            except Exception as e:
+                RNS.log(f"Error while getting persistent value statistics over RPC: {e}", RNS.LOG_DEBUG)
+                return None
+        else:
+            return self._get_persistent_stats()
+
+    def _get_persistent_stats(self):
+        stats = self.persistent_purge_stats.copy()
+        stats["last_purge"] = self.last_persistent_purge if self.last_persistent_purge > 0 else None
+        stats["cached"] = len(self.persistent_cache)
+        try:
+            with self.__db_read() as db:
+                dbc = db.cursor()
+                dbc.execute("select count(*) from persistent")
+                stats["keys"] = dbc.fetchone()[0]
+                dbc.execute("select count(*), count(case when expires<=:now then 1 end) from persistent where expires is not null", {"now": time.time()})
+                stats["expiring"], stats["expired"] = dbc.fetchone()
+
+        except Exception as e:
+            RNS.log(f"Could not get persistent value counts from database: {e}", RNS.LOG_ERROR)
+
+        return stats
+
     def _db_conversation_update_txtime(self, context_dest, is_retry = False):
         with self.db_lock:
             try:
@@ -2217,7 +3156,7 @@ class SidebandCore():
 
                 dbc.execute(query, data)
                 result = dbc.fetchall()
-                db.commit()
+                self.__db_commit(db)
             except Exception as e:
                 RNS.log("An error occurred while updating conversation TX time: "+str(e), RNS.LOG_ERROR)
                 self.__db_reconnect()
@@ -2244,7 +3183,7 @@ class SidebandCore():
 
                 dbc.execute(query, data)
                 result = dbc.fetchall()
-                db.commit()
+                self.__db_commit(db)
             except Exception as e:
                 RNS.log("An error occurred while updating conversation unread flag: "+str(e), RNS.LOG_ERROR)
                 self.__db_reconnect()
@@ -2253,8 +3192,7 @@ class SidebandCore():
                 #     self._db_conversation_set_unread(context_dest, unread, tx, is_retry=True)
 
     def _db_telemetry(self, context_dest = None, after = None, before = None, limit = None):
-        with self.db_lock:
-            db = self.__db_connect()
+        with self.__db_read() as db:
             dbc = db.cursor()
 
             limit_part = ""
@@ -2307,132 +3245,270 @@ class SidebandCore():
                 
                 return results
 
+    def _db_latest_telemetry(self, after = None):
+        # Returns the newest telemetry entry for each source, as a dict
+        # of source to [timestamp, packed telemetry], ordered by newest
+        # timestamp first. The per-source maximum is resolved from
+        # idx_telemetry_dest_context_ts without reading the history.
+        with self.__db_read() as db:
+            dbc = db.cursor()
+
+            conditions = ""
+            params = {}
+            if after != None:
+                conditions = " where ts>:after_ts"
+                params["after_ts"] = after
+
+            query  = "select telemetry.dest_context, telemetry.ts, telemetry.data from "
+            query += "(select dest_context, max(ts) as max_ts from telemetry"+conditions+" group by dest_context) as latest "
+            query += "join telemetry on telemetry.dest_context=latest.dest_context and telemetry.ts=latest.max_ts order by telemetry.ts DESC"
+            dbc.execute(query, params)
+
+            results = {}
+            for entry in dbc.fetchall():
+                results[entry[0]] = [entry[1], entry[2]]
+
+            return results
+
+    def _db_latest_locations(self, context_dest = None, after = None, after_id = None):
+        # Returns the newest telemetry entry with a valid location for
+        # each source, as a dict of source to [timestamp, packed
+        # telemetry, location]. Located sources are enumerated by
+        # skipping through idx_telemetry_location one source at a time,
+        # and the newest timestamp of each source is found with a
+        # single index seek, so the cost depends on the number of
+        # sources, not on the amount of stored history. If after_id is
+        # specified, only sources that have telemetry entries with a
+        # higher id are included.
+        with self.__db_read() as db:
+            dbc = db.cursor()
+
+            params = {}
+            if context_dest != None:
+                sources  = "sources(dest_context) as (select :context_dest"
+                sources += " where exists (select 1 from telemetry where id>:after_id and dest_context=:context_dest))" if after_id != None else ")"
+                params["context_dest"] = context_dest
+            elif after_id != None:
+                sources  = "sources(dest_context) as (select distinct dest_context from telemetry where id>:after_id)"
+            else:
+                sources  = "sources(dest_context) as (select (select min(dest_context) from telemetry where has_location=1) "
+                sources += "union all select (select min(dest_context) from telemetry where has_location=1 and dest_context>sources.dest_context) "
+                sources += "from sources where sources.dest_context is not null)"
+
+            if after_id != None:
+                params["after_id"] = after_id
+
+            ts_condition = ""
+            if after != None:
+                ts_condition = " and ts>:after_ts"
+                params["after_ts"] = after
+
+            query  = "with recursive "+sources+", "
+            query += "latest(dest_context, max_ts) as (select dest_context, (select max(ts) from telemetry where has_location=1 and dest_context=sources.dest_context"+ts_condition+") "
+            query += "from sources where dest_context is not null) "
+            query += "select telemetry.dest_context, telemetry.ts, telemetry.data, telemetry.latitude, telemetry.longitude, telemetry.altitude, telemetry.accuracy from "
+            query += "latest join telemetry on telemetry.dest_context=latest.dest_context and telemetry.ts=latest.max_ts"
+            dbc.execute(query, params)
+
+            results = {}
+            for entry in dbc.fetchall():
+                location = {"latitude": entry[3], "longitude": entry[4], "altitude": entry[5], "accuracy": entry[6]}
+                results[entry[0]] = [entry[1], entry[2], location]
+
+            return results
+
+    def __db_prepare_telemetry(self, telemetry, physical_link = None, source_dest = None, via = None):
+        # Unpacks received telemetry and adds any link, reception and
+        # relay information to it. Returns the telemetry timestamp, the
+        # resulting packed telemetry and the location column values,
+        # ready for insertion.
+        remote_telemeter = Telemeter.from_packed(telemetry)
+        telemetry_timestamp = remote_telemeter.read("time")["utc"]
+        location_columns = self.__db_location_columns(remote_telemeter.read("location"))
+
+        if physical_link != None and len(physical_link) != 0:
+            remote_telemeter.synthesize("physical_link")
+            if "rssi" in physical_link: remote_telemeter.sensors["physical_link"].rssi = physical_link["rssi"]
+            if "snr" in physical_link: remote_telemeter.sensors["physical_link"].snr = physical_link["snr"]
+            if "q" in physical_link: remote_telemeter.sensors["physical_link"].q = physical_link["q"]
+            remote_telemeter.sensors["physical_link"].update_data()
+            telemetry = remote_telemeter.packed()
+
+        if source_dest != None:
+            remote_telemeter.synthesize("received")
+            remote_telemeter.sensors["received"].by = self.lxmf_destination.hash
+            remote_telemeter.sensors["received"].via = source_dest
+
+            rl = remote_telemeter.read("location")
+            if rl and "latitude" in rl and "longitude" in rl and "altitude" in rl:
+                if self.latest_telemetry != None and "location" in self.latest_telemetry:
+                    ol = self.latest_telemetry["location"]
+                    if ol != None:
+                        if "latitude" in ol and "longitude" in ol and "altitude" in ol:
+                            olat = ol["latitude"]; olon = ol["longitude"]; oalt = ol["altitude"]
+                            rlat = rl["latitude"]; rlon = rl["longitude"]; ralt = rl["altitude"]
+                            if olat != None and olon != None and oalt != None:
+                                if rlat != None and rlon != None and ralt != None:
+                                    remote_telemeter.sensors["received"].set_distance(
+                                        (olat, olon, oalt), (rlat, rlon, ralt)
+                                    )
+
+            remote_telemeter.sensors["received"].update_data()
+            telemetry = remote_telemeter.packed()
+
+        if via != None:
+            if not "received" in remote_telemeter.sensors:
+                remote_telemeter.synthesize("received")
+
+            if "by" in remote_telemeter.sensors["received"].data:
+                remote_telemeter.sensors["received"].by = remote_telemeter.sensors["received"].data["by"]
+            if "distance" in remote_telemeter.sensors["received"].data:
+                remote_telemeter.sensors["received"].geodesic_distance = remote_telemeter.sensors["received"].data["distance"]["geodesic"]
+                remote_telemeter.sensors["received"].euclidian_distance = remote_telemeter.sensors["received"].data["distance"]["euclidian"]
+
+            remote_telemeter.sensors["received"].via = via
+            remote_telemeter.sensors["received"].update_data()
+            telemetry = remote_telemeter.packed()
+
+        return telemetry_timestamp, telemetry, location_columns
+
     def _db_save_telemetry(self, context_dest, telemetry, physical_link = None, source_dest = None, via = None, is_retry = False):
-        with self.db_lock:
-            try:
-                remote_telemeter = Telemeter.from_packed(telemetry)
-                read_telemetry = remote_telemeter.read_all()
-                telemetry_timestamp = read_telemetry["time"]["utc"]
+        try:
+            telemetry_timestamp, telemetry, location_columns = self.__db_prepare_telemetry(telemetry, physical_link=physical_link, source_dest=source_dest, via=via)
 
+            with self.db_lock:
                 db = self.__db_connect()
                 dbc = db.cursor()
 
-                query = "select * from telemetry where dest_context=:ctx and ts=:tts"
-                dbc.execute(query, {"ctx": context_dest, "tts": telemetry_timestamp})
-                result = dbc.fetchall()
-
-                if len(result) != 0:
-                    RNS.log("Telemetry entry with source "+RNS.prettyhexrep(context_dest)+" and timestamp "+str(telemetry_timestamp)+" already exists, skipping save", RNS.LOG_DEBUG)
-                    return None
-
-                if physical_link != None and len(physical_link) != 0:
-                    remote_telemeter.synthesize("physical_link")
-                    if "rssi" in physical_link: remote_telemeter.sensors["physical_link"].rssi = physical_link["rssi"]
-                    if "snr" in physical_link: remote_telemeter.sensors["physical_link"].snr = physical_link["snr"]
-                    if "q" in physical_link: remote_telemeter.sensors["physical_link"].q = physical_link["q"]
-                    remote_telemeter.sensors["physical_link"].update_data()
-                    telemetry = remote_telemeter.packed()
-
-                if source_dest != None:
-                    remote_telemeter.synthesize("received")
-                    remote_telemeter.sensors["received"].by = self.lxmf_destination.hash
-                    remote_telemeter.sensors["received"].via = source_dest
-
-                    rl = remote_telemeter.read("location")
-                    if rl and "latitude" in rl and "longitude" in rl and "altitude" in rl:
-                        if self.latest_telemetry != None and "location" in self.latest_telemetry:
-                            ol = self.latest_telemetry["location"]
-                            if ol != None:
-                                if "latitude" in ol and "longitude" in ol and "altitude" in ol:
-                                    olat = ol["latitude"]; olon = ol["longitude"]; oalt = ol["altitude"]
-                                    rlat = rl["latitude"]; rlon = rl["longitude"]; ralt = rl["altitude"]
-                                    if olat != None and olon != None and oalt != None:
-                                        if rlat != None and rlon != None and ralt != None:
-                                            remote_telemeter.sensors["received"].set_distance(
-                                                (olat, olon, oalt), (rlat, rlon, ralt)
-                                            )
-
-                    remote_telemeter.sensors["received"].update_data()
-                    telemetry = remote_telemeter.packed()
-
-                if via != None:
-                    if not "received" in remote_telemeter.sensors:
-                        remote_telemeter.synthesize("received")
-
-                    if "by" in remote_telemeter.sensors["received"].data:
-                        remote_telemeter.sensors["received"].by = remote_telemeter.sensors["received"].data["by"]
-                    if "distance" in remote_telemeter.sensors["received"].data:
-                        remote_telemeter.sensors["received"].geodesic_distance = remote_telemeter.sensors["received"].data["distance"]["geodesic"]
-                        remote_telemeter.sensors["received"].euclidian_distance = remote_telemeter.sensors["received"].data["distance"]["euclidian"]
-
-                    remote_telemeter.sensors["received"].via = via
-                    remote_telemeter.sensors["received"].update_data()
-                    telemetry = remote_telemeter.packed()
-                    
-                query = "INSERT INTO telemetry (dest_context, ts, data) values (?, ?, ?)"
-                data = (context_dest, telemetry_timestamp, telemetry)
+                query = "INSERT OR IGNORE INTO telemetry (dest_context, ts, data, latitude, longitude, altitude, accuracy, has_location) values (?, ?, ?, ?, ?, ?, ?, ?)"
+                data = (context_dest, telemetry_timestamp, telemetry)+location_columns
                 dbc.execute(query, data)
+                inserted = dbc.rowcount > 0
 
                 try:
-                    db.commit()
+                    self.__db_commit(db)
                 except Exception as e:
                     RNS.log("An error occurred while commiting telemetry to database: "+str(e), RNS.LOG_ERROR)
                     self.__db_reconnect()
-                    # if not is_retry:
-                    #     RNS.log("Retrying operation...", RNS.LOG_ERROR)
-                    #     self._db_save_telemetry(context_dest, telemetry, physical_link, source_dest, via, is_retry = True)
                     return
 
-                self.setstate("app.flags.last_telemetry", time.time())
+            if not inserted:
+                RNS.log("Telemetry entry with source "+RNS.prettyhexrep(context_dest)+" and timestamp "+str(telemetry_timestamp)+" already exists, skipping save", RNS.LOG_DEBUG)
+                return None
+
+            self.setstate("app.flags.last_telemetry", time.time())
 
-                if self.config["telemetry_to_mqtt"] == True:
-                    def mqtt_job():
-                        self.mqtt_handle_telemetry(context_dest, telemetry)
-                    threading.Thread(target=mqtt_job, daemon=True).start()
+            if self.config["telemetry_to_mqtt"] == True:
+                self.mqtt_handle_telemetry(context_dest, telemetry)
 
-                return telemetry
+            return telemetry
 
+        except Exception as e:
+            import traceback
+            exception_info = "".join(traceback.TracebackException.from_exception(e).format())
+            RNS.log(f"A {str(type(e))} occurred while saving telemetry to database: {str(e)}", RNS.LOG_ERROR)
+            RNS.log(exception_info, RNS.LOG_ERROR)
+            self.db = None
+
+    def _db_save_telemetry_stream(self, context_dest, stream):
+        # Saves all entries of a received telemetry stream, along with
+        # any appearance updates they carry, in a single transaction.
+        # Entries that already exist are skipped by the unique index
+        # on (dest_context, ts). Returns the number of saved entries.
+        started = time.time()
+        prepared = []
+        for telemetry_entry in stream:
+            try:
+                tsource = telemetry_entry[0]
+                ttstamp = telemetry_entry[1]
+                tpacked = telemetry_entry[2]
+                appearance = telemetry_entry[3]
+                telemetry_timestamp, telemetry, location_columns = self.__db_prepare_telemetry(tpacked, via=context_dest)
+                prepared.append((tsource, ttstamp, telemetry_timestamp, telemetry, location_columns, appearance))
             except Exception as e:
-                import traceback
-                exception_info = "".join(traceback.TracebackException.from_exception(e).format())
-                RNS.log(f"A {str(type(e))} occurred while saving telemetry to database: {str(e)}", RNS.LOG_ERROR)
-                RNS.log(exception_info, RNS.LOG_ERROR)
-                self.db = None
+                RNS.log(f"Could not decode telemetry stream entry from {RNS.prettyhexrep(context_dest)}: {e}", RNS.LOG_ERROR)
 
-    def _db_update_appearance(self, context_dest, timestamp, appearance, from_bulk_telemetry=False):
-        conv = self._db_conversation(context_dest)
+        saved = []
+        appearances = {}
+        with self.db_lock:
+            try:
+                db = self.__db_connect()
+                dbc = db.cursor()
+
+                query = "INSERT OR IGNORE INTO telemetry (dest_context, ts, data, latitude, longitude, altitude, accuracy, has_location) values (?, ?, ?, ?, ?, ?, ?, ?)"
+                for tsource, ttstamp, telemetry_timestamp, telemetry, location_columns, appearance in prepared:
+                    dbc.execute(query, (tsource, telemetry_timestamp, telemetry)+location_columns)
+                    if dbc.rowcount > 0:
+                        saved.append((tsource, telemetry))
+                        if appearance != None:
+                            if not tsource in appearances or ttstamp > appearances[tsource][0]:
+                                appearances[tsource] = (ttstamp, appearance)
+
+                for tsource in appearances:
+                    self.__db_apply_appearance(dbc, tsource, appearances[tsource][1], from_bulk_telemetry=True)
+
+                self.__db_commit(db)
+
+            except Exception as e:
+                RNS.log(f"An error occurred while saving telemetry stream to database: {e}", RNS.LOG_ERROR)
+                RNS.trace_exception(e)
+                try: db.rollback()
+                except: pass
+                self.__db_reconnect()
+                return 0
+
+        RNS.log(f"Saved {len(saved)} of {len(stream)} telemetry stream entries and {len(appearances)} appearance updates from {RNS.prettyhexrep(context_dest)} in {RNS.prettyshorttime(time.time()-started)}", RNS.LOG_DEBUG)
+
+        if len(saved) > 0:
+            self.setstate("app.flags.last_telemetry", time.time())
+
+            if self.config["telemetry_to_mqtt"] == True:
+                for tsource, telemetry in saved:
+                    self.mqtt_handle_telemetry(tsource, telemetry)
 
-        if conv == None:
+        return len(saved)
+
+    def __db_apply_appearance(self, dbc, context_dest, appearance, from_bulk_telemetry=False):
+        # Writes an appearance update using the supplied writer cursor.
+        # Must be called while holding db_lock, and does not commit.
+        dbc.execute("select data from conv where dest_context=:ctx", {"ctx": context_dest})
+        result = dbc.fetchall()
+
+        if len(result) < 1:
             ae = [appearance, int(time.time())]
-            # TODO: Clean out these temporary values at some interval.
-            # Probably expire after 14 days or so.
-            self.setpersistent("temp.peer_appearance."+RNS.hexrep(context_dest, delimit=False), ae)
-        
+            prop = "temp.peer_appearance."+RNS.hexrep(context_dest, delimit=False)
+            expires = self.__persistent_expiry(prop, None, time.time())
+            dbc.execute("INSERT OR REPLACE INTO persistent (property, value, expires) values (?, ?, ?)", (prop.encode("utf-8"), msgpack.packb(ae), expires))
+            self.__persistent_cache_put({prop: ae}, {prop: expires})
+
         else:
-            with self.db_lock:
-                data_dict = conv["data"]
-                if data_dict == None:
-                    data_dict = {}
+            data_dict = msgpack.unpackb(result[0][0])
+            if data_dict == None:
+                data_dict = {}
 
-                if not "appearance" in data_dict:
-                    data_dict["appearance"] = None
+            if not "appearance" in data_dict:
+                data_dict["appearance"] = None
 
-                if from_bulk_telemetry and data_dict["appearance"] != SidebandCore.DEFAULT_APPEARANCE and data_dict["appearance"] != None:
-                    RNS.log("Aborting appearance update from bulk transfer, since conversation already has appearance set: "+str(appearance)+" / "+str(data_dict["appearance"]), RNS.LOG_DEBUG)
-                    return
+            if from_bulk_telemetry and data_dict["appearance"] != SidebandCore.DEFAULT_APPEARANCE and data_dict["appearance"] != None:
+                RNS.log("Aborting appearance update from bulk transfer, since conversation already has appearance set: "+str(appearance)+" / "+str(data_dict["appearance"]), RNS.LOG_DEBUG)
+                return
 
-                if data_dict["appearance"] != appearance:
-                    data_dict["appearance"] = appearance
-                    packed_dict = msgpack.packb(data_dict)
-                
-                    db = self.__db_connect()
-                    dbc = db.cursor()
-                
-                    query = "UPDATE conv set data = ? where dest_context = ?"
-                    data = (packed_dict, context_dest)
-                    dbc.execute(query, data)
-                    result = dbc.fetchall()
-                    db.commit()
+            if data_dict["appearance"] != appearance:
+                data_dict["appearance"] = appearance
+                packed_dict = msgpack.packb(data_dict)
+                dbc.execute("UPDATE conv set data = ? where dest_context = ?", (packed_dict, context_dest))
+
+    def _db_update_appearance(self, context_dest, timestamp, appearance, from_bulk_telemetry=False):
+        with self.db_lock:
+            try:
+                db = self.__db_connect()
+                dbc = db.cursor()
+                self.__db_apply_appearance(dbc, context_dest, appearance, from_bulk_telemetry=from_bulk_telemetry)
+                self.__db_commit(db)
+
+            except Exception as e:
+                RNS.log(f"An error occurred while updating appearance for {RNS.prettyhexrep(context_dest)}: {e}", RNS.LOG_ERROR)
+                self.__db_reconnect()
 
     def _db_get_appearance(self, context_dest, conv = None, raw=False):
         if context_dest == self.lxmf_destination.hash:
@@ -2461,17 +3537,10 @@ class SidebandCore():
 
                 try:
                     if data_dict != None and "appearance" in data_dict:
-                        def htf(cbytes):
-                            d = 1.0/255.0
-                            r = round(struct.unpack("!B", bytes([cbytes[0]]))[0]*d, 4)
-                            g = round(struct.unpack("!B", bytes([cbytes[1]]))[0]*d, 4)
-                            b = round(struct.unpack("!B", bytes([cbytes[2]]))[0]*d, 4)
-                            return [r,g,b]
-
                         if raw:
                             appearance = data_dict["appearance"]
                         else:
-                            appearance = [data_dict["appearance"][0], htf(data_dict["appearance"][1]), htf(data_dict["appearance"][2])]
+                            appearance = self.__decode_appearance(data_dict["appearance"])
                         
                         return appearance
                 except Exception as e:
@@ -2480,6 +3549,16 @@ class SidebandCore():
         return None
 
 
+    def __decode_appearance(self, appearance):
+        def htf(cbytes):
+            d = 1.0/255.0
+            r = round(struct.unpack("!B", bytes([cbytes[0]]))[0]*d, 4)
+            g = round(struct.unpack("!B", bytes([cbytes[1]]))[0]*d, 4)
+            b = round(struct.unpack("!B", bytes([cbytes[2]]))[0]*d, 4)
+            return [r,g,b]
+
+        return [appearance[0], htf(appearance[1]), htf(appearance[2])]
+
     def _db_conversation_set_telemetry(self, context_dest, send_telemetry=False, is_retry = False):
         conv = self._db_conversation(context_dest)
         data_dict = conv["data"]
@@ -2499,7 +3578,7 @@ class SidebandCore():
             result = dbc.fetchall()
 
             try:
-                db.commit()
+                self.__db_commit(db)
             except Exception as e:
                 RNS.log("An error occurred while updating conversation telemetry options: "+str(e), RNS.LOG_ERROR)
                 self.__db_reconnect()
@@ -2526,7 +3605,7 @@ class SidebandCore():
             result = dbc.fetchall()
 
             try:
-                db.commit()
+                self.__db_commit(db)
             except Exception as e:
                 RNS.log("An error occurred while updating conversation request options: "+str(e), RNS.LOG_ERROR)
                 self.__db_reconnect()
@@ -2553,7 +3632,7 @@ class SidebandCore():
             result = dbc.fetchall()
 
             try:
-                db.commit()
+                self.__db_commit(db)
             except Exception as e:
                 RNS.log("An error occurred while updating conversation object option: "+str(e), RNS.LOG_ERROR)
                 self.__db_reconnect()
@@ -2580,7 +3659,7 @@ class SidebandCore():
             result = dbc.fetchall()
 
             try:
-                db.commit()
+                self.__db_commit(db)
             except Exception as e:
                 RNS.log("An error occurred while updating conversation PTT option: "+str(e), RNS.LOG_ERROR)
                 self.__db_reconnect()
@@ -2599,7 +3678,7 @@ class SidebandCore():
             result = dbc.fetchall()
 
             try:
-                db.commit()
+                self.__db_commit(db)
             except Exception as e:
                 RNS.log("An error occurred while updating conversation trusted option: "+str(e), RNS.LOG_ERROR)
                 self.__db_reconnect()
@@ -2607,6 +3686,8 @@ class SidebandCore():
                 #     RNS.log("Retrying operation...", RNS.LOG_ERROR)
                 #     self._db_conversation_set_trusted(context_dest, trusted, is_retry=True)
 
+        self.setstate("app.flags.trust_changed", time.time())
+
     def _db_conversation_set_name(self, context_dest, name):
         with self.db_lock:
             db = self.__db_connect()
@@ -2617,7 +3698,7 @@ class SidebandCore():
             result = dbc.fetchall()
             
             try:
-                db.commit()
+                self.__db_commit(db)
             except Exception as e:
                 RNS.log("An error occurred while updating conversation name option: "+str(e), RNS.LOG_ERROR)
                 self.__db_reconnect()
@@ -2626,102 +3707,204 @@ class SidebandCore():
                 #     self._db_conversation_set_name(context_dest, name, is_retry=True)
 
     def _db_conversations(self, conversations=True, objects=False):
-        with self.db_lock:
-            db = self.__db_connect()
+        # Returns display-ready entries for all conversations, including
+        # resolved display names, flags and appearance. Temporary peer
+        # appearance values are joined in, so the whole list is built
+        # from a single query.
+        with self.__db_read() as db:
             dbc = db.cursor()
             
-            dbc.execute("select * from conv")
+            query  = "select conv.*, persistent.value from conv left join persistent on "
+            query += "persistent.property = CAST('temp.peer_appearance.' || lower(hex(conv.dest_context)) AS BLOB) "
+            query += "and (persistent.expires is null or persistent.expires > :now)"
+            dbc.execute(query, {"now": time.time()})
             result = dbc.fetchall()
 
-            if len(result) < 1:
-                return None
-            else:
-                convs = []
-                for entry in result:
-                    is_object = False
-                    last_rx = entry[1]
-                    last_tx = entry[2]
-                    last_activity = max(last_rx, last_tx)
-                    data = None
+        if len(result) < 1:
+            return None
+        else:
+            convs = []
+            for entry in result:
+                context_dest = entry[0]
+                is_object = False
+                ptt_enabled = False
+                last_tx = entry[1]
+                last_rx = entry[2]
+                last_activity = max(last_rx, last_tx)
+                data = None
+                try:
+                    data = msgpack.unpackb(entry[7])
+                    if "is_object" in data:
+                        is_object = data["is_object"]
+                    if "ptt_enabled" in data:
+                        ptt_enabled = data["ptt_enabled"]
+                except:
+                    pass
+
+                should_add = False
+                if conversations and not is_object:
+                    should_add = True
+                if objects and is_object:
+                    should_add = True
+
+                if should_add:
+                    name = ""
                     try:
-                        data = msgpack.unpackb(entry[7])
-                        if "is_object" in data:
-                            is_object = data["is_object"]
-                    except:
-                        pass
+                        if entry[6] != None: name = entry[6].decode("utf-8")
+                    except Exception as e:
+                        RNS.log(f"Could not decode conversation name for {RNS.prettyhexrep(context_dest)}: {e}", RNS.LOG_ERROR)
+
+                    appearance = None
+                    try:
+                        raw_appearance = None
+                        if context_dest == self.lxmf_destination.hash:
+                            appearance = [self.config["telemetry_icon"], self.config["telemetry_fg"], self.config["telemetry_bg"]]
+                        elif data != None:
+                            if "appearance" in data and data["appearance"] != None:
+                                raw_appearance = data["appearance"]
+                            elif entry[8] != None:
+                                raw_appearance = msgpack.unpackb(entry[8])[0]
+                        if raw_appearance != None:
+                            appearance = self.__decode_appearance(raw_appearance)
+                    except Exception as e:
+                        RNS.log(f"Could not retrieve appearance for {RNS.prettyhexrep(context_dest)}: {e}", RNS.LOG_ERROR)
+
+                    if appearance == None or None in appearance:
+                        appearance = SidebandCore.DEFAULT_APPEARANCE
+
+                    try:
+                        if context_dest == self.lxmf_destination.hash: display_name = self.config["display_name"]
+                        else: display_name = self.__conversation_display_name(context_dest, name, entry[5])
+                    except Exception as e:
+                        RNS.log("Could not decode a valid peer name from data: "+str(e), RNS.LOG_DEBUG)
+                        display_name = RNS.prettyhexrep(context_dest)
 
                     conv = {
-                        "dest": entry[0],
+                        "dest": context_dest,
                         "unread": entry[3],
                         "last_rx": last_rx,
                         "last_tx": last_tx,
                         "last_activity": last_activity,
                         "type": entry[4],
                         "trust": entry[5],
+                        "name": name,
+                        "display_name": display_name,
+                        "is_object": is_object,
+                        "ptt_enabled": ptt_enabled,
+                        "appearance": appearance,
                         "data": data,
                     }
-                    should_add = False
-                    if conversations and not is_object:
-                        should_add = True
-                    if objects and is_object:
-                        should_add = True
 
-                    if should_add:
-                        convs.append(conv)
+                    convs.append(conv)
 
-                return sorted(convs, key=lambda c: c["last_activity"], reverse=True)
+            return sorted(convs, key=lambda c: c["last_activity"], reverse=True)
 
     def _db_announces(self):
-        with self.db_lock:
-            db = self.__db_connect()
+        with self.__db_read() as db:
             dbc = db.cursor()
-            
-            dbc.execute("select * from announce order by received desc")
+
+            dbc.execute(f"select {SidebandCore.ANNOUNCE_COLUMNS} from announce order by received desc, rowid desc")
             result = dbc.fetchall()
 
             if len(result) < 1:
                 return None
             else:
                 announces = []
-                added_dests = []
                 for entry in result:
-                    try:
-                        if not entry[2] in added_dests:
-                            app_data  = entry[3]
-                            dest_type = entry[4]
-                            if entry[5] != None:
-                                try:
-                                    extras = msgpack.unpackb(entry[5])
-                                except Exception as e:
-                                    RNS.log(f"Error while unpacking extras from announce: {e}", RNS.LOG_ERROR)
-                                    extras = None
-                            else:
-                                extras = None
-                            if dest_type == "lxmf.delivery":
-                                announced_name = LXMF.display_name_from_app_data(app_data)
-                                announced_cost = self.message_router.get_outbound_stamp_cost(entry[2])
-                            else:
-                                announced_name = LXMF.pn_name_from_app_data(app_data)
-                                announced_cost = LXMF.pn_stamp_cost_from_app_data(app_data)
-                            announce = {
-                                "dest"  : entry[2],
-                                "name"  : announced_name,
-                                "cost"  : announced_cost,
-                                "time"  : entry[1],
-                                "type"  : dest_type,
-                                "extras": extras,
-                            }
-                            added_dests.append(entry[2])
-                            announces.append(announce)
-                    except Exception as e:
-                        RNS.log("Exception while fetching announce from DB: "+str(e), RNS.LOG_ERROR)
+                    announce = self.__db_announce_from_entry(entry)
+                    if announce != None:
+                        announces.append(announce)
 
                 announces.reverse()
                 return announces
 
+    def _db_announces_page(self, dest_type=None, max_hops=None, since=None, name_prefix=None, cursor=None, limit=None):
+        # Keyset pagination over (received, rowid), newest first. All
+        # filters are resolved from the announce indices, or from the
+        # full-text index for name searches.
+        if limit == None:
+            limit = SidebandCore.ANNOUNCES_PAGE_SIZE
+
+        conditions = []
+        params = {"limit_val": int(limit)}
+        if dest_type != None:
+            conditions.append("dest_type=:dest_type"); params["dest_type"] = dest_type
+        if max_hops != None:
+            conditions.append("hops<=:max_hops"); params["max_hops"] = int(max_hops)
+        if since != None:
+            conditions.append("received>=:since"); params["since"] = since
+        if cursor != None:
+            cursor_ts, cursor_rowid = cursor
+            conditions.append("received<=:cursor_ts and (received<:cursor_ts or rowid<:cursor_rowid)")
+            params["cursor_ts"] = cursor_ts; params["cursor_rowid"] = cursor_rowid
+
+        if name_prefix != None and len(name_prefix.strip()) > 0:
+            search_terms = re.findall(r"\w+", name_prefix)
+            if self.__db_announce_search_available() and len(search_terms) > 0:
+                conditions.append("rowid in (select rowid from announce_fts where announce_fts match :match)")
+                params["match"] = " ".join(f"\"{t}\"*" for t in search_terms)
+            else:
+                name_key = name_prefix.strip().casefold()
+                conditions.append("name_key>=:name_key_lo and name_key<:name_key_hi")
+                params["name_key_lo"] = name_key; params["name_key_hi"] = name_key+"\U0010ffff"
+
+        where_part = " where "+" and ".join(conditions) if len(conditions) > 0 else ""
+        query = f"select {SidebandCore.ANNOUNCE_COLUMNS} from announce{where_part} order by received desc, rowid desc limit :limit_val"
+
+        with self.__db_read() as db:
+            dbc = db.cursor()
+            dbc.execute(query, params)
+            result = dbc.fetchall()
+
+        announces = []
+        for entry in result:
+            announce = self.__db_announce_from_entry(entry)
+            if announce != None:
+                announces.append(announce)
+
+        return announces
+
+    def __db_announce_search_available(self):
+        if self.announce_search_available == None:
+            with self.__db_read() as db:
+                dbc = db.cursor()
+                dbc.execute("select count(*) from sqlite_master where type='table' and name='announce_fts'")
+                self.announce_search_available = dbc.fetchone()[0] > 0
+
+        return self.announce_search_available
+
+    def __db_announce_from_entry(self, entry):
+        try:
+            source, received, app_data, dest_type, extra, name, stamp_cost, hops, rowid = entry
+            extras = None
+            if extra != None:
+                try:
+                    extras = msgpack.unpackb(extra)
+                except Exception as e:
+                    RNS.log(f"Error while unpacking extras from announce: {e}", RNS.LOG_ERROR)
+
+            # Announces stored before stamp costs were recorded fall
+            # back to the cost known by the message router
+            if stamp_cost == None and dest_type == "lxmf.delivery" and self.message_router != None:
+                stamp_cost = self.message_router.get_outbound_stamp_cost(source)
+
+            return {
+                "dest"  : source,
+                "name"  : name,
+                "cost"  : stamp_cost,
+                "time"  : received,
+                "type"  : dest_type,
+                "hops"  : hops,
+                "extras": extras,
+                "cursor": (received, rowid),
+            }
+
+        except Exception as e:
+            RNS.log("Exception while fetching announce from DB: "+str(e), RNS.LOG_ERROR)
+            return None
+
     def _db_conversation(self, context_dest):
-        with self.db_lock:
-            db = self.__db_connect()
+        with self.__db_read() as db:
             dbc = db.cursor()
             
             query = "select * from conv where dest_context=:ctx"
@@ -2752,7 +3935,7 @@ class SidebandCore():
 
             query = "delete from lxm where (dest=:ctx_dst or source=:ctx_dst);"
             dbc.execute(query, {"ctx_dst": context_dest})
-            db.commit()
+            self.__db_commit(db)
 
     def _db_clear_telemetry(self, context_dest):
         RNS.log("Clearing telemetry for "+RNS.prettyhexrep(context_dest), RNS.LOG_DEBUG)
@@ -2762,8 +3945,9 @@ class SidebandCore():
 
             query = "delete from telemetry where dest_context=:ctx_dst;"
             dbc.execute(query, {"ctx_dst": context_dest})
-            db.commit()
+            self.__db_commit(db)
 
+        self.setstate("app.flags.telemetry_cleared", time.time())
         self.setstate("app.flags.last_telemetry", time.time())
 
     def _db_delete_conversation(self, context_dest):
@@ -2774,18 +3958,22 @@ class SidebandCore():
 
             query = "delete from conv where (dest_context=:ctx_dst);"
             dbc.execute(query, {"ctx_dst": context_dest})
-            db.commit()
+            self.__db_commit(db)
 
+        self.setstate("app.flags.trust_changed", time.time())
 
     def _db_delete_announce(self, context_dest):
         RNS.log("Deleting announce with "+RNS.prettyhexrep(context_dest), RNS.LOG_DEBUG)
+        with self.announce_lock:
+            self.pending_announces.pop(context_dest, None)
+
         with self.db_lock:
             db = self.__db_connect()
             dbc = db.cursor()
 
             query = "delete from announce where (source=:ctx_dst);"
             dbc.execute(query, {"ctx_dst": context_dest})
-            db.commit()
+            self.__db_commit(db)
 
     def _db_create_conversation(self, context_dest, name = None, trust = False):
         RNS.log("Creating conversation for "+RNS.prettyhexrep(context_dest), RNS.LOG_DEBUG)
@@ -2798,7 +3986,7 @@ class SidebandCore():
             data = (context_dest, 0, time.time(), 0, SidebandCore.CONV_P2P, 0, def_name, msgpack.packb(None))
 
             dbc.execute(query, data)
-            db.commit()
+            self.__db_commit(db)
 
         if trust:
             self._db_conversation_set_trusted(context_dest, True)
@@ -2819,7 +4007,7 @@ class SidebandCore():
             data = (identity_hash, 0, time.time(), 0, SidebandCore.CONV_VOICE, 0, def_name, msgpack.packb(None))
 
             dbc.execute(query, data)
-            db.commit()
+            self.__db_commit(db)
 
         if trust:
             self._db_conversation_set_trusted(identity_hash, True)
@@ -2837,7 +4025,18 @@ class SidebandCore():
 
             query = "delete from lxm where (lxm_hash=:mhash);"
             dbc.execute(query, {"mhash": msg_hash})
-            db.commit()
+            self.__db_commit(db)
+
+    def _db_save_message_renders(self, renders):
+        # Stores rendered markup for a batch of messages, as a
+        # list of (message hash, render key, markup) entries
+        with self.db_lock:
+            db = self.__db_connect()
+            dbc = db.cursor()
+
+            query = "UPDATE lxm set render_key = ?, render = ? where lxm_hash = ?"
+            dbc.executemany(query, [(render_key, markup, msg_hash) for msg_hash, render_key, markup in renders])
+            self.__db_commit(db)
 
     def _db_clean_messages(self):
         RNS.log("Purging stale messages... ", RNS.LOG_DEBUG)
@@ -2847,7 +4046,7 @@ class SidebandCore():
 
             query = "delete from lxm where (state=:outbound_state or state=:sending_state);"
             dbc.execute(query, {"outbound_state": LXMF.LXMessage.OUTBOUND, "sending_state": LXMF.LXMessage.SENDING})
-            db.commit()
+            self.__db_commit(db)
 
     def _db_clean_telemetry(self):
         RNS.log("Cleaning telemetry... ", RNS.LOG_DEBUG)
@@ -2858,7 +4057,7 @@ class SidebandCore():
 
             query = f"delete from telemetry where (ts < {clean_time});"
             dbc.execute(query, {"outbound_state": LXMF.LXMessage.OUTBOUND, "sending_state": LXMF.LXMessage.SENDING})
-            db.commit()
+            self.__db_commit(db)
 
             self.last_telemetry_clean = time.time()
 
@@ -2899,7 +4098,7 @@ class SidebandCore():
             dbc.execute(query, data)
 
             try:
-                db.commit()
+                self.__db_commit(db)
                 result = dbc.fetchall()
             except Exception as e:
                 RNS.log("An error occurred while updating message state: "+str(e), RNS.LOG_ERROR)
@@ -2918,7 +4117,7 @@ class SidebandCore():
             dbc.execute(query, data)
 
             try:
-                db.commit()
+                self.__db_commit(db)
                 result = dbc.fetchall()
             except Exception as e:
                 RNS.log("An error occurred while updating message method: "+str(e), RNS.LOG_ERROR)
@@ -2931,8 +4130,7 @@ class SidebandCore():
         return self._db_message(msg_hash)
 
     def _db_message(self, msg_hash):
-        with self.db_lock:
-            db = self.__db_connect()
+        with self.__db_read() as db:
             dbc = db.cursor()
             
             query = "select * from lxm where lxm_hash=:mhash"
@@ -2942,45 +4140,46 @@ class SidebandCore():
             if len(result) < 1:
                 return None
             else:
-                entry = result[0]
-
-                lxm_method = entry[7]
-                if lxm_method == LXMF.LXMessage.PAPER:
-                    lxm_data = msgpack.unpackb(entry[10])
-                    packed_lxm = lxm_data[0]
-                    paper_packed_lxm = lxm_data[1]
-                else:
-                    packed_lxm = entry[10]
+                return self.__db_message_from_entry(result[0])
+
+    def __db_message_from_entry(self, entry):
+        lxm_method = entry[7]
+        if lxm_method == LXMF.LXMessage.PAPER:
+            lxm_data = msgpack.unpackb(entry[10])
+            packed_lxm = lxm_data[0]
+            paper_packed_lxm = lxm_data[1]
+        else:
+            packed_lxm = entry[10]
 
-                extras = None
-                try:
-                    extras = msgpack.unpackb(entry[11])
-                except:
-                    pass
+        lxm = LXMF.LXMessage.unpack_from_bytes(packed_lxm, original_method = lxm_method)
+        
+        if lxm.desired_method == LXMF.LXMessage.PAPER:
+            lxm.paper_packed = paper_packed_lxm
 
-                lxm = LXMF.LXMessage.unpack_from_bytes(packed_lxm, original_method = lxm_method)
-
-                if lxm.desired_method == LXMF.LXMessage.PAPER:
-                    lxm.paper_packed = paper_packed_lxm
-
-                message = {
-                    "hash": lxm.hash,
-                    "dest": lxm.destination_hash,
-                    "source": lxm.source_hash,
-                    "title": lxm.title,
-                    "content": lxm.content,
-                    "received": entry[5],
-                    "sent": lxm.timestamp,
-                    "state": entry[6],
-                    "method": entry[7],
-                    "lxm": lxm,
-                    "extras": extras,
-                }
-                return message
+        extras = None
+        try: extras = msgpack.unpackb(entry[11])
+        except: pass
+        
+        message = {
+            "hash": lxm.hash,
+            "dest": lxm.destination_hash,
+            "source": lxm.source_hash,
+            "title": lxm.title,
+            "content": lxm.content,
+            "received": entry[5],
+            "sent": lxm.timestamp,
+            "state": entry[6],
+            "method": entry[7],
+            "lxm": lxm,
+            "extras": extras,
+            "render_key": entry[12] if len(entry) > 13 else None,
+            "render": entry[13] if len(entry) > 13 else None,
+        }
+
+        return message
 
     def _db_message_count(self, context_dest):
-        with self.db_lock:
-            db = self.__db_connect()
+        with self.__db_read() as db:
             dbc = db.cursor()
             
             query = "select count(*) from lxm where dest=:context_dest or source=:context_dest"
@@ -2993,37 +4192,31 @@ class SidebandCore():
             else:
                 return result[0][0]
 
+    def __db_context_messages_query(self, condition, limit=None):
+        # Split the dest/source condition into a union of two queries,
+        # so that each side can be resolved by walking its own index in
+        # rx_ts order, and the limit is applied before rows are merged.
+        limit_part = " LIMIT :limit_val" if limit != None else ""
+        order_part = " ORDER BY rx_ts DESC, lxm_hash DESC"
+        query  = f"select * from (select * from lxm where dest=:context_dest{condition}{order_part}{limit_part})"
+        query += f" UNION select * from (select * from lxm where source=:context_dest{condition}{order_part}{limit_part})"
+        query += f"{order_part}{limit_part}"
+        return query
+
     def _db_messages(self, context_dest, after = None, before = None, limit = None):
-        with self.db_lock:
-            db = self.__db_connect()
+        with self.__db_read() as db:
             dbc = db.cursor()
 
-            base_condition = "(dest=:context_dest or source=:context_dest)"
-            if after != None and before == None:
-                query = f"select * from lxm where {base_condition} and rx_ts>:after_ts ORDER BY rx_ts DESC"
-                params = {"context_dest": context_dest, "after_ts": after}
-                if limit is not None:
-                    query += f" LIMIT :limit_val"; params["limit_val"] = int(limit)
-                dbc.execute(query, params)
-            elif after == None and before != None:
-                query = f"select * from lxm where {base_condition} and rx_ts<:before_ts ORDER BY rx_ts DESC"
-                params = {"context_dest": context_dest, "before_ts": before}
-                if limit is not None:
-                    query += f" LIMIT :limit_val"; params["limit_val"] = int(limit)
-                dbc.execute(query, params)
-            elif after != None and before != None:
-                query = f"select * from lxm where {base_condition} and rx_ts<:before_ts and rx_ts>:after_ts ORDER BY rx_ts DESC"
-                params = {"context_dest": context_dest, "before_ts": before, "after_ts": after}
-                if limit is not None:
-                    query += f" LIMIT :limit_val"; params["limit_val"] = int(limit)
-                dbc.execute(query, params)
-            else:
-                query = f"select * from lxm where {base_condition} ORDER BY rx_ts DESC"
-                params = {"context_dest": context_dest}
-                if limit is not None:
-                    query += f" LIMIT :limit_val"; params["limit_val"] = int(limit)
-                dbc.execute(query, params)
+            condition = ""
+            params = {"context_dest": context_dest}
+            if after != None:
+                condition += " and rx_ts>:after_ts"; params["after_ts"] = after
+            if before != None:
+                condition += " and rx_ts<:before_ts"; params["before_ts"] = before
+            if limit != None:
+                params["limit_val"] = int(limit)
 
+            dbc.execute(self.__db_context_messages_query(condition, limit), params)
             result = dbc.fetchall()
 
             if len(result) < 1:
@@ -3031,42 +4224,40 @@ class SidebandCore():
             else:
                 messages = []
                 for entry in result:
-                    lxm_method = entry[7]
-                    if lxm_method == LXMF.LXMessage.PAPER:
-                        lxm_data = msgpack.unpackb(entry[10])
-                        packed_lxm = lxm_data[0]
-                        paper_packed_lxm = lxm_data[1]
-                    else:
-                        packed_lxm = entry[10]
+                    messages.append(self.__db_message_from_entry(entry))
 
-                    lxm = LXMF.LXMessage.unpack_from_bytes(packed_lxm, original_method = lxm_method)
-                    
-                    if lxm.desired_method == LXMF.LXMessage.PAPER:
-                        lxm.paper_packed = paper_packed_lxm
+                messages.reverse()
+                return messages
 
-                    extras = None
-                    try: extras = msgpack.unpackb(entry[11])
-                    except: pass
-                    
-                    message = {
-                        "hash": lxm.hash,
-                        "dest": lxm.destination_hash,
-                        "source": lxm.source_hash,
-                        "title": lxm.title,
-                        "content": lxm.content,
-                        "received": entry[5],
-                        "sent": lxm.timestamp,
-                        "state": entry[6],
-                        "method": entry[7],
-                        "lxm": lxm,
-                        "extras": extras,
-                    }
+    def _db_messages_page(self, context_dest, cursor = None, limit = None):
+        # Keyset pagination over (rx_ts, lxm_hash). The cursor is the key
+        # of the earliest message already loaded, and the page consists of
+        # the messages immediately preceding it. Since each page is read
+        # directly from the context indices, the cost of loading a page
+        # does not depend on how many messages are stored in total.
+        if limit == None:
+            limit = SidebandCore.MESSAGES_PAGE_SIZE
 
-                    messages.append(message)
+        with self.__db_read() as db:
+            dbc = db.cursor()
 
-                messages.reverse()
-                if len(messages) > limit: messages = messages[-limit:]
-                return messages
+            condition = ""
+            params = {"context_dest": context_dest, "limit_val": int(limit)}
+            if cursor != None:
+                cursor_ts, cursor_hash = cursor
+                condition = " and rx_ts<=:cursor_ts and (rx_ts<:cursor_ts or lxm_hash<:cursor_hash)"
+                params["cursor_ts"] = cursor_ts
+                params["cursor_hash"] = cursor_hash
+
+            dbc.execute(self.__db_context_messages_query(condition, limit), params)
+            result = dbc.fetchall()
+
+            messages = []
+            for entry in result:
+                messages.append(self.__db_message_from_entry(entry))
+
+            messages.reverse()
+            return messages
 
     def _db_save_lxm(self, lxm, context_dest, originator = False, own_command = False, is_retry = False):
         state = lxm.state
@@ -3090,19 +4281,11 @@ class SidebandCore():
                 if LXMF.FIELD_TELEMETRY_STREAM in lxm.fields:
                     max_timebase = self.getpersistent(f"telemetry.{RNS.hexrep(context_dest, delimit=False)}.timebase") or 0
                     if lxm.fields[LXMF.FIELD_TELEMETRY_STREAM] != None and len(lxm.fields[LXMF.FIELD_TELEMETRY_STREAM]) > 0:
-                        for telemetry_entry in lxm.fields[LXMF.FIELD_TELEMETRY_STREAM]:
-                            tsource = telemetry_entry[0]
-                            ttstamp = telemetry_entry[1]
-                            tpacked = telemetry_entry[2]
-                            appearance = telemetry_entry[3]
-                            max_timebase = max(max_timebase, ttstamp)
-
-                            if self._db_save_telemetry(tsource, tpacked, via = context_dest):
-                                RNS.log("Saved telemetry stream entry from "+RNS.prettyhexrep(tsource), RNS.LOG_DEBUG)
-                                if appearance != None:
-                                    self._db_update_appearance(tsource, ttstamp, appearance, from_bulk_telemetry=True)
-                                    RNS.log("Updated appearance entry from "+RNS.prettyhexrep(tsource), RNS.LOG_DEBUG)
+                        telemetry_stream = lxm.fields[LXMF.FIELD_TELEMETRY_STREAM]
+                        for telemetry_entry in telemetry_stream:
+                            max_timebase = max(max_timebase, telemetry_entry[1])
 
+                        self._db_save_telemetry_stream(context_dest, telemetry_stream)
                         self.setpersistent(f"telemetry.{RNS.hexrep(context_dest, delimit=False)}.timebase", max_timebase)
 
                     else:
@@ -3166,7 +4349,7 @@ class SidebandCore():
                 dbc.execute(query, data)
 
                 try:
-                    db.commit()
+                    self.__db_commit(db)
                 except Exception as e:
                     RNS.log("An error occurred while saving message to database: "+str(e), RNS.LOG_ERROR)
                     self.__db_reconnect()
@@ -3177,34 +4360,49 @@ class SidebandCore():
 
             self.__event_conversation_changed(context_dest)
 
-    def _db_save_announce(self, destination_hash, app_data, dest_type="lxmf.delivery", link_stats = None):
-        with self.db_lock:
-            db = self.__db_connect()
-            dbc = db.cursor()
-
-            query = "delete from announce where id is NULL or id not in (select id from announce order by received desc limit "+str(self.MAX_ANNOUNCES)+")"
-            dbc.execute(query)
-
-            query = "delete from announce where (source=:source);"
-            dbc.execute(query, {"source": destination_hash})
-
-            now = time.time()
-            hash_material = str(time).encode("utf-8")+destination_hash+app_data+dest_type.encode("utf-8")
-            announce_hash = RNS.Identity.full_hash(hash_material)
-            extras = msgpack.packb({"link_stats": link_stats})
+    def _db_save_announces(self):
+        # Writes all pending announces, and returns the number of
+        # announces written. Rows are prepared before taking the
+        # database lock, and written in batches of ANNOUNCE_WRITE_BATCH,
+        # releasing the lock between batches, so messages and telemetry
+        # can be saved while a large set of announces is written.
+        # Flushes are serialised by announce_flush_lock, so pending sets
+        # are always written in the order they were received.
+        with self.announce_flush_lock:
+            with self.announce_lock:
+                self.announce_flush_scheduled = False
+                if len(self.pending_announces) == 0:
+                    return 0
+                pending = self.pending_announces
+                self.pending_announces = OrderedDict()
+
+            entries = []
+            for destination_hash, (received, app_data, dest_type, stamp_cost, hops, link_stats) in pending.items():
+                hash_material = str(time).encode("utf-8")+destination_hash+app_data+dest_type.encode("utf-8")
+                announce_hash = RNS.Identity.full_hash(hash_material)
+                extras = msgpack.packb({"link_stats": link_stats})
+                name, name_key, stamp_cost = self.__db_announce_columns(app_data, dest_type, stamp_cost)
+                entries.append((announce_hash, received, destination_hash, app_data, dest_type, extras, name, name_key, stamp_cost, hops))
+
+            query  = "INSERT INTO announce (id, received, source, data, dest_type, extra, name, name_key, stamp_cost, hops) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            query += "ON CONFLICT(source) DO UPDATE SET id=excluded.id, received=excluded.received, data=excluded.data, dest_type=excluded.dest_type, "
+            query += "extra=excluded.extra, name=excluded.name, name_key=excluded.name_key, stamp_cost=excluded.stamp_cost, hops=excluded.hops"
+            for offset in range(0, len(entries), SidebandCore.ANNOUNCE_WRITE_BATCH):
+                with self.db_lock:
+                    db = self.__db_connect()
+                    dbc = db.cursor()
+                    dbc.executemany(query, entries[offset:offset+SidebandCore.ANNOUNCE_WRITE_BATCH])
+                    self.__db_commit(db)
 
-            query = "INSERT INTO announce (id, received, source, data, dest_type, extra) values (?, ?, ?, ?, ?, ?)"
-            data = (
-                announce_hash,
-                now,
-                destination_hash,
-                app_data,
-                dest_type,
-                extras,
-            )
+            # Trim the directory to the newest MAX_ANNOUNCES entries
+            with self.db_lock:
+                db = self.__db_connect()
+                dbc = db.cursor()
+                query = "delete from announce where received < (select received from announce order by received desc limit 1 offset :offset)"
+                dbc.execute(query, {"offset": self.MAX_ANNOUNCES-1})
+                self.__db_commit(db)
 
-            dbc.execute(query, data)
-            db.commit()
+            return len(entries)
 
     def lxmf_announce(self, attached_interface=None):
         if self.is_standalone or self.is_service:
@@ -3262,21 +4460,23 @@ class SidebandCore():
         self.setstate("app.flags.last_telemetry", time.time())
 
     def mqtt_handle_telemetry(self, context_dest, telemetry):
+        # Telemetry is only queued here, and published by the worker
+        # of the MQTT handler over a persistent connection
         with self.mqtt_handle_lock:
-            if hasattr(self, "last_mqtt_recycle") and time.time() > self.last_mqtt_recycle + 60*4:
-                self.mqtt.stop()
-                self.mqtt.client = None
-                self.mqtt = None
-                gc.collect()
-
             if self.mqtt == None:
                 self.mqtt = MQTT()
-                self.last_mqtt_recycle = time.time()
 
-            self.mqtt.set_server(self.config["telemetry_mqtt_host"], self.config["telemetry_mqtt_port"])
-            self.mqtt.set_auth(self.config["telemetry_mqtt_user"], self.config["telemetry_mqtt_pass"])
+            self.mqtt.configure(self.config["telemetry_mqtt_host"], self.config["telemetry_mqtt_port"],
+                                self.config["telemetry_mqtt_user"], self.config["telemetry_mqtt_pass"],
+                                self.config["telemetry_mqtt_retain"])
             self.mqtt.handle(context_dest, telemetry)
 
+    def get_mqtt_stats(self):
+        if self.mqtt == None:
+            return None
+        else:
+            return self.mqtt.get_stats()
+
     def update_telemetry(self):
         try:
             try: latest_telemetry = deepcopy(self.latest_telemetry)
@@ -3380,9 +4580,7 @@ class SidebandCore():
             self.update_telemeter_config()
             if self.telemeter != None:
                 if self.config["telemetry_to_mqtt"]:
-                    def mqtt_job():
-                        self.mqtt_handle_telemetry(self.lxmf_destination.hash, self.telemeter.packed())
-                    threading.Thread(target=mqtt_job, daemon=True).start()
+                    self.mqtt_handle_telemetry(self.lxmf_destination.hash, self.telemeter.packed())
                 return self.telemeter.read_all()
             else:
                 return {}
@@ -3674,6 +4872,9 @@ class SidebandCore():
                                     self.setpersistent("lxmf.lastsync", time.time())
                                     self.setpersistent("lxmf.syncretrying", False)
 
+                if time.time()-self.last_persistent_purge > SidebandCore.PERSISTENT_PURGE_INTERVAL:
+                    self._db_purge_persistent()
+
                 if self.config["telemetry_enabled"]:
                     if time.time()-self.last_telemetry_clean > self.telemetry_clean_interval:
                         self._db_clean_telemetry()
@@ -4124,6 +5325,7 @@ class SidebandCore():
             exit(255)
 
         if self.is_service:
+            self.__init_rpc_handlers()
             self.__start_rpc_listener()
 
         if RNS.vendor.platformutils.get_platform() == "android":
@@ -4951,6 +6153,9 @@ class SidebandCore():
                     if self.gui_display() == "conversations_screen" and self.gui_foreground():
                         should_notify = False
 
+            if not originator and LXMF.FIELD_AUDIO in message.fields and not ptt_enabled:
+                self.audio_pretranscode(message.fields[LXMF.FIELD_AUDIO])
+
             if not originator and LXMF.FIELD_AUDIO in message.fields and ptt_enabled:
                 self.ptt_event(message)
                 if self.gui_conversation() != context_dest:
@@ -5001,19 +6206,9 @@ class SidebandCore():
                         self.last_msg_audio = None
                         return
 
-                    if audio_field[0] == LXMF.AM_OPUS_OGG:
-                        temp_path = os.path.join(self.rec_cache, "ptt_msg.ogg")
-                        with open(temp_path, "wb") as af: af.write(self.last_msg_audio)
-
-                    elif audio_field[0] >= LXMF.AM_CODEC2_700C and audio_field[0] <= LXMF.AM_CODEC2_3200:
-                        temp_path = os.path.join(self.rec_cache, "ptt_msg.ogg")
-                        from sideband.audioproc import samples_to_ogg, decode_codec2, detect_codec2
-                        
-                        target_rate = 48000
-                        if detect_codec2():
-                            if samples_to_ogg(decode_codec2(audio_field[1], audio_field[0]), temp_path, input_rate=8000, output_rate=target_rate): RNS.log("Wrote OGG file to: "+temp_path, RNS.LOG_DEBUG)
-                            else: RNS.log("OGG write failed", RNS.LOG_DEBUG)
-                        else:
+                    if audio_field[0] == LXMF.AM_OPUS_OGG or (audio_field[0] >= LXMF.AM_CODEC2_700C and audio_field[0] <= LXMF.AM_CODEC2_3200):
+                        temp_path = self.audio_playback_path(audio_field)
+                        if temp_path == None:
                             self.last_msg_audio = None
                             return
                     
@@ -5040,6 +6235,117 @@ class SidebandCore():
                 RNS.log("Error while playing message audio:"+str(e))
                 RNS.trace_exception(e)
 
+    def audio_playback_path(self, audio_field):
+        # Returns the path of a playable OGG file for an LXMF audio field.
+        # Transcoded audio is cached in the temporary directory, keyed by
+        # a hash of the audio field, so repeated playback of the same
+        # message does not transcode it again.
+        try:
+            audio_mode = audio_field[0]; audio_data = audio_field[1]
+            audio_hash = RNS.Identity.full_hash(struct.pack("!B", audio_mode)+audio_data)
+            cache_path = os.path.join(self.tmp_dir, "audio_"+RNS.hexrep(audio_hash[:16], delimit=False)+".ogg")
+
+            if os.path.isfile(cache_path):
+                os.utime(cache_path)
+                return cache_path
+
+            # Only transcodes of the same audio wait for each other
+            with self.audio_transcode_lock:
+                if not cache_path in self.audio_transcode_locks:
+                    self.audio_transcode_locks[cache_path] = threading.Lock()
+                transcode_lock = self.audio_transcode_locks[cache_path]
+
+            try:
+                with transcode_lock:
+                    return self.__audio_transcode(audio_mode, audio_data, cache_path)
+            finally:
+                with self.audio_transcode_lock:
+                    if self.audio_transcode_locks.get(cache_path) == transcode_lock:
+                        self.audio_transcode_locks.pop(cache_path)
+
+        except Exception as e:
+            RNS.log(f"Error while preparing audio for playback: {e}", RNS.LOG_ERROR)
+            RNS.trace_exception(e)
+            return None
+
+    def __audio_transcode(self, audio_mode, audio_data, cache_path):
+        if os.path.isfile(cache_path):
+            os.utime(cache_path)
+            return cache_path
+
+        transcode_path = cache_path+".tmp"
+        try:
+            if audio_mode == LXMF.AM_OPUS_OGG:
+                with open(transcode_path, "wb") as af: af.write(audio_data)
+
+            elif audio_mode >= LXMF.AM_CODEC2_700C and audio_mode <= LXMF.AM_CODEC2_3200:
+                from sideband.audioproc import samples_to_ogg, decode_codec2, detect_codec2
+                target_rate = 48000
+                if not detect_codec2():
+                    return None
+                if samples_to_ogg(decode_codec2(audio_data, audio_mode), transcode_path, input_rate=8000, output_rate=target_rate):
+                    RNS.log("Wrote OGG file to: "+cache_path, RNS.LOG_DEBUG)
+                else:
+                    RNS.log("OGG write failed", RNS.LOG_DEBUG)
+                    return None
+
+            else:
+                raise NotImplementedError(audio_mode)
+
+            os.replace(transcode_path, cache_path)
+
+        finally:
+            # A failed transcode must not leave partial output behind
+            if os.path.isfile(transcode_path):
+                try: os.unlink(transcode_path)
+                except Exception as e: RNS.log(f"Could not remove partial audio file {transcode_path}: {e}", RNS.LOG_DEBUG)
+
+        self.__evict_audio_cache()
+        return cache_path
+
+    def __evict_audio_cache(self):
+        entries = []
+        for file in os.listdir(self.tmp_dir):
+            if file.startswith("audio_") and file.endswith(".ogg"):
+                fpath = os.path.join(self.tmp_dir, file)
+                st = os.stat(fpath)
+                entries.append((st.st_mtime, st.st_size, fpath))
+
+        cache_size = sum(e[1] for e in entries)
+        for mtime, size, fpath in sorted(entries):
+            if cache_size <= SidebandCore.AUDIO_CACHE_SIZE:
+                break
+            try:
+                os.unlink(fpath)
+                cache_size -= size
+            except Exception as e:
+                RNS.log(f"Could not remove cached audio file {fpath}: {e}", RNS.LOG_DEBUG)
+
+    def audio_pretranscode(self, audio_field):
+        # Transcodes received audio in the background, so it is ready
+        # from the cache when it is played. This is done one message
+        # at a time on a single worker, and skipped entirely when
+        # running without a UI, since nothing will play it.
+        if self.is_daemon:
+            return
+
+        with self.audio_pretranscode_condition:
+            self.audio_pretranscode_queue.append(audio_field)
+            if self.audio_pretranscode_worker == None:
+                self.audio_pretranscode_worker = threading.Thread(target=self.__audio_pretranscode_job, daemon=True)
+                self.audio_pretranscode_worker.start()
+            else:
+                self.audio_pretranscode_condition.notify()
+
+    def __audio_pretranscode_job(self):
+        while True:
+            with self.audio_pretranscode_condition:
+                while len(self.audio_pretranscode_queue) == 0:
+                    self.audio_pretranscode_condition.wait()
+                audio_field = self.audio_pretranscode_queue.popleft()
+
+            self.audio_playback_path(audio_field)
+
     def ptt_event(self, message):
         def ptt_job():
             while self.ui_recording: time.sleep(0.5)
@@ -5295,30 +6601,9 @@ class SidebandCore():
             RNS.log("Not sending new telemetry collector response, since an earlier transfer is already in progress", RNS.LOG_DEBUG)
             return "in_progress"
 
-        added_sources = {}
-        sources = self.list_telemetry(after=timebase)
         only_latest = self.config["telemetry_requests_only_send_latest"]
-
-        elements = 0; added = 0
-        telemetry_stream = []
-        for source in sources:
-            if source in self.telemetry_response_excluded:
-                RNS.log(f"Excluding {RNS.prettyhexrep(source)} from collector response", RNS.LOG_DEBUG)
-            else:
-                if source != to_addr:
-                    for entry in sources[source]:
-                        elements += 1
-                        timestamp = entry[0]; packed_telemetry = entry[1]
-                        appearance = self._db_get_appearance(source, raw=True)
-                        te = [source, timestamp, packed_telemetry, appearance]
-                        if only_latest:
-                            if not source in added_sources:
-                                added_sources[source] = True
-                                telemetry_stream.append(te)
-                                added += 1
-                        else:
-                            telemetry_stream.append(te)
-                            added += 1
+        entries = self.__telemetry_collector_entries(timebase, only_latest)
+        telemetry_stream = [te for te in entries if te[0] != to_addr and (timebase == None or te[1] > timebase)]
 
         if len(telemetry_stream) == 0:
             RNS.log(f"No new telemetry for request with timebase {timebase}", RNS.LOG_DEBUG)
@@ -5330,6 +6615,52 @@ class SidebandCore():
             is_collector_response=is_collector_response,
         )
 
+    def __telemetry_collector_entries(self, timebase, only_latest):
+        # Collector response entries for all sources are built from the
+        # start of the timebase bucket, and cached, so requests with
+        # similar timebases share one database scan. The cached entries
+        # are used until new telemetry is saved, telemetry is cleared,
+        # or the cache TTL expires. Callers must drop entries at or
+        # before their own timebase.
+        bucket_size = SidebandCore.TELEMETRY_RESPONSE_BUCKET
+        after = int(timebase//bucket_size)*bucket_size if timebase != None else None
+        excluded = frozenset(self.telemetry_response_excluded)
+        key = (after, only_latest, excluded)
+
+        cleared = self.getstate("app.flags.telemetry_cleared", allow_cache=True) or 0
+        with self.__db_read() as db:
+            dbc = db.cursor()
+            dbc.execute("select max(id) from telemetry")
+            validity = (dbc.fetchone()[0] or 0, cleared)
+
+        now = time.time()
+        with self.telemetry_response_lock:
+            cached = self.telemetry_response_cache.get(key)
+            if cached != None and cached[0] == validity and now < cached[1]+SidebandCore.TELEMETRY_RESPONSE_CACHE_TTL:
+                self.telemetry_response_cache.move_to_end(key)
+                return cached[2]
+
+        if only_latest:
+            sources = {source: [entry] for source, entry in self._db_latest_telemetry(after=after).items()}
+        else:
+            sources = self.list_telemetry(after=after)
+
+        entries = []
+        for source in sources:
+            if source in excluded:
+                RNS.log(f"Excluding {RNS.prettyhexrep(source)} from collector response", RNS.LOG_DEBUG)
+            else:
+                appearance = self._db_get_appearance(source, raw=True)
+                for timestamp, packed_telemetry in sources[source]:
+                    entries.append([source, timestamp, packed_telemetry, appearance])
+
+        with self.telemetry_response_lock:
+            self.telemetry_response_cache.pop(key, None)
+            self.telemetry_response_cache[key] = (validity, now, entries)
+            while len(self.telemetry_response_cache) > SidebandCore.TELEMETRY_RESPONSE_CACHE_SIZE:
+                self.telemetry_response_cache.popitem(last=False)
+
+        return entries
 
     def get_display_name_bytes(self):
         return self.config["display_name"].encode("utf-8")
@@ -1,8 +1,12 @@
 import os
+import sys
 import time
 import mmap
 import struct
+import threading
 import RNS
+import numpy as np
+from collections import OrderedDict
 from math import pi, sin, cos, acos, asin, tan, atan, atan2
 from math import radians, degrees, sqrt
 
@@ -14,7 +18,7 @@ from math import radians, degrees, sqrt
 
 # Planetary metrics
 equatorial_radius    = 6378.137 *1e3
-polar_radius         = 6356.7523142 *1e3
+polar_radius         = 6356.752314245179 *1e3
 ellipsoid_flattening = 1-(polar_radius/equatorial_radius)
 eccentricity_squared = 2*ellipsoid_flattening-pow(ellipsoid_flattening,2)
 ###############################
@@ -108,30 +112,29 @@ def spherical_distance(c1, c2, altitude=0, r=mean_earth_radius):
     return d
 
 def ellipsoid_distance(c1, c2):
-    # TODO: Update this to the method described by Karney in 2013
-    # instead of using Vincenty's algorithm.
+    # Single pairs are solved with Vincenty's algorithm, which is fast
+    # in plain Python. Pairs where it converges poorly, such as nearly
+    # antipodal points, are solved with the method described by Karney
+    # in 2013 instead.
     try:
         if c1[:2] == c2[:2]:
             return 0
 
-        if c1[0] == 0.0: c1 = (1e-6, c1[1])
         a = equatorial_radius
         f = ellipsoid_flattening
         b = (1 - f)*a # polar radius
-        tolerance = 1e-9 # to stop iteration
+        tolerance = 1e-12 # to stop iteration
+        max_iterations = 100
 
         phi1, phi2 = radians(c1[0]), radians(c2[0])
         U1 = atan((1-f)*tan(phi1))
         U2 = atan((1-f)*tan(phi2))
         L1, L2 = radians(c1[1]), radians(c2[1])
-        L = L2 - L1
+        L = (L2 - L1 + pi)%(2*pi) - pi
 
         lambda_old = L + 0
 
-        max_iterations = 10000
         iteration = 0
-        timeout = 1.0
-        st = time.time()
         while True:
             iteration += 1
             t = (cos(U2)*sin(lambda_old))**2
@@ -139,10 +142,13 @@ def ellipsoid_distance(c1, c2):
             sin_sigma = t**0.5
             cos_sigma = sin(U1)*sin(U2) + cos(U1)*cos(U2)*cos(lambda_old)
             sigma = atan2(sin_sigma, cos_sigma)
-        
+            if sin_sigma == 0:
+                break
+
             sin_alpha = cos(U1)*cos(U2)*sin(lambda_old) / sin_sigma
             cos_sq_alpha = 1 - sin_alpha**2
-            cos_2sigma_m = cos_sigma - 2*sin(U1)*sin(U2)/cos_sq_alpha
+            # Lines along the equator have cos_sq_alpha = 0
+            cos_2sigma_m = cos_sigma - 2*sin(U1)*sin(U2)/cos_sq_alpha if cos_sq_alpha != 0 else 0.0
             C = f*cos_sq_alpha*(4 + f*(4-3*cos_sq_alpha))/16
         
             t = sigma + C*sin_sigma*(cos_2sigma_m + C*cos_sigma*(-1 + 2*cos_2sigma_m**2))
@@ -152,18 +158,21 @@ def ellipsoid_distance(c1, c2):
             else:
                 lambda_old = lambda_new
 
-            if iteration%1000 == 0:
-                if iteration >= max_iterations:
-                    return None
-                
-                if time.time() > st+timeout:
-                    return None
+            # Near antipodal points, the iteration converges slowly or
+            # not at all, and the longitude difference on the auxiliary
+            # sphere can exceed pi
+            if iteration >= max_iterations or abs(lambda_new) > pi:
+                return float(geodesic_inverse(c1[0], c1[1], c2[0], c2[1])[0])
+
+        if sin_sigma == 0:
+            return float(geodesic_inverse(c1[0], c1[1], c2[0], c2[1])[0])
 
         u2 = cos_sq_alpha*((a**2 - b**2)/b**2)
         A = 1 + (u2/16384)*(4096 + u2*(-768+u2*(320 - 175*u2)))
         B = (u2/1024)*(256 + u2*(-128 + u2*(74 - 47*u2)))
-        t = cos_2sigma_m + 0.25*B*(cos_sigma*(-1 + 2*cos_2sigma_m**2))
+        t = cos_sigma*(-1 + 2*cos_2sigma_m**2)
         t -= (B/6)*cos_2sigma_m*(-3 + 4*sin_sigma**2)*(-3 + 4*cos_2sigma_m**2)
+        t = cos_2sigma_m + 0.25*B*t
         delta_sigma = B * sin_sigma * t
         s = b*A*(sigma - delta_sigma)
         return s
@@ -294,12 +303,111 @@ def shared_radio_horizon(c1, c2,):
         "antenna_distance": antenna_distance
     }
 
+# Batch versions of the functions above. These take one origin
+# coordinate, and arrays of latitudes, longitudes and altitudes for
+# any number of target points, and return arrays of results.
+
+def euclidian_points(latitudes, longitudes, altitudes=0.0, ellipsoid=True):
+    lat = np.radians(latitudes); lon = np.radians(longitudes)
+    if ellipsoid:
+        a = equatorial_radius; b = polar_radius
+        cl = np.cos(lat); sl = np.sin(lat)
+        r = np.sqrt(((a*a*cl)**2 + (b*b*sl)**2) / ((a*cl)**2 + (b*sl)**2))
+        gclat = np.arctan((1.0 - eccentricity_squared) * np.tan(lat))
+    else:
+        r = mean_earth_radius
+        gclat = lat
+
+    normal_x = np.cos(lat)*np.cos(lon)
+    normal_y = np.cos(lat)*np.sin(lon)
+    normal_z = np.sin(lat)
+    x = np.cos(lon)*np.cos(gclat)*r + altitudes*normal_x
+    y = np.cos(gclat)*np.sin(lon)*r + altitudes*normal_y
+    z = np.sin(gclat)*r + altitudes*normal_z
+
+    return (x, y, z, normal_x, normal_y, normal_z)
+
+def euclidian_distances(c, latitudes, longitudes, altitudes=0.0, ellipsoid=True):
+    alt = c[2] if len(c) > 2 else 0.0
+    p1 = euclidian_points(c[0], c[1], alt, ellipsoid=ellipsoid)
+    p2 = euclidian_points(latitudes, longitudes, altitudes, ellipsoid=ellipsoid)
+    return np.sqrt((p1[0]-p2[0])**2 + (p1[1]-p2[1])**2 + (p1[2]-p2[2])**2)
+
+def spherical_distances(c, latitudes, longitudes, altitude=0, r=mean_earth_radius):
+    lat1 = radians(c[0]); lon1 = radians(c[1])
+    lat2 = np.radians(latitudes); lon2 = np.radians(longitudes)
+    ca = np.arccos(np.clip(sin(lat1)*np.sin(lat2) + cos(lat1)*np.cos(lat2)*np.cos(np.abs(lon1-lon2)), -1.0, 1.0))
+    return (r+altitude)*ca
+
+def ellipsoid_distances(c, latitudes, longitudes):
+    return geodesic_inverse(c[0], c[1], latitudes, longitudes)[0]
+
+def orthodromic_distances(c, latitudes, longitudes, ellipsoid=True):
+    if ellipsoid:
+        return ellipsoid_distances(c, latitudes, longitudes)
+    else:
+        return spherical_distances(c, latitudes, longitudes)
+
+def azalts(c, latitudes, longitudes, altitudes=0.0, ellipsoid=True):
+    # Returns arrays of azimuths and altitudes of the target points as
+    # seen from the origin, with NaN where they are undefined
+    alt = c[2] if len(c) > 2 else 0.0
+    c2rp = euclidian_points(latitudes, np.subtract(longitudes, c[1]), altitudes, ellipsoid=ellipsoid)
+    lat1 = -1*radians(c[0])
+    if ellipsoid:
+        lat1 = radians(geocentric_latitude(degrees(lat1)))
+
+    c2y = c2rp[1]
+    c2z = (c2rp[0] * sin(lat1)) + (c2rp[2] * cos(lat1))
+    azimuths = np.mod(90 - np.degrees(np.arctan2(c2z, c2y)), 360)
+    azimuths = np.where(c2z*c2z + c2y*c2y > 1e-6, np.round(azimuths, 4), np.nan)
+
+    c1p = euclidian_point(c[0], c[1], alt, ellipsoid=ellipsoid)
+    c2p = euclidian_points(latitudes, longitudes, altitudes, ellipsoid=ellipsoid)
+    dx = c2p[0]-c1p[0]; dy = c2p[1]-c1p[1]; dz = c2p[2]-c1p[2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        d = np.sqrt(dx*dx + dy*dy + dz*dz)
+        ca = np.clip((dx*c1p[3] + dy*c1p[4] + dz*c1p[5])/d, -1.0, 1.0)
+        altitudes = np.where(d > 0, np.round(90 - np.degrees(np.arccos(ca)), 4), np.nan)
+
+    return azimuths, altitudes
+
+def radio_horizons(h):
+    r = mean_earth_radius
+    return arc_length(np.arccos(r/(r+np.asarray(h, dtype=float))), r=r)
+
+def shared_radio_horizons(c, latitudes, longitudes, altitudes):
+    geodesic_distance = spherical_distances(c, latitudes, longitudes)
+    antenna_distance = euclidian_distances(c, latitudes, longitudes, altitudes, ellipsoid=False)
+    rh1 = radio_horizon(c[2])
+    rh2 = radio_horizons(altitudes)
+    rhc = rh1+rh2
+
+    return {
+        "horizon1":rh1, "horizon2":rh2, "shared":rhc,
+        "within":rhc > geodesic_distance,
+        "geodesic_distance": geodesic_distance,
+        "antenna_distance": antenna_distance
+    }
+
+def geodesic_inverse(lat1, lon1, lat2, lon2):
+    # Returns the ellipsoid distance and the forward azimuths at both
+    # ends of the geodesics between the given points, which can be
+    # scalars or arrays
+    return KarneyGeodesic.inverse(lat1, lon1, lat2, lon2)
+
 def geoid_offset(lat, lon):
     global geoid_height
     if geoid_height == None:
         geoid_height = GeoidHeight()
     return geoid_height.get(lat, lon)
 
+def geoid_offsets(latitudes, longitudes):
+    global geoid_height
+    if geoid_height == None:
+        geoid_height = GeoidHeight()
+    return geoid_height.get_many(latitudes, longitudes)
+
 def altitude_to_aamsl(alt, lat, lon):
     if alt == None or lat == None or lon == None:
         return None
@@ -361,7 +469,9 @@ class GeoidHeight(object):
         ( 18,  -36,    2,   0,  -66,  -51, 0,   0,  102,  31),
     )
 
-    def __init__(self, name="egm2008-5.pgm"):
+    CELL_CACHE_SIZE = 64
+
+    def __init__(self, name="egm2008-5.pgm", in_memory=False):
         self.offset = None
         self.scale = None
 
@@ -423,18 +533,25 @@ class GeoidHeight(object):
             else:
                 self.raw = mmap.mmap(fd, fullsize, mmap.MAP_SHARED, mmap.PROT_READ)
 
+        # The raster is accessed as an array view over the mapped file
+        # for batch lookups, or copied into memory if requested
+        self.grid = np.frombuffer(self.raw, dtype=">u2", count=self.width*self.height, offset=self.headerlen)
+        self.grid = self.grid.reshape(self.height, self.width)
+        if in_memory:
+            self.grid = self.grid.astype(np.uint16)
+
         self.rlonres = self.width / 360.0
         self.rlatres = (self.height - 1) / 180.0
-        self.ix = None
-        self.iy = None
+        self.cells = OrderedDict()
+        self.cells_lock = threading.Lock()
 
     def _rawval(self, ix, iy):
         if iy < 0:
             iy = -iy
-            ix += self.width/2
+            ix += self.width//2
         elif iy >= self.height:
             iy = 2 * (self.height - 1) - iy
-            ix += self.width/2
+            ix += self.width//2
         if ix < 0:
             ix += self.width
         elif ix >= self.width:
@@ -456,14 +573,24 @@ class GeoidHeight(object):
         if iy == self.height - 1:
             iy -= 1
 
-        if ix != self.ix or iy != self.iy:
-            self.ix = ix
-            self.iy = iy
+        # Interpolation coefficients are cached for recently used cells.
+        # The cache is shared between the UI and telemetry threads, so
+        # it is only accessed while holding the lock, but coefficients
+        # are computed outside it.
+        key = (ix, iy, cubic)
+        with self.cells_lock:
+            cell = self.cells.get(key)
+            if cell != None:
+                self.cells.move_to_end(key)
+
+        if cell == None:
             if not cubic:
-                self.v00 = self._rawval(ix, iy)
-                self.v01 = self._rawval(ix+1, iy)
-                self.v10 = self._rawval(ix, iy+1)
-                self.v11 = self._rawval(ix+1, iy+1)
+                cell = (
+                    self._rawval(ix, iy),
+                    self._rawval(ix+1, iy),
+                    self._rawval(ix, iy+1),
+                    self._rawval(ix+1, iy+1)
+                )
             else:
                 v = (
                     self._rawval(ix    , iy - 1),
@@ -488,25 +615,533 @@ class GeoidHeight(object):
                 else:
                     c3x = GeoidHeight.c3
                     c0x = GeoidHeight.c0
-                self.t = [
+                cell = [
                     sum([ v[j] * c3x[j][i] for j in range(12) ]) / float(c0x)
                     for i in range(10)
                 ]
+
+            with self.cells_lock:
+                self.cells[key] = cell
+                while len(self.cells) > GeoidHeight.CELL_CACHE_SIZE:
+                    self.cells.popitem(last=False)
+
+        if not cubic:
+            v00, v01, v10, v11 = cell
+            a = (1 - fx) * v00 + fx * v01
+            b = (1 - fx) * v10 + fx * v11
+            h = (1 - fy) * a + fy * b
+        else:
+            t = cell
+            h = (
+                t[0] +
+                fx * (t[1] + fx * (t[3] + fx * t[6])) +
+                fy * (
+                    t[2] + fx * (t[4] + fx * t[7]) +
+                        fy * (t[5] + fx * t[8] + fy * t[9])
+                )
+            )
+        return self.offset + self.scale * h
+
+    def _rawvals(self, ix, iy):
+        north = iy < 0
+        south = iy >= self.height
+        ix = np.where(north | south, ix + self.width//2, ix) % self.width
+        iy = np.where(north, -iy, np.where(south, 2 * (self.height - 1) - iy, iy))
+        return self.grid[iy, ix].astype(float)
+
+    def get_many(self, lats, lons, cubic=True):
+        # Batch version of get, returning an array of geoid heights for
+        # the given arrays of coordinates
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        lons = np.where(lons < 0, lons + 360, lons)
+        fy = (90 - lats) * self.rlatres
+        fx = lons * self.rlonres
+        iy = fy.astype(int)
+        ix = fx.astype(int)
+        fx = fx - ix
+        fy = fy - iy
+        iy = np.where(iy == self.height - 1, iy - 1, iy)
+
         if not cubic:
-            a = (1 - fx) * self.v00 + fx * self.v01
-            b = (1 - fx) * self.v10 + fx * self.v11
+            v00 = self._rawvals(ix, iy)
+            v01 = self._rawvals(ix+1, iy)
+            v10 = self._rawvals(ix, iy+1)
+            v11 = self._rawvals(ix+1, iy+1)
+            a = (1 - fx) * v00 + fx * v01
+            b = (1 - fx) * v10 + fx * v11
             h = (1 - fy) * a + fy * b
         else:
+            stencil = ((0, -1), (1, -1), (-1, 0), (0, 0), (1, 0), (2, 0),
+                       (-1, 1), (0, 1), (1, 1), (2, 1), (0, 2), (1, 2))
+            v = np.stack([self._rawvals(ix + dx, iy + dy) for dx, dy in stencil], axis=-1)
+            t = np.where((iy == 0)[..., None], v @ GeoidHeight.c3n_matrix,
+                np.where((iy == self.height - 2)[..., None], v @ GeoidHeight.c3s_matrix,
+                         v @ GeoidHeight.c3_matrix))
+            t = np.moveaxis(t, -1, 0)
             h = (
-                self.t[0] +
-                fx * (self.t[1] + fx * (self.t[3] + fx * self.t[6])) +
+                t[0] +
+                fx * (t[1] + fx * (t[3] + fx * t[6])) +
                 fy * (
-                    self.t[2] + fx * (self.t[4] + fx * self.t[7]) +
-                        fy * (self.t[5] + fx * self.t[8] + fy * self.t[9])
+                    t[2] + fx * (t[4] + fx * t[7]) +
+                        fy * (t[5] + fx * t[8] + fy * t[9])
                 )
             )
+
         return self.offset + self.scale * h
 
+GeoidHeight.c3_matrix = np.array(GeoidHeight.c3, dtype=float) / GeoidHeight.c0
+GeoidHeight.c3n_matrix = np.array(GeoidHeight.c3n, dtype=float) / GeoidHeight.c0n
+GeoidHeight.c3s_matrix = np.array(GeoidHeight.c3s, dtype=float) / GeoidHeight.c0s
+
+
+##########################################################
+# Geodesic solver after C. F. F. Karney, "Algorithms for #
+# geodesics", J. Geodesy 87, 43-55 (2013). Ported from   #
+# GeographicLib, MIT License, and vectorised with NumPy. #
+# Only oblate ellipsoids are handled.                    #
+##########################################################
+
+class KarneyGeodesic(object):
+    a       = equatorial_radius
+    f       = ellipsoid_flattening
+    f1      = 1-f
+    e2      = f*(2-f)
+    ep2     = e2/(f1*f1)
+    n       = f/(2-f)
+    b       = a*f1
+
+    tiny    = sqrt(sys.float_info.min)
+    tol0    = sys.float_info.epsilon
+    tol1    = 200*tol0
+    tol2    = sqrt(tol0)
+    tolb    = tol0
+    xthresh = 1000*tol2
+    etol2   = 0.1*tol2/sqrt(max(0.001, abs(f))*min(1.0, 1-f/2)/2)
+    maxit1  = 20
+    maxit2  = maxit1+sys.float_info.mant_dig+10
+
+    # Series coefficients for sixth order in the flattening
+    A1_coeff = (1, 4, 64, 0, 256)
+    C1_coeff = (-1, 6, -16, 32, -9, 64, -128, 2048, 9, -16, 768, 3, -5, 512, -7, 1280, -7, 2048)
+    A2_coeff = (-11, -28, -192, 0, 256)
+    C2_coeff = (1, 2, 16, 32, 35, 64, 384, 2048, 15, 80, 768, 7, 35, 512, 63, 1280, 77, 2048)
+    A3_coeff = (-3, 128, -2, -3, 64, -1, -3, -1, 16, 3, -1, -2, 8, 1, -1, 2, 1, 1)
+    C3_coeff = (3, 128, 2, 5, 128, -1, 3, 3, 64, -1, 0, 1, 8, -1, 1, 4, 5, 256, 1, 3, 128,
+                -3, -2, 3, 64, 1, -3, 2, 32, 7, 512, -10, 9, 384, 5, -9, 5, 192, 7, 512,
+                -14, 7, 512, 21, 2560)
+
+    @staticmethod
+    def polyval(N, p, s, x):
+        y = float(0 if N < 0 else p[s])
+        while N > 0:
+            N -= 1; s += 1
+            y = y * x + p[s]
+        return y
+
+    @staticmethod
+    def norm(x, y):
+        r = np.hypot(x, y)
+        return x/r, y/r
+
+    @staticmethod
+    def sincosd(x):
+        r = np.fmod(x, 360)
+        q = np.where(np.isnan(r), 0, np.rint(r / 90))
+        r = np.radians(r - 90 * q)
+        s = np.sin(r); c = np.cos(r)
+        q = q.astype(int) % 4
+        s, c = (np.select([q == 1, q == 2, q == 3], [c, -s, -c], s),
+                np.select([q == 1, q == 2, q == 3], [-s, -c, s], c))
+        s = np.where(s == 0, np.copysign(s, x), s)
+        return s, c + 0.0
+
+    @staticmethod
+    def anground(x):
+        z = 1/16.0
+        y = np.abs(x)
+        y = np.where(y < z, z - (z - y), y)
+        return np.copysign(y, x)
+
+    @staticmethod
+    def sincos_series(sinp, sinx, cosx, c):
+        # Evaluates a trigonometric series using Clenshaw summation
+        k = len(c)
+        n = k - sinp
+        ar = 2 * (cosx - sinx) * (cosx + sinx)
+        y1 = 0
+        if n & 1:
+            k -= 1; y0 = c[k]
+        else:
+            y0 = 0
+        n = n // 2
+        while n:
+            n -= 1
+            k -= 1; y1 = ar * y0 - y1 + c[k]
+            k -= 1; y0 = ar * y1 - y0 + c[k]
+        return 2 * sinx * cosx * y0 if sinp else cosx * (y0 - y1)
+
+    @staticmethod
+    def astroid(x, y):
+        # Solves k^4+2*k^3-(x^2+y^2-1)*k^2-2*y^2*k-y^2 = 0 for the
+        # positive root k
+        p = x*x; q = y*y
+        r = (p + q - 1) / 6
+        S = p * q / 4
+        r2 = r*r; r3 = r * r2
+        disc = S * (S + 2 * r3)
+        T3 = S + r3
+        T3 = T3 + np.where(T3 < 0, -1, 1) * np.sqrt(np.maximum(disc, 0))
+        T = np.cbrt(T3)
+        u = np.where(disc >= 0,
+                     r + T + np.where(T != 0, r2 / np.where(T != 0, T, 1), 0),
+                     r + 2 * r * np.cos(np.arctan2(np.sqrt(np.maximum(-disc, 0)), -(S + r3)) / 3))
+        v = np.sqrt(u*u + q)
+        uv = np.where(u < 0, q / (v - u), u + v)
+        w = (uv - q) / (2 * v)
+        k = uv / (np.sqrt(uv + w*w) + w)
+        return np.where((q == 0) & (r <= 0), 0.0, k)
+
+    @staticmethod
+    def series(coeff, order, eps):
+        # Returns the coefficients c[1] through c[order] of a series
+        # in eps, given as polynomials in eps^2
+        eps2 = eps*eps; d = eps; o = 0
+        c = [0]*(order+1)
+        for l in range(1, order+1):
+            m = (order - l) // 2
+            c[l] = d * KarneyGeodesic.polyval(m, coeff, o, eps2) / coeff[o + m + 1]
+            o += m + 2
+            d = d * eps
+        return c
+
+    @staticmethod
+    def A1m1f(eps):
+        t = KarneyGeodesic.polyval(3, KarneyGeodesic.A1_coeff, 0, eps*eps) / KarneyGeodesic.A1_coeff[4]
+        return (t + eps) / (1 - eps)
+
+    @staticmethod
+    def A2m1f(eps):
+        t = KarneyGeodesic.polyval(3, KarneyGeodesic.A2_coeff, 0, eps*eps) / KarneyGeodesic.A2_coeff[4]
+        return (t - eps) / (1 + eps)
+
+    @classmethod
+    def init_coefficients(cls):
+        cls.A3x = []; o = 0
+        for j in range(5, -1, -1):
+            m = min(6 - j - 1, j)
+            cls.A3x.append(cls.polyval(m, cls.A3_coeff, o, cls.n) / cls.A3_coeff[o + m + 1])
+            o += m + 2
+
+        cls.C3x = []; o = 0
+        for l in range(1, 6):
+            for j in range(5, l - 1, -1):
+                m = min(6 - j - 1, j)
+                cls.C3x.append(cls.polyval(m, cls.C3_coeff, o, cls.n) / cls.C3_coeff[o + m + 1])
+                o += m + 2
+
+    @staticmethod
+    def A3f(eps):
+        return KarneyGeodesic.polyval(5, KarneyGeodesic.A3x, 0, eps)
+
+    @staticmethod
+    def C3f(eps):
+        c = [0]*6; mult = 1; o = 0
+        for l in range(1, 6):
+            m = 6 - l - 1
+            mult = mult * eps
+            c[l] = mult * KarneyGeodesic.polyval(m, KarneyGeodesic.C3x, o, eps)
+            o += m + 1
+        return c
+
+    @staticmethod
+    def lengths(eps, sig12, ssig1, csig1, dn1, ssig2, csig2, dn2):
+        # Returns the distance and the reduced length, both missing a
+        # factor of b
+        kg = KarneyGeodesic
+        C1a = kg.series(kg.C1_coeff, 6, eps)
+        C2a = kg.series(kg.C2_coeff, 6, eps)
+        A1 = kg.A1m1f(eps); A2 = kg.A2m1f(eps)
+        m0x = A1 - A2
+        A1 = 1 + A1; A2 = 1 + A2
+        B1 = kg.sincos_series(True, ssig2, csig2, C1a) - kg.sincos_series(True, ssig1, csig1, C1a)
+        B2 = kg.sincos_series(True, ssig2, csig2, C2a) - kg.sincos_series(True, ssig1, csig1, C2a)
+        s12b = A1 * (sig12 + B1)
+        J12 = m0x * sig12 + (A1 * B1 - A2 * B2)
+        m12b = dn2 * (csig1 * ssig2) - dn1 * (ssig1 * csig2) - csig1 * csig2 * J12
+        return s12b, m12b
+
+    @staticmethod
+    def inverse_start(sbet1, cbet1, sbet2, cbet2, lam12, slam12, clam12):
+        # Finds a starting value for Newton's method. For short lines
+        # that do not need it, sig12 is positive and the final values
+        # for alp2 and dnm are returned too.
+        kg = KarneyGeodesic
+        sbet12 = sbet2 * cbet1 - cbet2 * sbet1
+        cbet12 = cbet2 * cbet1 + sbet2 * sbet1
+        sbet12a = sbet2 * cbet1 + cbet2 * sbet1
+
+        shortline = (cbet12 >= 0) & (sbet12 < 0.5) & (cbet2 * lam12 < 0.5)
+        sbetm2 = (sbet1 + sbet2)**2
+        sbetm2 = sbetm2 / (sbetm2 + (cbet1 + cbet2)**2)
+        dnm = np.sqrt(1 + kg.ep2 * sbetm2)
+        omg12 = lam12 / (kg.f1 * dnm)
+        somg12 = np.where(shortline, np.sin(omg12), slam12)
+        comg12 = np.where(shortline, np.cos(omg12), clam12)
+
+        salp1 = cbet2 * somg12
+        calp1 = np.where(comg12 >= 0,
+                         sbet12 + cbet2 * sbet1 * somg12**2 / (1 + comg12),
+                         sbet12a - cbet2 * sbet1 * somg12**2 / (1 - comg12))
+
+        ssig12 = np.hypot(salp1, calp1)
+        csig12 = sbet1 * sbet2 + cbet1 * cbet2 * comg12
+
+        short = shortline & (ssig12 < kg.etol2)
+        salp2 = cbet1 * somg12
+        calp2 = sbet12 - cbet1 * sbet2 * np.where(comg12 >= 0, somg12**2 / (1 + comg12), 1 - comg12)
+        salp2, calp2 = kg.norm(salp2, calp2)
+        sig12 = np.where(short, np.arctan2(ssig12, csig12), -1.0)
+
+        # Nearly antipodal points, where the spherical approximation is
+        # not good enough, are estimated by solving the astroid problem
+        nearly_antipodal = ~short & (csig12 < 0) & (ssig12 < 6 * abs(kg.n) * pi * cbet1**2)
+        if np.any(nearly_antipodal):
+            lam12x = np.arctan2(-slam12, -clam12)
+            k2 = sbet1**2 * kg.ep2
+            eps = k2 / (2 * (1 + np.sqrt(1 + k2)) + k2)
+            lamscale = kg.f * cbet1 * kg.A3f(eps) * pi
+            betscale = lamscale * cbet1
+            x = lam12x / lamscale
+            y = sbet12a / betscale
+
+            cut = (y > -kg.tol1) & (x > -1 - kg.xthresh)
+            salp1_cut = np.minimum(1.0, -x)
+            calp1_cut = -np.sqrt(1 - salp1_cut**2)
+
+            k = kg.astroid(x, y)
+            omg12a = lamscale * (-x * k / (1 + k))
+            somg12a = np.sin(omg12a); comg12a = -np.cos(omg12a)
+            salp1_ast = cbet2 * somg12a
+            calp1_ast = sbet12a - cbet2 * sbet1 * somg12a**2 / (1 - comg12a)
+
+            salp1 = np.where(nearly_antipodal, np.where(cut, salp1_cut, salp1_ast), salp1)
+            calp1 = np.where(nearly_antipodal, np.where(cut, calp1_cut, calp1_ast), calp1)
+
+        valid = ~(salp1 <= 0)
+        salp1n, calp1n = kg.norm(salp1, calp1)
+        salp1 = np.where(valid, salp1n, 1.0)
+        calp1 = np.where(valid, calp1n, 0.0)
+        return sig12, salp1, calp1, salp2, calp2, dnm
+
+    @staticmethod
+    def lambda12(sbet1, cbet1, dn1, sbet2, cbet2, dn2, salp1, calp1, slam120, clam120, diffp):
+        # Solves the hybrid problem, returning the longitude difference
+        # for the given azimuth at the first point, and its derivative
+        kg = KarneyGeodesic
+        calp1 = np.where((sbet1 == 0) & (calp1 == 0), -kg.tiny, calp1)
+
+        salp0 = salp1 * cbet1
+        calp0 = np.hypot(calp1, salp1 * sbet1)
+
+        ssig1 = sbet1; somg1 = salp0 * sbet1
+        csig1 = comg1 = calp1 * cbet1
+        ssig1, csig1 = kg.norm(ssig1, csig1)
+
+        salp2 = np.where(cbet2 != cbet1, salp0 / cbet2, salp1)
+        calp2 = np.where((cbet2 != cbet1) | (np.abs(sbet2) != -sbet1),
+                         np.sqrt((calp1 * cbet1)**2 + np.where(cbet1 < -sbet1,
+                                 (cbet2 - cbet1) * (cbet1 + cbet2),
+                                 (sbet1 - sbet2) * (sbet1 + sbet2))) / cbet2,
+                         np.abs(calp1))
+
+        ssig2 = sbet2; somg2 = salp0 * sbet2
+        csig2 = comg2 = calp2 * cbet2
+        ssig2, csig2 = kg.norm(ssig2, csig2)
+
+        sig12 = np.arctan2(np.maximum(0.0, csig1 * ssig2 - ssig1 * csig2) + 0.0, csig1 * csig2 + ssig1 * ssig2)
+        somg12 = np.maximum(0.0, comg1 * somg2 - somg1 * comg2) + 0.0
+        comg12 = comg1 * comg2 + somg1 * somg2
+        eta = np.arctan2(somg12 * clam120 - comg12 * slam120, comg12 * clam120 + somg12 * slam120)
+
+        k2 = calp0**2 * kg.ep2
+        eps = k2 / (2 * (1 + np.sqrt(1 + k2)) + k2)
+        C3a = kg.C3f(eps)
+        B312 = kg.sincos_series(True, ssig2, csig2, C3a) - kg.sincos_series(True, ssig1, csig1, C3a)
+        domg12 = -kg.f * kg.A3f(eps) * salp0 * (sig12 + B312)
+        lam12 = eta + domg12
+
+        if diffp:
+            m12b = kg.lengths(eps, sig12, ssig1, csig1, dn1, ssig2, csig2, dn2)[1]
+            dlam12 = np.where(calp2 == 0, -2 * kg.f1 * dn1 / sbet1, m12b * kg.f1 / (calp2 * cbet2))
+        else:
+            dlam12 = np.full_like(lam12, np.nan)
+
+        return lam12, salp2, calp2, sig12, ssig1, csig1, ssig2, csig2, eps, dlam12
+
+    @staticmethod
+    def inverse(lat1, lon1, lat2, lon2):
+        kg = KarneyGeodesic
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            return kg._inverse(lat1, lon1, lat2, lon2)
+
+    @staticmethod
+    def _inverse(lat1, lon1, lat2, lon2):
+        kg = KarneyGeodesic
+        lat1, lon1, lat2, lon2 = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (lat1, lon1, lat2, lon2)])
+        shape = lat1.shape
+        lat1 = lat1.ravel(); lon1 = lon1.ravel(); lat2 = lat2.ravel(); lon2 = lon2.ravel()
+
+        # Bring the points to a canonical form, where 0 <= lon12 <= 180,
+        # -90 <= lat1 <= 0 and lat1 <= lat2 <= -lat1
+        lon12 = lon2 - lon1
+        wrapped = np.remainder(lon12 + 180, 360) - 180
+        wrapped = np.where(wrapped == -180, np.copysign(180.0, lon12), wrapped)
+        lon12 = np.where(np.abs(lon12) > 180, wrapped, lon12)
+        lonsign = np.where(lon12 < 0, -1.0, 1.0)
+        lon12 = lonsign * lon12
+        lam12 = np.radians(lon12)
+        slam12, clam12 = kg.sincosd(lon12)
+        lon12s = 180 - lon12
+
+        lat1 = kg.anground(np.where(np.abs(lat1) > 90, np.nan, lat1))
+        lat2 = kg.anground(np.where(np.abs(lat2) > 90, np.nan, lat2))
+        swapp = np.where((np.abs(lat1) < np.abs(lat2)) | np.isnan(lat2), -1.0, 1.0)
+        lonsign = np.where(swapp < 0, -lonsign, lonsign)
+        lat1, lat2 = np.where(swapp < 0, lat2, lat1), np.where(swapp < 0, lat1, lat2)
+        latsign = np.copysign(1.0, -lat1)
+        lat1 = lat1 * latsign
+        lat2 = lat2 * latsign
+
+        sbet1, cbet1 = kg.sincosd(lat1); sbet1 = sbet1 * kg.f1
+        sbet1, cbet1 = kg.norm(sbet1, cbet1); cbet1 = np.maximum(kg.tiny, cbet1)
+        sbet2, cbet2 = kg.sincosd(lat2); sbet2 = sbet2 * kg.f1
+        sbet2, cbet2 = kg.norm(sbet2, cbet2); cbet2 = np.maximum(kg.tiny, cbet2)
+
+        sensitive = cbet1 < -sbet1
+        sbet2 = np.where(sensitive & (cbet2 == cbet1), np.copysign(sbet1, sbet2), sbet2)
+        cbet2 = np.where(~sensitive & (np.abs(sbet2) == -sbet1), cbet1, cbet2)
+
+        dn1 = np.sqrt(1 + kg.ep2 * sbet1**2)
+        dn2 = np.sqrt(1 + kg.ep2 * sbet2**2)
+
+        s12 = np.full(lat1.shape, np.nan)
+        salp1 = np.full(lat1.shape, np.nan); calp1 = np.full(lat1.shape, np.nan)
+        salp2 = np.full(lat1.shape, np.nan); calp2 = np.full(lat1.shape, np.nan)
+
+        # Endpoints on a single meridian
+        meridian = (lat1 == -90) | (slam12 == 0)
+        if np.any(meridian):
+            i = meridian
+            mcalp1 = clam12[i]; msalp1 = slam12[i]
+            ssig1 = sbet1[i]; csig1 = mcalp1 * cbet1[i]
+            ssig2 = sbet2[i]; csig2 = cbet2[i]
+            sig12 = np.arctan2(np.maximum(0.0, csig1 * ssig2 - ssig1 * csig2) + 0.0, csig1 * csig2 + ssig1 * ssig2)
+            s12x, m12x = kg.lengths(kg.n, sig12, ssig1, csig1, dn1[i], ssig2, csig2, dn2[i])
+            zero = (sig12 < 3 * kg.tiny) | ((sig12 < kg.tol0) & ((s12x < 0) | (m12x < 0)))
+            s12[i] = np.where(zero, 0.0, s12x) * kg.b
+            salp1[i] = msalp1; calp1[i] = mcalp1
+            salp2[i] = 0.0; calp2[i] = 1.0
+
+        # Geodesics running along the equator
+        equatorial = ~meridian & (sbet1 == 0) & (lon12s >= kg.f * 180)
+        s12[equatorial] = kg.a * lam12[equatorial]
+        salp1[equatorial] = 1.0; calp1[equatorial] = 0.0
+        salp2[equatorial] = 1.0; calp2[equatorial] = 0.0
+
+        general = np.flatnonzero(~meridian & ~equatorial)
+        if len(general) > 0:
+            g = general
+            gs1 = sbet1[g]; gc1 = cbet1[g]; gs2 = sbet2[g]; gc2 = cbet2[g]; gd1 = dn1[g]; gd2 = dn2[g]
+            gsl = slam12[g]; gcl = clam12[g]
+            sig12, gsalp1, gcalp1, gsalp2, gcalp2, dnm = kg.inverse_start(gs1, gc1, gs2, gc2, lam12[g], gsl, gcl)
+
+            # Short lines are solved directly on the auxiliary sphere
+            short = sig12 >= 0
+            ss = g[short]
+            s12[ss] = sig12[short] * kg.b * dnm[short]
+            salp1[ss] = gsalp1[short]; calp1[ss] = gcalp1[short]
+            salp2[ss] = gsalp2[short]; calp2[ss] = gcalp2[short]
+
+            # The remaining lines are solved with Newton's method, with
+            # bisection of a bracketing range as a fallback
+            nw = ~short
+            if np.any(nw):
+                ni = g[nw]
+                bs1 = gs1[nw]; bc1 = gc1[nw]; bs2 = gs2[nw]; bc2 = gc2[nw]; bd1 = gd1[nw]; bd2 = gd2[nw]
+                bsl = gsl[nw]; bcl = gcl[nw]
+                nsalp1 = gsalp1[nw]; ncalp1 = gcalp1[nw]
+                count = len(ni)
+                out = {}
+                salp1a = np.full(count, kg.tiny); calp1a = np.full(count, 1.0)
+                salp1b = np.full(count, kg.tiny); calp1b = np.full(count, -1.0)
+                tripn = np.zeros(count, dtype=bool); tripb = np.zeros(count, dtype=bool)
+                active = np.arange(count)
+                numit = 0
+
+                while len(active) > 0:
+                    a = active
+                    (v, rsalp2, rcalp2, rsig12, rssig1, rcsig1, rssig2, rcsig2, reps, dv) = kg.lambda12(
+                        bs1[a], bc1[a], bd1[a], bs2[a], bc2[a], bd2[a],
+                        nsalp1[a], ncalp1[a], bsl[a], bcl[a], numit < kg.maxit1)
+
+                    for key, value in (("salp2", rsalp2), ("calp2", rcalp2), ("sig12", rsig12), ("ssig1", rssig1),
+                                       ("csig1", rcsig1), ("ssig2", rssig2), ("csig2", rcsig2), ("eps", reps)):
+                        if not key in out: out[key] = np.full(count, np.nan)
+                        out[key][a] = value
+
+                    done = tripb[a] | ~(np.abs(v) >= np.where(tripn[a], 8, 1) * kg.tol0) | (numit == kg.maxit2)
+                    keep = ~done
+                    a = a[keep]; v = v[keep]; dv = dv[keep]
+                    if len(a) == 0:
+                        break
+
+                    ratio = ncalp1[a] / nsalp1[a]
+                    upper = (v > 0) & ((numit > kg.maxit1) | (ratio > calp1b[a] / salp1b[a]))
+                    lower = (v < 0) & ((numit > kg.maxit1) | (ratio < calp1a[a] / salp1a[a]))
+                    salp1b[a[upper]] = nsalp1[a[upper]]; calp1b[a[upper]] = ncalp1[a[upper]]
+                    salp1a[a[lower]] = nsalp1[a[lower]]; calp1a[a[lower]] = ncalp1[a[lower]]
+
+                    numit += 1
+                    stepped = np.zeros(len(a), dtype=bool)
+                    if numit < kg.maxit1:
+                        dalp1 = -v / dv
+                        sdalp1 = np.sin(dalp1); cdalp1 = np.cos(dalp1)
+                        ssalp1 = nsalp1[a] * cdalp1 + ncalp1[a] * sdalp1
+                        stepped = (dv > 0) & (np.abs(dalp1) < pi) & (ssalp1 > 0)
+                        st = a[stepped]
+                        scalp1 = ncalp1[st] * cdalp1[stepped] - nsalp1[st] * sdalp1[stepped]
+                        nsalp1[st], ncalp1[st] = kg.norm(ssalp1[stepped], scalp1)
+                        tripn[st] = np.abs(v[stepped]) <= 16 * kg.tol0
+
+                    bi = a[~stepped]
+                    nsalp1[bi], ncalp1[bi] = kg.norm((salp1a[bi] + salp1b[bi]) / 2, (calp1a[bi] + calp1b[bi]) / 2)
+                    tripn[bi] = False
+                    tripb[bi] = ((np.abs(salp1a[bi] - nsalp1[bi]) + (calp1a[bi] - ncalp1[bi]) < kg.tolb) |
+                                 (np.abs(nsalp1[bi] - salp1b[bi]) + (ncalp1[bi] - calp1b[bi]) < kg.tolb))
+                    active = a
+
+                s12x = kg.lengths(out["eps"], out["sig12"], out["ssig1"], out["csig1"], bd1,
+                                  out["ssig2"], out["csig2"], bd2)[0]
+                s12[ni] = s12x * kg.b
+                salp1[ni] = nsalp1; calp1[ni] = ncalp1
+                salp2[ni] = out["salp2"]; calp2[ni] = out["calp2"]
+
+        # Undo the transformation to the canonical form
+        salp1, salp2 = np.where(swapp < 0, salp2, salp1), np.where(swapp < 0, salp1, salp2)
+        calp1, calp2 = np.where(swapp < 0, calp2, calp1), np.where(swapp < 0, calp1, calp2)
+        salp1 = salp1 * swapp * lonsign; calp1 = calp1 * swapp * latsign
+        salp2 = salp2 * swapp * lonsign; calp2 = calp2 * swapp * latsign
+
+        s12 = (s12 + 0.0).reshape(shape)
+        azi1 = np.degrees(np.arctan2(salp1, calp1)).reshape(shape)
+        azi2 = np.degrees(np.arctan2(salp2, calp2)).reshape(shape)
+        if shape == ():
+            return float(s12), float(azi1), float(azi2)
+        else:
+            return s12, azi1, azi2
+
+KarneyGeodesic.init_coefficients()
 
 # def tests():
 #     import RNS
@@ -1,7 +1,7 @@
 import RNS
 import time
 import threading
-from collections import deque
+from collections import deque, OrderedDict
 from .sense import Telemeter, Commands
 
 if RNS.vendor.platformutils.get_platform() == "android":
@@ -10,20 +10,66 @@ else:
     from sbapp.pmqtt import client as mqtt
 
 class MQTT():
-    QUEUE_MAXLEN = 65536
+    QUEUE_MAXLEN = 4096
+    MAX_INFLIGHT = 256
     SCHEDULER_SLEEP = 1
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 120
+    TOPIC_CACHE_SOURCES = 1024
+    FULL_REFRESH_INTERVAL = 300
 
     def __init__(self):
         self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         self.host = None
         self.port = None
+        self.config = None
         self.run = False
         self.is_connected = False
-        self.queue_lock = threading.Lock()
-        self.waiting_msgs = deque(maxlen=MQTT.QUEUE_MAXLEN)
-        self.waiting_telemetry = set()
+        self.session_started = False
+        self.retain = False
+
+        # The last published topic values are kept per source, so only
+        # topics that changed are published, except on the periodic full
+        # refresh. The packed telemetry the topics were rendered from is
+        # kept too, so identical telemetry is not decoded again.
+        self.topic_cache = OrderedDict()
+        self.topic_cache_reset = False
+
+        # Rendered topics are kept per source and sensor, along with the
+        # packed sensor data they were rendered from, so sensors with
+        # unchanged data are not unpacked and rendered again
+        self.render_cache = OrderedDict()
+
+        # Pending telemetry is kept per source, so repeated telemetry
+        # from the same source is coalesced to the latest value while
+        # it waits to be published
+        self.queue_lock = threading.Condition()
+        self.waiting_telemetry = OrderedDict()
+
+        # Publish acknowledgements are handed from the network thread
+        # to the worker through a deque, since the paho client holds
+        # its own locks while calling on_publish
+        self.inflight = {}
+        self.acks = deque()
+        self.ack_event = threading.Event()
+
+        # Server and authentication changes are applied by the worker,
+        # since changing servers disconnects and joins the network
+        # thread of the client, which must not block the caller
+        self.pending_config = None
+
+        # Statistics are updated from the caller, the worker and the
+        # network thread of the client, so they are kept under a lock
+        self.stats_lock = threading.Lock()
+        self.stats = {"enqueued": 0, "coalesced": 0, "dropped": 0, "published": 0, "unchanged": 0, "acknowledged": 0,
+                      "connects": 0, "disconnects": 0, "latency_total": 0.0, "latency_max": 0.0}
+        self.started = time.time()
+
+        self.client.on_connect = self.connected
         self.client.on_connect_fail = self.connect_failed
         self.client.on_disconnect = self.disconnected
+        self.client.on_publish = self.published
+        self.client.reconnect_delay_set(MQTT.RECONNECT_MIN_DELAY, MQTT.RECONNECT_MAX_DELAY)
         self.start()
 
     def start(self):
@@ -34,100 +80,259 @@ class MQTT():
     def stop(self):
         RNS.log("Stopping MQTT scheduler", RNS.LOG_DEBUG)
         self.run = False
+        with self.queue_lock:
+            self.queue_lock.notify_all()
+        self.ack_event.set()
 
     def jobs(self):
         while self.run:
             try:
-                if len(self.waiting_msgs) > 0:
-                    RNS.log(f"Processing {len(self.waiting_msgs)} MQTT messages", RNS.LOG_DEBUG)
-                    if self.process_queue():
-                        RNS.log("All MQTT messages processed", RNS.LOG_DEBUG)
+                self.apply_config()
+                if not self.session_started and self.host != None:
+                    self.connect()
+
+                self.process_acks()
+                if not self.is_connected:
+                    with self.queue_lock:
+                        self.queue_lock.wait(MQTT.SCHEDULER_SLEEP)
+
+                elif len(self.inflight) >= MQTT.MAX_INFLIGHT:
+                    self.ack_event.wait(MQTT.SCHEDULER_SLEEP)
+                    self.ack_event.clear()
+
+                else:
+                    self.process_queue()
 
             except Exception as e:
                 RNS.log(f"An error occurred while running MQTT scheduler jobs: {e}", RNS.LOG_ERROR)
                 RNS.trace_exception(e)
-
-            time.sleep(MQTT.SCHEDULER_SLEEP)
+                time.sleep(MQTT.SCHEDULER_SLEEP)
 
         try: self.disconnect()
         except Exception as e: RNS.log(f"An error occurred while disconnecting MQTT server: {e}", RNS.LOG_ERROR)
 
         RNS.log("Stopped MQTT scheduler", RNS.LOG_DEBUG)
 
+    def connected(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            RNS.log(f"MQTT server refused connection, reason code: {reason_code}", RNS.LOG_ERROR)
+            self.is_connected = False
+        else:
+            RNS.log(f"Connected to MQTT server {self.host}:{self.port}", RNS.LOG_DEBUG)
+            self.count("connects")
+            self.is_connected = True
+
+            # Everything is published again after connecting, since the
+            # server may have lost retained values in the meantime
+            self.topic_cache_reset = True
+            with self.queue_lock:
+                self.queue_lock.notify_all()
+
     def connect_failed(self, client, userdata):
         RNS.log(f"Connection to MQTT server failed", RNS.LOG_DEBUG)
         self.is_connected = False
 
     def disconnected(self, client, userdata, disconnect_flags, reason_code, properties):
         RNS.log(f"Disconnected from MQTT server, reason code: {reason_code}", RNS.LOG_EXTREME)
+        self.count("disconnects")
         self.is_connected = False
 
+    def published(self, client, userdata, mid, reason_code, properties):
+        self.acks.append((mid, time.time()))
+        self.ack_event.set()
+
+    def configure(self, host, port, username, password, retain):
+        # Queues a configuration change for the worker to apply. This
+        # can be called for every telemetry update, since the worker
+        # only acts on configurations that differ from the current one.
+        with self.queue_lock:
+            self.pending_config = (host, port, username, password, retain)
+            self.queue_lock.notify()
+
+    def apply_config(self):
+        # Must only be called from the worker
+        with self.queue_lock:
+            config = self.pending_config
+            self.pending_config = None
+
+        if config != None and config != self.config:
+            host, port, username, password, retain = config
+            self.set_server(host, port)
+            self.set_auth(username, password)
+            self.retain = retain
+            self.config = config
+
     def set_server(self, host, port):
         try:
             port = int(port)
         except:
             port = None
 
+        port = port or 1883
+        if self.session_started and (host != self.host or port != self.port):
+            RNS.log("MQTT server changed, restarting session", RNS.LOG_DEBUG)
+            self.disconnect()
+
         self.host = host
-        self.port = port or 1883
+        self.port = port
 
     def set_auth(self, username, password):
         self.client.username_pw_set(username, password)
 
     def connect(self):
-        RNS.log(f"Connecting MQTT server {self.host}:{self.port}", RNS.LOG_DEBUG) # TODO: Remove debug
-        cs = self.client.connect(self.host, self.port)
+        # The session is kept open, and the network thread of the client
+        # reconnects with exponential backoff when the connection is lost
+        RNS.log(f"Connecting MQTT server {self.host}:{self.port}", RNS.LOG_DEBUG)
+        self.session_started = True
+        self.client.connect_async(self.host, self.port)
         self.client.loop_start()
 
     def disconnect(self):
-        RNS.log("Disconnecting from MQTT server", RNS.LOG_EXTREME) # TODO: Remove debug
+        RNS.log("Disconnecting from MQTT server", RNS.LOG_EXTREME)
         if self.client:
             self.client.disconnect()
             self.client.loop_stop()
+        self.inflight.clear()
+        self.session_started = False
         self.is_connected = False
 
-    def post_message(self, topic, data):
-        mqtt_msg = self.client.publish(topic, data, qos=1)
-        self.waiting_telemetry.add(mqtt_msg)
+    def post_message(self, topic, data, enqueued):
+        mqtt_msg = self.client.publish(topic, data, qos=1, retain=self.retain)
+        self.inflight[mqtt_msg.mid] = enqueued
+        self.count("published")
+
+    def process_acks(self):
+        while len(self.acks) > 0:
+            mid, acknowledged = self.acks.popleft()
+            enqueued = self.inflight.pop(mid, None)
+            if enqueued != None:
+                latency = acknowledged-enqueued
+                with self.stats_lock:
+                    self.stats["acknowledged"] += 1
+                    self.stats["latency_total"] += latency
+                    if latency > self.stats["latency_max"]: self.stats["latency_max"] = latency
 
     def process_queue(self):
         with self.queue_lock:
-            try:
-                self.connect()
-            except Exception as e:
-                RNS.log(f"An error occurred while connecting to MQTT server: {e}", RNS.LOG_ERROR)
+            if len(self.waiting_telemetry) == 0:
+                self.queue_lock.wait(MQTT.SCHEDULER_SLEEP)
+            if len(self.waiting_telemetry) == 0:
                 return False
+            context_dest, (telemetry, enqueued) = self.waiting_telemetry.popitem(last=False)
 
-            try:
-                while len(self.waiting_msgs) > 0:
-                    topic, data = self.waiting_msgs.pop()
-                    self.post_message(topic, data)
-            except Exception as e:
-                RNS.log(f"An error occurred while publishing MQTT messages: {e}", RNS.LOG_ERROR)
-                RNS.trace_exception(e)
+        try:
+            cached, changed = self.render(context_dest, telemetry)
 
-            try:
-                for msg in self.waiting_telemetry:
-                    msg.wait_for_publish()
-                self.waiting_telemetry.clear()
+            # Topics are only recorded as published once the publish
+            # call succeeded, and the telemetry itself once all of its
+            # topics were published, so anything left unpublished by an
+            # error is sent again with the next telemetry from the source
+            for topic_path, data in changed:
+                self.post_message(topic_path, data, enqueued)
+                cached["topics"][topic_path] = data
+            cached["telemetry"] = telemetry
 
-            except Exception as e:
-                RNS.log(f"An error occurred while publishing MQTT messages: {e}", RNS.LOG_ERROR)
-                RNS.trace_exception(e)
+        except Exception as e:
+            RNS.log(f"An error occurred while publishing MQTT messages: {e}", RNS.LOG_ERROR)
+            RNS.trace_exception(e)
 
-            self.disconnect()
-            return True
+        return True
 
-    def handle(self, context_dest, telemetry):
+    def count(self, stat, value=1):
+        with self.stats_lock:
+            self.stats[stat] += value
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = self.stats.copy()
+        acknowledged = stats["acknowledged"]
+        stats["queued"] = len(self.waiting_telemetry)
+        stats["inflight"] = len(self.inflight)
+        stats["connected"] = self.is_connected
+        stats["latency_avg"] = stats["latency_total"]/acknowledged if acknowledged > 0 else None
+        stats["throughput"] = acknowledged/max(1, time.time()-self.started)
+        return stats
+
+    def render_topics(self, context_dest, telemetry):
         remote_telemeter = Telemeter.from_packed(telemetry)
-        read_telemetry = remote_telemeter.read_all()
-        telemetry_timestamp = read_telemetry["time"]["utc"]
         root_path = f"lxmf/telemetry/{RNS.hexrep(context_dest, delimit=False)}"
+        previous = self.render_cache.pop(context_dest, {})
+        sensors = {}
+        rendered = {}
         for sensor in remote_telemeter.sensors:
-            s = remote_telemeter.sensors[sensor]
-            topics = s.render_mqtt()
+            packed = remote_telemeter.sensors.packed_data(sensor)
+            if sensor in previous and previous[sensor][0] == packed:
+                topics = previous[sensor][1]
+            else:
+                topics = remote_telemeter.sensors[sensor].render_mqtt()
+                if topics != None:
+                    topics = {f"{root_path}/{topic}": topics[topic] for topic in topics}
+
+            sensors[sensor] = (packed, topics)
             if topics != None:
-                for topic in topics:
-                    topic_path = f"{root_path}/{topic}"
-                    data = topics[topic]
-                    self.waiting_msgs.append((topic_path, data))
\ No newline at end of file
+                rendered.update(topics)
+
+        self.render_cache[context_dest] = sensors
+        while len(self.render_cache) > MQTT.TOPIC_CACHE_SOURCES:
+            self.render_cache.popitem(last=False)
+
+        return rendered
+
+    def render(self, context_dest, telemetry):
+        # Returns the topic cache entry for the source, and the topics
+        # that changed since they were last published. The entry holds
+        # only topics that are still current and already published,
+        # and the caller adds the changed topics as they are published.
+        if self.topic_cache_reset:
+            self.topic_cache_reset = False
+            self.topic_cache.clear()
+
+        now = time.time()
+        cached = self.topic_cache.pop(context_dest, None)
+        if cached != None and now < cached["refreshed"]+MQTT.FULL_REFRESH_INTERVAL:
+            if cached["telemetry"] == telemetry:
+                self.count("unchanged", len(cached["topics"]))
+                self.topic_cache[context_dest] = cached
+                return cached, []
+
+            published = cached["topics"]
+            refreshed = cached["refreshed"]
+        else:
+            published = {}
+            refreshed = now
+
+        topics = self.render_topics(context_dest, telemetry)
+        unchanged = {}; changed = []
+        for topic_path, data in topics.items():
+            if topic_path in published and published[topic_path] == data:
+                unchanged[topic_path] = data
+            else:
+                changed.append((topic_path, data))
+        self.count("unchanged", len(unchanged))
+
+        cached = {"telemetry": None, "topics": unchanged, "refreshed": refreshed}
+        self.topic_cache[context_dest] = cached
+        while len(self.topic_cache) > MQTT.TOPIC_CACHE_SOURCES:
+            self.topic_cache.popitem(last=False)
+
+        return cached, changed
+
+    def handle(self, context_dest, telemetry):
+        with self.queue_lock:
+            self.count("enqueued")
+            if context_dest in self.waiting_telemetry:
+                # Telemetry can arrive out of order, for example from
+                # collector streams, so the queued telemetry is only
+                # replaced by telemetry with a newer timestamp
+                waiting, enqueued = self.waiting_telemetry[context_dest]
+                waiting_time = Telemeter.peek_time(waiting)
+                telemetry_time = Telemeter.peek_time(telemetry)
+                if waiting_time == None or telemetry_time == None or telemetry_time > waiting_time:
+                    self.waiting_telemetry[context_dest] = (telemetry, enqueued)
+                self.count("coalesced")
+            else:
+                if len(self.waiting_telemetry) >= MQTT.QUEUE_MAXLEN:
+                    self.waiting_telemetry.popitem(last=False)
+                    self.count("dropped")
+                self.waiting_telemetry[context_dest] = (telemetry, time.time())
+                self.queue_lock.notify()
@@ -21,61 +21,48 @@ class Telemeter():
     try:
       p = umsgpack.unpackb(packed)
       t = Telemeter(from_packed=True)
-      for sid in p:
-        if sid in t.sids:
-          name = None
-          s = t.sids[sid]()
-          for n in t.available:
-            if t.sids[t.available[n]] == type(s):
-              name = n
-
-          if name != None:
-            s.data = s.unpack(p[sid])
-            s.synthesized = True
-            s.active = True
-            s._telemeter = t
-            t.sensors[name] = s
-
+      t.sensors = PackedSensors(t, p)
       return t
 
     except Exception as e:
       RNS.log("An error occurred while unpacking telemetry. The contained exception was: "+str(e), RNS.LOG_ERROR)
       return None
 
+  @staticmethod
+  def peek(packed, sensor):
+    # Decodes the data of a single sensor from packed telemetry,
+    # without creating a telemeter or any other sensor instances.
+    try:
+      if sensor in sensor_sids:
+        sid = sensor_sids[sensor]
+        p = umsgpack.unpackb(packed)
+        if sid in p:
+          return sensor_unpacker(sid).unpack(p[sid])
+
+      return None
+
+    except Exception as e:
+      RNS.log("An error occurred while peeking into telemetry. The contained exception was: "+str(e), RNS.LOG_ERROR)
+      return None
+
+  @staticmethod
+  def peek_time(packed):
+    t = Telemeter.peek(packed, "time")
+    if t != None: return t["utc"]
+    else: return None
+
+  @staticmethod
+  def peek_location(packed):
+    # Returns the location contained in packed telemetry, or None if
+    # there is no location with valid coordinates.
+    l = Telemeter.peek(packed, "location")
+    if l != None and l["latitude"] != None and l["longitude"] != None: return l
+    else: return None
+
   def __init__(self, from_packed=False, android_context=None, service=False, location_provider=None):
-    self.sids = {
-      Sensor.SID_TIME: Time, Sensor.SID_RECEIVED: Received,
-      Sensor.SID_INFORMATION: Information, Sensor.SID_BATTERY: Battery,
-      Sensor.SID_PRESSURE: Pressure, Sensor.SID_LOCATION: Location,
-      Sensor.SID_PHYSICAL_LINK: PhysicalLink, Sensor.SID_TEMPERATURE: Temperature,
-      Sensor.SID_HUMIDITY: Humidity, Sensor.SID_MAGNETIC_FIELD: MagneticField,
-      Sensor.SID_AMBIENT_LIGHT: AmbientLight, Sensor.SID_GRAVITY: Gravity,
-      Sensor.SID_ANGULAR_VELOCITY: AngularVelocity, Sensor.SID_ACCELERATION: Acceleration,
-      Sensor.SID_PROXIMITY: Proximity, Sensor.SID_POWER_CONSUMPTION: PowerConsumption,
-      Sensor.SID_POWER_PRODUCTION: PowerProduction, Sensor.SID_PROCESSOR: Processor,
-      Sensor.SID_RAM: RandomAccessMemory, Sensor.SID_NVM: NonVolatileMemory,
-      Sensor.SID_CUSTOM: Custom, Sensor.SID_TANK: Tank, Sensor.SID_FUEL: Fuel,
-      Sensor.SID_RNS_TRANSPORT: RNSTransport, Sensor.SID_LXMF_PROPAGATION: LXMFPropagation,
-      Sensor.SID_CONNECTION_MAP: ConnectionMap}
-
-    self.available = {
-      "time": Sensor.SID_TIME,
-      "information": Sensor.SID_INFORMATION, "received": Sensor.SID_RECEIVED,
-      "battery": Sensor.SID_BATTERY, "pressure": Sensor.SID_PRESSURE,
-      "location": Sensor.SID_LOCATION, "physical_link": Sensor.SID_PHYSICAL_LINK,
-      "temperature": Sensor.SID_TEMPERATURE, "humidity": Sensor.SID_HUMIDITY,
-      "magnetic_field": Sensor.SID_MAGNETIC_FIELD, "ambient_light": Sensor.SID_AMBIENT_LIGHT,
-      "gravity": Sensor.SID_GRAVITY, "angular_velocity": Sensor.SID_ANGULAR_VELOCITY,
-      "acceleration": Sensor.SID_ACCELERATION, "proximity": Sensor.SID_PROXIMITY,
-      "power_consumption": Sensor.SID_POWER_CONSUMPTION, "power_production": Sensor.SID_POWER_PRODUCTION,
-      "processor": Sensor.SID_PROCESSOR, "ram": Sensor.SID_RAM, "nvm": Sensor.SID_NVM,
-      "custom": Sensor.SID_CUSTOM, "tank": Sensor.SID_TANK, "fuel": Sensor.SID_FUEL,
-      "rns_transport": Sensor.SID_RNS_TRANSPORT, "lxmf_propagation": Sensor.SID_LXMF_PROPAGATION,
-      "connection_map": Sensor.SID_CONNECTION_MAP}
-
-    self.names = {}
-    for name in self.available:
-      self.names[self.available[name]] = name
+    self.sids = sensor_classes
+    self.available = sensor_sids
+    self.names = sensor_names
 
     self.from_packed = from_packed
     self.sensors = {}
@@ -3138,6 +3125,107 @@ class ConnectionMap(Sensor):
 
     return None
 
+# Sensor lookup tables shared by all telemeters
+sensor_classes = {
+  Sensor.SID_TIME: Time, Sensor.SID_RECEIVED: Received,
+  Sensor.SID_INFORMATION: Information, Sensor.SID_BATTERY: Battery,
+  Sensor.SID_PRESSURE: Pressure, Sensor.SID_LOCATION: Location,
+  Sensor.SID_PHYSICAL_LINK: PhysicalLink, Sensor.SID_TEMPERATURE: Temperature,
+  Sensor.SID_HUMIDITY: Humidity, Sensor.SID_MAGNETIC_FIELD: MagneticField,
+  Sensor.SID_AMBIENT_LIGHT: AmbientLight, Sensor.SID_GRAVITY: Gravity,
+  Sensor.SID_ANGULAR_VELOCITY: AngularVelocity, Sensor.SID_ACCELERATION: Acceleration,
+  Sensor.SID_PROXIMITY: Proximity, Sensor.SID_POWER_CONSUMPTION: PowerConsumption,
+  Sensor.SID_POWER_PRODUCTION: PowerProduction, Sensor.SID_PROCESSOR: Processor,
+  Sensor.SID_RAM: RandomAccessMemory, Sensor.SID_NVM: NonVolatileMemory,
+  Sensor.SID_CUSTOM: Custom, Sensor.SID_TANK: Tank, Sensor.SID_FUEL: Fuel,
+  Sensor.SID_RNS_TRANSPORT: RNSTransport, Sensor.SID_LXMF_PROPAGATION: LXMFPropagation,
+  Sensor.SID_CONNECTION_MAP: ConnectionMap}
+
+sensor_sids = {
+  "time": Sensor.SID_TIME,
+  "information": Sensor.SID_INFORMATION, "received": Sensor.SID_RECEIVED,
+  "battery": Sensor.SID_BATTERY, "pressure": Sensor.SID_PRESSURE,
+  "location": Sensor.SID_LOCATION, "physical_link": Sensor.SID_PHYSICAL_LINK,
+  "temperature": Sensor.SID_TEMPERATURE, "humidity": Sensor.SID_HUMIDITY,
+  "magnetic_field": Sensor.SID_MAGNETIC_FIELD, "ambient_light": Sensor.SID_AMBIENT_LIGHT,
+  "gravity": Sensor.SID_GRAVITY, "angular_velocity": Sensor.SID_ANGULAR_VELOCITY,
+  "acceleration": Sensor.SID_ACCELERATION, "proximity": Sensor.SID_PROXIMITY,
+  "power_consumption": Sensor.SID_POWER_CONSUMPTION, "power_production": Sensor.SID_POWER_PRODUCTION,
+  "processor": Sensor.SID_PROCESSOR, "ram": Sensor.SID_RAM, "nvm": Sensor.SID_NVM,
+  "custom": Sensor.SID_CUSTOM, "tank": Sensor.SID_TANK, "fuel": Sensor.SID_FUEL,
+  "rns_transport": Sensor.SID_RNS_TRANSPORT, "lxmf_propagation": Sensor.SID_LXMF_PROPAGATION,
+  "connection_map": Sensor.SID_CONNECTION_MAP}
+
+sensor_names = {}
+for name in sensor_sids:
+  sensor_names[sensor_sids[name]] = name
+
+sensor_unpackers = {}
+def sensor_unpacker(sid):
+  # Sensor unpacking does not depend on instance state, so one
+  # instance per sensor type is reused for peeking into telemetry.
+  if not sid in sensor_unpackers:
+    sensor_unpackers[sid] = sensor_classes[sid]()
+  return sensor_unpackers[sid]
+
+class PackedSensors(dict):
+  # Sensor container for telemeters created from packed telemetry.
+  # Sensors are only instantiated and unpacked when first accessed,
+  # so reading a single value does not decode the entire telemetry.
+  def __init__(self, telemeter, packed):
+    super().__init__()
+    self._telemeter = telemeter
+    self._pending = {}
+    for sid in packed:
+      if sid in sensor_classes:
+        name = sensor_names[sid]
+        self._pending[name] = (sid, packed[sid])
+        dict.__setitem__(self, name, None)
+
+  def _materialize(self, name):
+    sid, packed = self._pending.pop(name)
+    s = sensor_classes[sid]()
+    s.data = s.unpack(packed)
+    s.synthesized = True
+    s.active = True
+    s._telemeter = self._telemeter
+    dict.__setitem__(self, name, s)
+    return s
+
+  def __getitem__(self, name):
+    if name in self._pending: return self._materialize(name)
+    else: return dict.__getitem__(self, name)
+
+  def __setitem__(self, name, value):
+    self._pending.pop(name, None)
+    dict.__setitem__(self, name, value)
+
+  def __delitem__(self, name):
+    self._pending.pop(name, None)
+    dict.__delitem__(self, name)
+
+  def get(self, name, default=None):
+    if name in self: return self[name]
+    else: return default
+
+  def packed_data(self, name):
+    # Returns the packed data of a sensor, without unpacking it
+    if name in self._pending: return self._pending[name][1]
+    else: return dict.__getitem__(self, name).pack()
+
+  def pop(self, name, *default):
+    if name in self._pending: self._materialize(name)
+    return dict.pop(self, name, *default)
+
+  def values(self):
+    return [self[name] for name in self]
+
+  def items(self):
+    return [(name, self[name]) for name in self]
+
+  def copy(self):
+    return {name: self[name] for name in self}
+
 def mqtt_desthash(desthash):
   if type(desthash) == bytes:
     return RNS.hexrep(desthash, delimit=False)
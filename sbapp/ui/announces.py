@@ -5,11 +5,13 @@ from kivy.metrics import dp,sp
 from kivy.uix.boxlayout import BoxLayout
 from kivy.properties import StringProperty, BooleanProperty
 from kivymd.uix.list import MDList, IconLeftWidget, IconRightWidget, TwoLineAvatarIconListItem
+from kivymd.uix.recycleview import MDRecycleView
 from kivymd.uix.menu import MDDropdownMenu
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.boxlayout import BoxLayout
 from kivy.clock import Clock
 from kivy.core.clipboard import Clipboard
+from kivy.effects.scroll import ScrollEffect
 
 from kivymd.uix.button import MDRectangleFlatButton
 from kivymd.uix.dialog import MDDialog
@@ -27,12 +29,125 @@ if RNS.vendor.platformutils.get_platform() == "android":
 else:
     from .helpers import ts_format
 
+class AnnounceEntry(TwoLineAvatarIconListItem):
+    app = None
+    owner_screen = None
+    delivery_dropdown = None
+    propagation_dropdown = None
+
+    icon = StringProperty()
+
+    def __init__(self):
+        super().__init__()
+        self.bind(on_release=self.info_action)
+        self.ids.right_icon.bind(on_release=self.right_icon_action)
+        self.__init_menus()
+
+    def __init_menus(self):
+        dmi_h = 40
+        if AnnounceEntry.delivery_dropdown == None:
+            dm_items = [ { "viewclass": "OneLineListItem", "text": "Converse", "height": dp(dmi_h), "on_release": self.converse_action },
+                         { "viewclass": "OneLineListItem", "text": "Copy address", "height": dp(dmi_h), "on_release": self.copy_address_action },
+                         { "viewclass": "OneLineListItem", "text": "Delete Announce", "height": dp(dmi_h), "on_release": self.delete_action } ]
+
+            AnnounceEntry.delivery_dropdown = MDDropdownMenu(caller=None, items=dm_items, position="auto", width=dp(256), elevation=0, radius=dp(3))
+            AnnounceEntry.delivery_dropdown.effect_cls = ScrollEffect
+            AnnounceEntry.delivery_dropdown.md_bg_color = self.app.color_hover
+
+        if AnnounceEntry.propagation_dropdown == None:
+            dm_items = [ { "viewclass": "OneLineListItem", "text": "Use this Propagation Node", "height": dp(dmi_h), "on_release": self.set_node_action },
+                         { "viewclass": "OneLineListItem", "text": "Copy address", "height": dp(dmi_h), "on_release": self.copy_address_action },
+                         { "viewclass": "OneLineListItem", "text": "Delete Announce", "height": dp(dmi_h), "on_release": self.delete_action } ]
+
+            AnnounceEntry.propagation_dropdown = MDDropdownMenu(caller=None, items=dm_items, position="auto", width=dp(256), elevation=0, radius=dp(3))
+            AnnounceEntry.propagation_dropdown.effect_cls = ScrollEffect
+            AnnounceEntry.propagation_dropdown.md_bg_color = self.app.color_hover
+
+    def dropdown_dismiss(self):
+        AnnounceEntry.delivery_dropdown.dismiss(); AnnounceEntry.propagation_dropdown.dismiss()
+
+    def right_icon_action(self, sender):
+        for dropdown in [AnnounceEntry.delivery_dropdown, AnnounceEntry.propagation_dropdown]:
+            dropdown.context_dest = self.sb_uid
+            dropdown.caller = self.ids.right_icon
+
+        if self.dest_type == "lxmf.delivery": AnnounceEntry.delivery_dropdown.open()
+        elif self.dest_type == "lxmf.propagation": AnnounceEntry.propagation_dropdown.open()
+
+    def info_action(self, sender):
+        ok_button = MDRectangleFlatButton(text="OK",font_size=dp(18))
+        dest = self.sb_uid; ts = self.ts_plain; link_extras = self.link_extras
+        if self.a_name: disp_name = multilingual_markup(escape_markup(str(self.a_name)).encode("utf-8")).decode("utf-8")
+        else: disp_name = None
+
+        if self.dest_type == "lxmf.delivery":
+            ad_text = "[size=22dp]LXMF Peer[/size]\n\n[b]Received[/b] "+ts+"\n[b]Address[/b] "+RNS.prettyhexrep(dest)+"\n[b]Name[/b] "+str(disp_name)+"\n[b]Stamp Cost[/b] "+str(self.a_cost)+link_extras
+
+        elif self.dest_type == "lxmf.propagation":
+            disp_name = f"\n[b]Name[/b] {disp_name}" if disp_name else ""
+            disp_cost = f"\n[b]Stamp Cost[/b] {self.a_cost}" if self.a_cost else ""
+            ad_text = f"[size=22dp]LXMF Propagation Node[/size]\n\n[b]Received[/b] {ts}\n[b]Address[/b] {RNS.prettyhexrep(dest)+link_extras}{disp_name}{disp_cost}"
+
+        else:
+            ad_text = f"[size=22dp]Unknown Announce[/size]\n\n[b]Received[/b] {ts}\n[b]Address[/b] {RNS.prettyhexrep(dest)}"
+
+        dialog = MDDialog(text=ad_text, buttons=[ ok_button ])
+        def dl_ok(s): dialog.dismiss()
+        ok_button.bind(on_release=dl_ok)
+        dialog.open()
+
+    def converse_action(self):
+        self.dropdown_dismiss()
+        self.app.conversation_from_announce_action(AnnounceEntry.delivery_dropdown.context_dest)
+
+    def copy_address_action(self):
+        self.dropdown_dismiss()
+        Clipboard.copy(RNS.hexrep(AnnounceEntry.delivery_dropdown.context_dest, delimit=False))
+
+    def set_node_action(self):
+        self.dropdown_dismiss()
+        dest = AnnounceEntry.propagation_dropdown.context_dest
+        self.app.sideband.set_active_propagation_node(dest)
+        self.app.sideband.config["lxmf_propagation_node"] = dest
+        self.app.sideband.save_configuration()
+
+    def delete_action(self):
+        dest = AnnounceEntry.delivery_dropdown.context_dest
+        self.dropdown_dismiss()
+        yes_button = MDRectangleFlatButton(text="Yes",font_size=dp(18), theme_text_color="Custom", line_color=self.app.color_reject, text_color=self.app.color_reject)
+        no_button = MDRectangleFlatButton(text="No",font_size=dp(18))
+        dialog = MDDialog(title="Delete announce?", buttons=[ yes_button, no_button ], padding=[0,0,dp(32),0])
+        def dl_yes(s):
+            dialog.dismiss()
+            def cb(dt):
+                self.app.sideband.delete_announce(dest)
+                self.owner_screen.update()
+            Clock.schedule_once(cb, 0.2)
+        def dl_no(s):
+            dialog.dismiss()
+
+        yes_button.bind(on_release=dl_yes)
+        no_button.bind(on_release=dl_no)
+        dialog.open()
+
+class AnnounceList(MDRecycleView):
+    def __init__(self):
+        super().__init__()
+        self.data = []
+
 class Announces():
+    # When scrolled to within this fraction of the end of the list,
+    # the next page of announces is fetched
+    LOAD_MORE_THRESHOLD = 0.1
+    FILTER_DELAY = 0.35
+
     def __init__(self, app):
         self.app = app
-        self.context_dests = []
-        self.added_item_dests = []
+        self.announce_list = None
         self.list = None
+        self.name_filter = None
+        self.next_cursor = None
+        self.loading = False
 
         if not self.app.root.ids.screen_manager.has_screen("announces_screen"):
             self.screen = Builder.load_string(layout_announces_screen)
@@ -40,67 +155,78 @@ class Announces():
             self.ids = self.screen.ids
             self.app.root.ids.screen_manager.add_widget(self.screen)
 
-        self.fetch_announces()
-        self.list = MDList()
-        # self.update()
+        self.load_trigger = Clock.create_trigger(self.load_more)
+        self.filter_trigger = Clock.create_trigger(self.filter_changed, Announces.FILTER_DELAY)
+        self.ids.announces_filter.font_name = self.app.input_font
+        self.ids.announces_filter.bind(text=lambda instance, text: self.filter_trigger())
 
-    def fetch_announces(self):
-        self.announces = self.app.sideband.list_announces()
+    def fetch_announces(self, cursor=None, limit=None):
+        return self.app.sideband.list_announces_page(name_prefix=self.name_filter, cursor=cursor, limit=limit)
 
     def reload(self):
         self.clear_list()
         self.update()
 
     def clear_list(self):
-        if self.list != None:
-            self.list.clear_widgets()
-
-        self.context_dests = []
-        self.added_item_dests = []
+        if self.announce_list != None:
+            self.announce_list.data = []
+        self.next_cursor = None
 
     def update(self):
         us = time.time()
-        self.fetch_announces()
-        self.update_widget()
+        if self.announce_list == None:
+            self.announce_list = AnnounceList()
+            self.list = self.announce_list
+            self.announce_list.bind(scroll_y=self.scroll_changed)
+            self.ids.announce_list_container.add_widget(self.announce_list)
+
+        # Reload as many announces as are currently loaded, so
+        # the list keeps its position when new announces arrive
+        limit = max(len(self.announce_list.data), self.app.sideband.ANNOUNCES_PAGE_SIZE)
+        announces, self.next_cursor = self.fetch_announces(limit=limit)
+        self.announce_list.data = self.list_entries(announces)
+
         self.app.sideband.setstate("app.flags.new_announces", False)
         RNS.log("Updated announce stream widgets in "+RNS.prettytime(time.time()-us), RNS.LOG_DEBUG)
 
-    def update_widget(self):
-        if self.list == None:
-            self.list = MDList()
-
-        remove_widgets = []
-        for item in self.list.children:
-            if not item.sb_uid in (a["dest"] for a in self.announces):
-                remove_widgets.append(item)
-            
-            else:
-                for announce in self.announces:
-                    if announce["dest"] == item.sb_uid:
-                        if announce["time"] > item.ts:
-                            remove_widgets.append(item)
-                            break
-
-        for item in remove_widgets:
-            if item.sb_uid in self.added_item_dests:
-                self.added_item_dests.remove(item.sb_uid)
-            self.list.remove_widget(item)
-
-        for announce in self.announces:
+    def load_more(self, dt=None):
+        if self.next_cursor == None or self.loading:
+            return
+
+        self.loading = True
+        try:
+            announces, self.next_cursor = self.fetch_announces(cursor=self.next_cursor)
+            self.announce_list.data.extend(self.list_entries(announces))
+        finally:
+            self.loading = False
+
+    def scroll_changed(self, instance, scroll_y):
+        if self.next_cursor != None and scroll_y <= Announces.LOAD_MORE_THRESHOLD:
+            self.load_trigger()
+
+    def filter_changed(self, dt=None):
+        name_filter = self.ids.announces_filter.text.strip()
+        self.name_filter = name_filter if len(name_filter) > 0 else None
+        self.reload()
+        self.announce_list.scroll_y = 1.0
+
+    def list_entries(self, announces):
+        AnnounceEntry.app = self.app
+        AnnounceEntry.owner_screen = self
+        entries = []
+        for announce in announces:
             context_dest = announce["dest"]
             ts = announce["time"]
             a_name = announce["name"]
             a_cost = announce["cost"]
             dest_type = announce["type"]
-            a_rssi = None
-            a_snr = None
             a_q = None
 
             link_extras_str = ""
             link_extras_full = ""
             if "extras" in announce and announce["extras"] != None:
                 extras = announce["extras"]
-                if "link_stats" in extras:
+                if "link_stats" in extras and extras["link_stats"] != None:
                     link_stats = extras["link_stats"]
                     if "rssi" in link_stats and "snr" in link_stats and "q" in link_stats:
                         a_rssi = link_stats["rssi"]
@@ -111,190 +237,62 @@ class Announces():
                             link_extras_full = f"\n[b]Link Quality[/b] {a_q}%[/b]\n[b]RSSI[/b] {a_rssi}\n[b]SNR[/b] {a_snr}"
 
             sig_icon = multilingual_markup(sig_icon_for_q(a_q).encode("utf-8")).decode("utf-8")
+            time_string = sig_icon + "  " + time.strftime(ts_format, time.localtime(ts)) + link_extras_str
+            time_string_plain = time.strftime(ts_format, time.localtime(ts))
+
+            if dest_type == "lxmf.delivery":
+                disp_name = multilingual_markup(escape_markup(str(self.app.sideband.peer_display_name(context_dest))).encode("utf-8")).decode("utf-8")
+                if self.app.sideband.is_trusted(context_dest): icon = "account-check"
+                else: icon = "account-question"
 
-            if not context_dest in self.added_item_dests:
-                if self.app.sideband.is_trusted(context_dest):
-                    trust_icon = "account-check"
-                else:
-                    trust_icon = "account-question"
-
-                def gen_info(ts, dest, name, cost, dtype, link_extras):
-                    name = multilingual_markup(escape_markup(str(name)).encode("utf-8")).decode("utf-8")
-                    cost = str(cost)
-                    def x(sender):
-                        yes_button = MDRectangleFlatButton(text="OK",font_size=dp(18))    
-                        if dtype == "lxmf.delivery":
-                            ad_text = "[size=22dp]LXMF Peer[/size]\n\n[b]Received[/b] "+ts+"\n[b]Address[/b] "+RNS.prettyhexrep(dest)+"\n[b]Name[/b] "+name+"\n[b]Stamp Cost[/b] "+cost+link_extras
-
-                        if dtype == "lxmf.propagation":
-                            if a_name:
-                                disp_name = multilingual_markup(escape_markup(str(a_name)).encode("utf-8")).decode("utf-8")
-                                disp_name = f"\n[b]Name[/b] {disp_name}"
-                            else: disp_name = ""
-                            if a_cost:
-                                disp_cost = str(a_cost)
-                                disp_cost = f"\n[b]Stamp Cost[/b] {disp_cost}"
-                            else: disp_cost = ""
-
-                            ad_text = f"[size=22dp]LXMF Propagation Node[/size]\n\n[b]Received[/b] {ts}\n[b]Address[/b] {RNS.prettyhexrep(dest)+link_extras}{disp_name}{disp_cost}"
-
-                        dialog = MDDialog(
-                            text=ad_text,
-                            buttons=[ yes_button ],
-                            # elevation=0,
-                        )
-                        def dl_yes(s):
-                            dialog.dismiss()
-
-                        yes_button.bind(on_release=dl_yes)
-                        item.dmenu.dismiss()
-                        dialog.open()
-                    return x
-
-                time_string = sig_icon + "  " + time.strftime(ts_format, time.localtime(ts)) + link_extras_str
-                time_string_plain = time.strftime(ts_format, time.localtime(ts))
-
-                if dest_type == "lxmf.delivery":
-                    disp_name = multilingual_markup(escape_markup(str(self.app.sideband.peer_display_name(context_dest))).encode("utf-8")).decode("utf-8")
-                    iconl = IconLeftWidget(icon=trust_icon)
-
-                elif dest_type == "lxmf.propagation":
-                    if a_name: disp_name = multilingual_markup(escape_markup(str(a_name)).encode("utf-8")).decode("utf-8")
-                    else: disp_name = f"Propagation Node"
-                    disp_name = f"{disp_name} {RNS.prettyhexrep(context_dest)}"
-                    iconl = IconLeftWidget(icon="upload-network")
-
-                else:
-                    disp_name = "Unknown Announce"
-                    iconl = IconLeftWidget(icon="progress-question")
-
-                item = TwoLineAvatarIconListItem(text=time_string, secondary_text=disp_name, on_release=gen_info(time_string_plain, context_dest, a_name, a_cost, dest_type, link_extras_full))
-                item.add_widget(iconl)
-                item.sb_uid = context_dest
-                item.ts = ts
-
-                def gen_del(dest, item):
-                    def x():
-                        yes_button = MDRectangleFlatButton(text="Yes",font_size=dp(18), theme_text_color="Custom", line_color=self.app.color_reject, text_color=self.app.color_reject)
-                        no_button = MDRectangleFlatButton(text="No",font_size=dp(18))
-                        dialog = MDDialog(
-                            title="Delete announce?",
-                            buttons=[ yes_button, no_button ],
-                            padding=[0,0,dp(32),0]
-                            # elevation=0,
-                        )
-                        def dl_yes(s):
-                            dialog.dismiss()
-                            def cb(dt):
-                                self.app.sideband.delete_announce(dest)
-                                self.update()
-                            Clock.schedule_once(cb, 0.2)
-                        def dl_no(s):
-                            dialog.dismiss()
-
-                        yes_button.bind(on_release=dl_yes)
-                        no_button.bind(on_release=dl_no)
-                        item.dmenu.dismiss()
-                        dialog.open()
-                    return x
-
-                def gen_conv(dest, item):
-                    def x():
-                        item.dmenu.dismiss()
-                        self.app.conversation_from_announce_action(dest)
-                    return x
-
-                def gen_copy_addr(dest, item):
-                    def x():
-                        Clipboard.copy(RNS.hexrep(dest, delimit=False))
-                        item.dmenu.dismiss()
-                    return x
-
-                def gen_set_node(dest, item):
-                    def x():
-                        item.dmenu.dismiss()
-                        self.app.sideband.set_active_propagation_node(dest)
-                        self.app.sideband.config["lxmf_propagation_node"] = dest
-                        self.app.sideband.save_configuration()
-                    return x
-
-                if dest_type == "lxmf.delivery":
-                    dm_items = [
-                        {
-                            "viewclass": "OneLineListItem",
-                            "text": "Converse",
-                            "height": dp(40),
-                            "on_release": gen_conv(context_dest, item)
-                        },
-                        {
-                            "viewclass": "OneLineListItem",
-                            "text": "Copy address",
-                            "height": dp(40),
-                            "on_release": gen_copy_addr(context_dest, item)
-                        },
-                        {
-                            "text": "Delete Announce",
-                            "viewclass": "OneLineListItem",
-                            "height": dp(40),
-                            "on_release": gen_del(context_dest, item)
-                        }
-                    ]
-
-                elif dest_type == "lxmf.propagation":
-                    dm_items = [
-                        {
-                            "viewclass": "OneLineListItem",
-                            "text": "Use this Propagation Node",
-                            "height": dp(40),
-                            "on_release": gen_set_node(context_dest, item)
-                        },
-                        {
-                            "viewclass": "OneLineListItem",
-                            "text": "Copy address",
-                            "height": dp(40),
-                            "on_release": gen_copy_addr(context_dest, item)
-                        },
-                        {
-                            "text": "Delete Announce",
-                            "viewclass": "OneLineListItem",
-                            "height": dp(40),
-                            "on_release": gen_del(context_dest, item)
-                        }
-                    ]
-
-                else:
-                    dm_items = []
-
-                item.iconr = IconRightWidget(icon="dots-vertical");
-                
-                item.dmenu = MDDropdownMenu(
-                    caller=item.iconr,
-                    items=dm_items,
-                    position="auto",
-                    width=dp(256),
-                    elevation=0,
-                    radius=dp(3),
-                )
-                item.dmenu.md_bg_color = self.app.color_hover
-
-                def callback_factory(ref):
-                    def x(sender):
-                        ref.dmenu.open()
-                    return x
-
-                item.iconr.bind(on_release=callback_factory(item))
-                item.add_widget(item.iconr)
-                
-                self.added_item_dests.append(context_dest)
-                self.list.add_widget(item, index=len(self.list.children))
+            elif dest_type == "lxmf.propagation":
+                if a_name: disp_name = multilingual_markup(escape_markup(str(a_name)).encode("utf-8")).decode("utf-8")
+                else: disp_name = f"Propagation Node"
+                disp_name = f"{disp_name} {RNS.prettyhexrep(context_dest)}"
+                icon = "upload-network"
+
+            else:
+                disp_name = "Unknown Announce"
+                icon = "progress-question"
+
+            entries.append({"text": time_string, "secondary_text": disp_name, "icon": icon, "sb_uid": context_dest,
+                            "dest_type": dest_type, "a_name": a_name, "a_cost": a_cost, "ts_plain": time_string_plain,
+                            "link_extras": link_extras_full})
+
+        return entries
 
     def get_widget(self):
-        return self.list
+        return self.announce_list
+
+Builder.load_string("""
+<AnnounceEntry>
+    IconLeftWidget:
+        id: left_icon
+        icon: root.icon
+        _default_icon_pad: dp(14)
+        icon_size: dp(24)
+
+    IconRightWidget:
+        id: right_icon
+        icon: "dots-vertical"
+
+<AnnounceList>:
+    id: announces_scrollview
+    viewclass: "AnnounceEntry"
+    effect_cls: "ScrollEffect"
+
+    RecycleBoxLayout:
+        default_size: None, dp(72)
+        default_size_hint: 1, None
+        size_hint_y: None
+        height: self.minimum_height
+        orientation: "vertical"
+""")
 
 layout_announces_screen = """
 MDScreen:
     name: "announces_screen"
-    
+
     BoxLayout:
         orientation: "vertical"
 
@@ -310,21 +308,19 @@ MDScreen:
                 ]
             #    [['eye-off', lambda x: root.ids.screen_manager.app.announce_filter_action(self)]]
 
-        ScrollView:
-            id: announces_scrollview
-
-            MDBoxLayout:
-                orientation: "vertical"
-                spacing: "24dp"
-                size_hint_y: None
-                height: self.minimum_height
-                padding: dp(64)
-
-                MDLabel:
-                    id: announces_info
-                    markup: True
-                    text: ""
-                    size_hint_y: None
-                    text_size: self.width, None
-                    height: self.texture_size[1]
+        MDBoxLayout:
+            orientation: "vertical"
+            size_hint_y: None
+            height: self.minimum_height
+            padding: [dp(28), dp(0), dp(28), dp(8)]
+
+            MDTextField:
+                id: announces_filter
+                hint_text: "Search by name"
+                text: ""
+                font_size: dp(18)
+
+        MDBoxLayout:
+            orientation: "vertical"
+            id: announce_list_container
 """
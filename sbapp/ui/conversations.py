@@ -285,11 +285,15 @@ class Conversations():
         self.app.sideband.setstate("app.flags.new_conversations", False)
         self.app.sideband.setstate("wants.viewupdate.conversations", False)
 
+    def conv_appearance(self, conv):
+        if "appearance" in conv: return conv["appearance"]
+        else: return self.app.sideband.peer_appearance(conv["dest"], conv=conv)
+
     def trust_icon(self, conv):
         conv_type = conv["type"]
         context_dest = conv["dest"]
         unread = conv["unread"]
-        appearance = self.app.sideband.peer_appearance(context_dest, conv=conv)
+        appearance = self.conv_appearance(conv)
         is_trusted = conv["trust"] == 1
         appearance_from_all = self.app.sideband.config["display_style_from_all"]
 
@@ -305,7 +309,7 @@ class Conversations():
             if conv_type == self.app.sideband.CONV_VOICE:
                 trust_icon = "phone"
             else:
-                if self.app.sideband.requests_allowed_from(context_dest):
+                if self.app.sideband.requests_allowed_from(context_dest, conv_data=conv):
                     if unread:
                         if is_trusted:
                             trust_icon = "email-seal"
@@ -333,7 +337,7 @@ class Conversations():
         last_activity = conv["last_activity"]
         trusted = conv["trust"] == 1
         appearance_from_all = self.app.sideband.config["display_style_from_all"]
-        appearance = self.app.sideband.peer_appearance(context_dest, conv=conv)
+        appearance = self.conv_appearance(conv)
         is_object = self.app.sideband.is_object(context_dest, conv_data=conv)
         da = self.app.sideband.DEFAULT_APPEARANCE
         ic_s = 24; ic_p = 14
@@ -373,7 +377,7 @@ class Conversations():
         context_dest = conv["dest"]
         trusted = conv["trust"] == 1
         appearance_from_all = self.app.sideband.config["display_style_from_all"]
-        appearance = self.app.sideband.peer_appearance(context_dest, conv=conv)
+        appearance = self.conv_appearance(conv)
         da = self.app.sideband.DEFAULT_APPEARANCE
         ic_s = 24; ic_p = 14
 
@@ -398,11 +402,10 @@ class Conversations():
             last_activity = conv["last_activity"]
             colors = self.get_icon_colors(conv)
 
-            peer_disp_name = multilingual_markup(escape_markup(str(self.app.sideband.peer_display_name(context_dest))).encode("utf-8")).decode("utf-8")
-            existing_conv = self.app.sideband._db_conversation(context_dest)
-            is_object = self.app.sideband.is_object(context_dest, conv_data=existing_conv)
-            is_trusted = self.app.sideband.is_trusted(context_dest, conv_data=existing_conv)
-            ptt_enabled = self.app.sideband.ptt_enabled(context_dest, conv_data=existing_conv)
+            peer_disp_name = multilingual_markup(escape_markup(str(conv["display_name"])).encode("utf-8")).decode("utf-8")
+            is_object = conv["is_object"]
+            is_trusted = conv["trust"] == 1
+            ptt_enabled = conv["ptt_enabled"]
             icon = self.trust_icon(conv)
 
             cl_entry = {"icon": icon, "text": peer_disp_name, "conv_type": conv_type,
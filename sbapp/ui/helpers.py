@@ -5,6 +5,8 @@ from kivymd.theming import ThemableBehavior
 from kivymd.uix.list import OneLineIconListItem, MDList, IconLeftWidget, IconRightWidget
 from kivy.properties import StringProperty
 import re
+from bisect import bisect_right
+from functools import lru_cache
 
 ts_format_date = "%Y-%m-%d"
 ts_format = "%Y-%m-%d %H:%M:%S"
@@ -55,7 +57,7 @@ class IconListItem(OneLineIconListItem):
     icon = StringProperty()
 
 def is_emoji(unicode_character):
-    return unicode_character in emoji_lookup
+    return unicode_character in emoji_set
 
 def strip_emojis(str_input):
     output = ""
@@ -64,40 +66,44 @@ def strip_emojis(str_input):
             output += cp
     return output
 
+MARKUP_CACHE_SIZE = 512
+
+@lru_cache(maxsize=MARKUP_CACHE_SIZE)
 def multilingual_markup(data):
-    do = ""
+    do = []
     rfont = "default"
     ds = data.decode("utf-8")
-    di = 0
     persistent_regions = [(m.start(), m.end()) for m in re.finditer("(?s)\[font=(?:nf|term)\].*?\[/font\]", ds)]
+    pr_count = len(persistent_regions)
+    pr = 0
 
-    for cp in ds:
+    for di, cp in enumerate(ds):
         match = False
         switch = False
         pfont = rfont
 
-        if is_emoji(cp):
+        if cp in emoji_set:
             match = True
             if rfont != "emoji":
                 switch = True
                 rfont = "emoji"
 
-        in_persistent = False
-        if any(x[0] < di and x[1] > di for x in persistent_regions):
-            in_persistent = True
+        # Persistent regions are ordered and do not overlap, so they
+        # can be swept along with the input
+        while pr < pr_count and persistent_regions[pr][1] <= di:
+            pr += 1
+        in_persistent = pr < pr_count and persistent_regions[pr][0] < di
 
         if not match:
-            for range_start in codepoint_map:
-                range_end = codepoint_map[range_start][0]
-                mapped_font = codepoint_map[range_start][1]
-
-                if range_end >= ord(cp) >= range_start:
-                    match = True
-                    if rfont != mapped_font:
-                        if not in_persistent:
-                            rfont = mapped_font
-                            switch = True
-                    break
+            o = ord(cp)
+            ri = bisect_right(codepoint_starts, o) - 1
+            if ri >= 0 and o <= codepoint_ends[ri]:
+                match = True
+                mapped_font = codepoint_fonts[ri]
+                if rfont != mapped_font:
+                    if not in_persistent:
+                        rfont = mapped_font
+                        switch = True
 
         if (not match) and rfont != "default":
             rfont = "default"
@@ -105,17 +111,16 @@ def multilingual_markup(data):
 
         if switch:
             if pfont != "default":
-                do += "[/font]"
+                do.append("[/font]")
             if rfont != "default":
-                do += "[font="+str(rfont)+"]"
+                do.append("[font="+str(rfont)+"]")
 
-        do += cp
-        di += 1
+        do.append(cp)
 
     if rfont != "default":
-        do += "[/font]"
+        do.append("[/font]")
 
-    return do.encode("utf-8")
+    return "".join(do).encode("utf-8")
 
 def sig_icon_for_q(q):
     if q == None:
@@ -303,3 +308,27 @@ emoji_extra_1 = [
 for e in emoji_extra_1:
     if not e in emoji_lookup:
         emoji_lookup.append(e)
+
+emoji_set = set(emoji_lookup)
+
+# The codepoint map is flattened into sorted, non-overlapping ranges
+# for binary search. Where ranges in the map overlap, the one listed
+# first takes precedence.
+codepoint_starts = []
+codepoint_ends = []
+codepoint_fonts = []
+def _flatten_codepoint_map():
+    bounds = sorted(set([s for s in codepoint_map]+[codepoint_map[s][0]+1 for s in codepoint_map]))
+    for segment_start, segment_end in zip(bounds, bounds[1:]):
+        for range_start in codepoint_map:
+            range_end, mapped_font = codepoint_map[range_start]
+            if range_start <= segment_start and segment_end-1 <= range_end:
+                if len(codepoint_ends) > 0 and codepoint_ends[-1] == segment_start-1 and codepoint_fonts[-1] == mapped_font:
+                    codepoint_ends[-1] = segment_end-1
+                else:
+                    codepoint_starts.append(segment_start)
+                    codepoint_ends.append(segment_end-1)
+                    codepoint_fonts.append(mapped_font)
+                break
+
+_flatten_codepoint_map()
@@ -1013,6 +1013,17 @@ MDScreen:
                         on_release: root.app.map_select_file_action(self)
                         disabled: False
 
+                    MDRectangleFlatIconButton:
+                        id: map_prefetch_button
+                        icon: "map-marker-down"
+                        text: "Download Visible Area"
+                        padding: [dp(0), dp(14), dp(0), dp(14)]
+                        icon_size: dp(24)
+                        font_size: dp(16)
+                        size_hint: [1.0, None]
+                        on_release: root.app.map_prefetch_action(self)
+                        disabled: False
+
                     MDRectangleFlatIconButton:
                         id: map_cache_button
                         icon: "map-clock-outline"
@@ -81,6 +81,10 @@ class ListLXMessageCard(MDCard):
             RNS.trace_exception(e)
 
 class Messages():
+    # Increment when the way message bodies are rendered changes,
+    # so that renders cached in the database are not reused
+    RENDER_VERSION = 1
+
     def __init__(self, app, context_dest):
         self.app = app
         self.context_dest = context_dest
@@ -97,6 +101,7 @@ class Messages():
         self.added_messages = 0
         self.latest_message_timestamp = None
         self.earliest_message_timestamp = time.time()
+        self.earliest_message_cursor = None
         self.loading_earlier_messages = False
         self.list = None
         self.widgets = []
@@ -113,12 +118,17 @@ class Messages():
         self.added_item_hashes = []
         self.added_messages = 0
         self.latest_message_timestamp = None
+        self.earliest_message_timestamp = time.time()
+        self.earliest_message_cursor = None
         self.widgets = []
 
         self.update()
 
     def load_more(self, dt):
-        for new_message in self.app.sideband.list_messages(self.context_dest, before=self.earliest_message_timestamp,limit=5):
+        if self.earliest_message_cursor != None: cursor = self.earliest_message_cursor
+        else: cursor = (self.earliest_message_timestamp, b"")
+        messages, next_cursor = self.app.sideband.list_messages_page(self.context_dest, cursor=cursor, limit=5)
+        for new_message in messages:
             self.new_messages.append(new_message)
 
         if len(self.new_messages) > 0:
@@ -525,6 +535,10 @@ class Messages():
         if self.loading_earlier_messages:
             self.new_messages.reverse()
 
+        markup_untrusted = self.app.sideband.config["trusted_markup_only"] and not self.is_trusted
+        render_settings = f"{Messages.RENDER_VERSION}:{int(markup_untrusted)}:{self.app.markup_render_settings()}"
+        new_renders = []
+
         for m in self.new_messages:
             if not m["hash"] in self.added_item_hashes:
                 renderer = None
@@ -532,32 +546,12 @@ class Messages():
                 if "lxm" in m and m["lxm"] and m["lxm"].fields != None and LXMF.FIELD_RENDERER in m["lxm"].fields:
                     renderer = m["lxm"].fields[LXMF.FIELD_RENDERER]
 
-                try:
-                    if self.app.sideband.config["trusted_markup_only"] and not self.is_trusted:
-                        message_input = str( escape_markup(m["content"].decode("utf-8")) ).encode("utf-8")
-                    else:
-                        message_input = m["content"]
-                        if renderer == LXMF.RENDERER_MARKDOWN:
-                            message_input = self.app.md_to_bbcode(message_input.decode("utf-8")).encode("utf-8")
-                            message_input = self.app.process_bb_markup(message_input.decode("utf-8")).encode("utf-8")
-                        elif renderer == LXMF.RENDERER_BBCODE:
-                            message_input = self.app.process_bb_markup(message_input.decode("utf-8")).encode("utf-8")
-                        else:
-                            message_input = str(escape_markup(m["content"].decode("utf-8"))).encode("utf-8")
-
-                except Exception as e:
-                    RNS.log(f"Message content could not be decoded: {e}", RNS.LOG_DEBUG)
-                    RNS.trace_exception(e)
-                    message_input = b""
-
-                if message_input.strip() == b"":
-                    if not ("lxm" in m and m["lxm"] != None and m["lxm"].fields != None and LXMF.FIELD_COMMANDS in m["lxm"].fields):
-                        message_input = "[i]This message contains no text content[/i]".encode("utf-8")
-
-                # Add clickable URL refs before multilingual font markup is applied
-                message_text_for_markup = message_input.decode("utf-8")
-                message_text_for_markup = _add_url_refs(message_text_for_markup)
-                message_markup = multilingual_markup(message_text_for_markup.encode("utf-8"))
+                render_key = f"{render_settings}:{renderer}".encode("utf-8")
+                if m.get("render") != None and m.get("render_key") == render_key:
+                    message_markup = m["render"]
+                else:
+                    message_markup = self.render_message(m, renderer)
+                    new_renders.append((m["hash"], render_key, message_markup))
 
                 txstr = time.strftime(ts_format, time.localtime(m["sent"]))
                 rxstr = time.strftime(ts_format, time.localtime(m["received"]))
@@ -1366,9 +1360,46 @@ class Messages():
                 if self.earliest_message_timestamp == None or m["received"] < self.earliest_message_timestamp:
                     self.earliest_message_timestamp = m["received"]
 
+                if self.earliest_message_cursor == None or (m["received"], m["hash"]) < self.earliest_message_cursor:
+                    self.earliest_message_cursor = (m["received"], m["hash"])
+
+        if len(new_renders) > 0:
+            self.app.sideband.save_message_renders(new_renders)
+
         self.added_messages += len(self.new_messages)
         self.new_messages = []
 
+    def render_message(self, m, renderer):
+        # Converts the message body to display markup. The result only
+        # depends on the message and the settings in the render key.
+        markup_untrusted = self.app.sideband.config["trusted_markup_only"] and not self.is_trusted
+        try:
+            if markup_untrusted:
+                message_input = str( escape_markup(m["content"].decode("utf-8")) ).encode("utf-8")
+            else:
+                message_input = m["content"]
+                if renderer == LXMF.RENDERER_MARKDOWN:
+                    message_input = self.app.md_to_bbcode(message_input.decode("utf-8")).encode("utf-8")
+                    message_input = self.app.process_bb_markup(message_input.decode("utf-8")).encode("utf-8")
+                elif renderer == LXMF.RENDERER_BBCODE:
+                    message_input = self.app.process_bb_markup(message_input.decode("utf-8")).encode("utf-8")
+                else:
+                    message_input = str(escape_markup(m["content"].decode("utf-8"))).encode("utf-8")
+
+        except Exception as e:
+            RNS.log(f"Message content could not be decoded: {e}", RNS.LOG_DEBUG)
+            RNS.trace_exception(e)
+            message_input = b""
+
+        if message_input.strip() == b"":
+            if not ("lxm" in m and m["lxm"] != None and m["lxm"].fields != None and LXMF.FIELD_COMMANDS in m["lxm"].fields):
+                message_input = "[i]This message contains no text content[/i]".encode("utf-8")
+
+        # Add clickable URL refs before multilingual font markup is applied
+        message_text_for_markup = message_input.decode("utf-8")
+        message_text_for_markup = _add_url_refs(message_text_for_markup)
+        return multilingual_markup(message_text_for_markup.encode("utf-8"))
+
     def get_widget(self):
         return self.list
 